@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ebay_tool_lister.settings')
 
 application = get_asgi_application()
+
+# The server's event loop lives as long as the process, so asyncio clients can be kept per loop
+from product_matcher import clients  # noqa: E402
+
+clients.serve_async()
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'product_matcher.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -131,7 +132,111 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Per-process cache for Vision hit counters, eBay item details, image probes, listing picture features
+# and page fragments
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+# Optional cache shared by every process, used by EBAY_SEARCH_CACHE_BACKEND=django
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', '')  # e.g. redis://localhost:6379/0; needs the redis package
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': CACHE_MAX_ENTRIES},
+    }
+}
+if CACHE_REDIS_URL:
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    }
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Vision API result cache
+# Re-uploads of byte-identical images are answered from stored VisionAPICall rows.
+VISION_CACHE_TTL_SECONDS = int(os.getenv('VISION_CACHE_TTL_SECONDS', 60 * 60 * 24 * 30))
+VISION_CACHE_MAX_ENTRIES = int(os.getenv('VISION_CACHE_MAX_ENTRIES', 50000))
+VISION_CACHE_EVICT_EVERY = int(os.getenv('VISION_CACHE_EVICT_EVERY', 100))  # Run eviction every N cache misses
+
+# eBay item detail lookups
+EBAY_DETAILS_MAX_WORKERS = int(os.getenv('EBAY_DETAILS_MAX_WORKERS', 8))
+EBAY_DETAILS_TIMEOUT_SECONDS = int(os.getenv('EBAY_DETAILS_TIMEOUT_SECONDS', 5))  # Per GetSingleItem call
+EBAY_DETAILS_DEADLINE_SECONDS = float(os.getenv('EBAY_DETAILS_DEADLINE_SECONDS', 8))  # For the whole fan-out
+EBAY_DETAILS_CACHE_TTL_SECONDS = int(os.getenv('EBAY_DETAILS_CACHE_TTL_SECONDS', 60 * 60))
+
+# Similar-image accessibility probes
+IMAGE_PROBE_MAX_WORKERS = int(os.getenv('IMAGE_PROBE_MAX_WORKERS', 5))
+IMAGE_PROBE_TIMEOUT_SECONDS = float(os.getenv('IMAGE_PROBE_TIMEOUT_SECONDS', 3))  # Per HEAD request
+IMAGE_PROBE_DEADLINE_SECONDS = float(os.getenv('IMAGE_PROBE_DEADLINE_SECONDS', 4))  # For all probes of one image
+IMAGE_PROBE_CACHE_TTL_SECONDS = int(os.getenv('IMAGE_PROBE_CACHE_TTL_SECONDS', 60 * 60 * 24))
+IMAGE_PROBE_NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv('IMAGE_PROBE_NEGATIVE_CACHE_TTL_SECONDS', 60 * 60))
+
+# Upload processing jobs (see `python manage.py run_worker`)
+UPLOAD_JOBS_INLINE = os.getenv('UPLOAD_JOBS_INLINE', 'False') == 'True'  # Process uploads inside the request (development only)
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv('JOB_POLL_INTERVAL_SECONDS', 1))
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', 15 * 60))  # Running jobs older than this are requeued
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+
+# Bulk uploads and pipelined job processing
+BULK_UPLOAD_MAX_FILES = int(os.getenv('BULK_UPLOAD_MAX_FILES', 500))
+DATA_UPLOAD_MAX_NUMBER_FILES = BULK_UPLOAD_MAX_FILES
+PIPELINE_BATCH_SIZE = int(os.getenv('PIPELINE_BATCH_SIZE', 32))  # Jobs a worker claims at once
+PIPELINE_VISION_WORKERS = int(os.getenv('PIPELINE_VISION_WORKERS', 2))  # Concurrent Vision batch requests
+PIPELINE_EBAY_WORKERS = int(os.getenv('PIPELINE_EBAY_WORKERS', 4))  # Concurrent eBay searches
+
+# Image normalization before Vision, and thumbnails for listing pages
+VISION_IMAGE_MAX_EDGE = int(os.getenv('VISION_IMAGE_MAX_EDGE', 1600))
+VISION_IMAGE_JPEG_QUALITY = int(os.getenv('VISION_IMAGE_JPEG_QUALITY', 85))
+THUMBNAIL_MAX_EDGE = int(os.getenv('THUMBNAIL_MAX_EDGE', 480))
+THUMBNAIL_JPEG_QUALITY = int(os.getenv('THUMBNAIL_JPEG_QUALITY', 80))
+
+# Near-duplicate detection: similar photos reuse the stored results of an earlier upload
+NEAR_DUPLICATE_REUSE = os.getenv('NEAR_DUPLICATE_REUSE', 'True') == 'True'
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv('NEAR_DUPLICATE_MAX_DISTANCE', 6))  # Differing bits out of 64
+NEAR_DUPLICATE_INDEX_REBUILD_SECONDS = int(os.getenv('NEAR_DUPLICATE_INDEX_REBUILD_SECONDS', 10 * 60))
+
+# Visual re-ranking of eBay search results
+LISTING_RERANK = os.getenv('LISTING_RERANK', 'True') == 'True'
+LISTING_IMAGE_MAX_WORKERS = int(os.getenv('LISTING_IMAGE_MAX_WORKERS', 8))
+LISTING_IMAGE_TIMEOUT_SECONDS = float(os.getenv('LISTING_IMAGE_TIMEOUT_SECONDS', 3))  # Per picture download
+LISTING_IMAGE_DEADLINE_SECONDS = float(os.getenv('LISTING_IMAGE_DEADLINE_SECONDS', 5))  # For all pictures of one search
+LISTING_FEATURES_CACHE_TTL_SECONDS = int(os.getenv('LISTING_FEATURES_CACHE_TTL_SECONDS', 60 * 60 * 24))
+
+# eBay keyword search cache (stale-while-revalidate)
+EBAY_SEARCH_CACHE_BACKEND = os.getenv('EBAY_SEARCH_CACHE_BACKEND', 'lru')  # 'lru' (per process) or 'django'
+EBAY_SEARCH_CACHE_TTL_SECONDS = int(os.getenv('EBAY_SEARCH_CACHE_TTL_SECONDS', 15 * 60))  # 0 disables the cache
+EBAY_SEARCH_CACHE_STALE_SECONDS = int(os.getenv('EBAY_SEARCH_CACHE_STALE_SECONDS', 60 * 60))  # Serve stale results while refreshing
+EBAY_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('EBAY_SEARCH_CACHE_MAX_ENTRIES', 1000))  # 'lru' backend only
+
+# Shared rate limits, retries and circuit breakers for upstream APIs (0 = no rate limit)
+RATE_LIMIT_VISION_PER_SECOND = float(os.getenv('RATE_LIMIT_VISION_PER_SECOND', 10))  # Batch requests, not images
+RATE_LIMIT_EBAY_FINDING_PER_SECOND = float(os.getenv('RATE_LIMIT_EBAY_FINDING_PER_SECOND', 5))
+RATE_LIMIT_EBAY_SHOPPING_PER_SECOND = float(os.getenv('RATE_LIMIT_EBAY_SHOPPING_PER_SECOND', 10))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 10))  # Calls allowed back to back after an idle period
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv('RATE_LIMIT_MAX_WAIT_SECONDS', 30))
+RATE_LIMIT_TOKEN_BATCH = int(os.getenv('RATE_LIMIT_TOKEN_BATCH', 4))  # Tokens a process takes from the shared bucket at once
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv('UPSTREAM_MAX_ATTEMPTS', 4))
+UPSTREAM_BACKOFF_BASE_SECONDS = float(os.getenv('UPSTREAM_BACKOFF_BASE_SECONDS', 0.5))
+UPSTREAM_BACKOFF_MAX_SECONDS = float(os.getenv('UPSTREAM_BACKOFF_MAX_SECONDS', 8))
+CIRCUIT_BREAKER_FAILURES = int(os.getenv('CIRCUIT_BREAKER_FAILURES', 5))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv('CIRCUIT_BREAKER_RESET_SECONDS', 30))
+
+# Coalescing of identical Vision, eBay search and item lookups in flight at the same time
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv('SINGLE_FLIGHT_WAIT_SECONDS', 30))  # Longest a caller waits for another's result; 0 disables
+SINGLE_FLIGHT_LOCK_DIR = os.getenv('SINGLE_FLIGHT_LOCK_DIR', '')  # Lock files shared by the processes on a host; defaults to a private directory under the system temp dir
+
+# Local search over the eBay items found for earlier uploads, tried before the Finding API
+LOCAL_SEARCH = os.getenv('LOCAL_SEARCH', 'True') == 'True'
+LOCAL_SEARCH_MIN_HITS = int(os.getenv('LOCAL_SEARCH_MIN_HITS', 10))  # Fewer matching items than this go to eBay
+LOCAL_SEARCH_MIN_SCORE = float(os.getenv('LOCAL_SEARCH_MIN_SCORE', 0.6))  # Share of the (rarity-weighted) search words an item must contain
+LOCAL_SEARCH_MAX_AGE_SECONDS = int(os.getenv('LOCAL_SEARCH_MAX_AGE_SECONDS', 6 * 60 * 60))  # Items eBay has not returned for longer are not used
+LOCAL_SEARCH_INDEX_REBUILD_SECONDS = int(os.getenv('LOCAL_SEARCH_INDEX_REBUILD_SECONDS', 60 * 60))
+
+# Cached listing fragments and JSON bodies of the results and Vision call pages, keyed by page version
+PAGE_CACHE_TTL_SECONDS = int(os.getenv('PAGE_CACHE_TTL_SECONDS', 60 * 60 * 24))
+
+# History exports stop before uploads this recent, which may still be committing or waiting for their job
+EXPORT_SETTLE_SECONDS = int(os.getenv('EXPORT_SETTLE_SECONDS', 60))
@@ -0,0 +1,257 @@
+"""Full analysis of a single image, as shown on the Image Analysis page.
+
+Runs label, web and text detection, looks up the eBay listings among the
+matching pages and checks which visually similar images are reachable.
+Used by ``process_image`` and the ``process_images`` management command;
+``iter_analysis`` yields the same results stage by stage for the streaming
+Image Analysis page. ``aanalyze_image`` and ``aiter_analysis`` are the async
+versions used by the async views.
+"""
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+
+from . import imaging, near_duplicates, timing, vision_api
+from .ebay_api import aiter_ebay_items_details, extract_ebay_item_id, iter_ebay_items_details
+from .image_probe import afilter_accessible_images, filter_accessible_images
+from .models import VisionAPICall
+from .pipeline import record_vision_call
+
+ANALYSIS_RESPONSE_KEYS = ['label_response', 'web_response', 'text_response']
+
+
+def analyze_image(product_image, image_content):
+    """Analyze ``image_content`` for ``product_image`` and return the template results.
+
+    The time spent in each stage is stored with the VisionAPICall.
+    """
+    ebay_results = []
+    for event, data in iter_analysis(product_image, image_content):
+        if event == 'summary':
+            results = data
+        elif event == 'ebay_listing':
+            ebay_results.append(data)
+        elif event == 'similar_images':
+            results['web_matches']['similar_images'] = data
+    return _collect(results, ebay_results)
+
+
+async def aanalyze_image(product_image, image_content):
+    """Async version of ``analyze_image``."""
+    ebay_results = []
+    async for event, data in aiter_analysis(product_image, image_content):
+        if event == 'summary':
+            results = data
+        elif event == 'ebay_listing':
+            ebay_results.append(data)
+        elif event == 'similar_images':
+            results['web_matches']['similar_images'] = data
+    return _collect(results, ebay_results)
+
+
+def iter_analysis(product_image, image_content):
+    """Analyze ``image_content`` for ``product_image``, yielding ``(event, data)`` as each stage completes.
+
+    * ``('summary', results)``: labels, web entities, text and pages, with
+      empty eBay listings and similar images
+    * ``('ebay_listing', (position, listing))``: one per eBay page, as its
+      detail lookup finishes; ``position`` is the page's place in Vision's results
+    * ``('similar_images', images)``: the similar images that are reachable
+
+    The time spent in each stage is stored with the VisionAPICall when the
+    generator finishes or is closed.
+    """
+    vision_call = None
+    with timing.collect() as timings:
+        try:
+            # Record start time for API call
+            start_time = time.time()
+
+            # Byte-identical uploads are served by the Vision cache. Otherwise reuse the responses of a
+            # near-duplicate if there is one, or perform all detections in a single request
+            with timing.stage('vision'):
+                responses = vision_api.cached_responses(product_image.content_hash, ANALYSIS_RESPONSE_KEYS)
+            with timing.stage('near_duplicates'):
+                reused = _find_reusable(product_image, image_content, responses)
+            if responses is not None:
+                cache_hit = True
+            elif reused:
+                responses, cache_hit = reused[0], True
+            else:
+                with timing.stage('vision'):
+                    responses, cache_hit = vision_api.detect_image(
+                        image_content, product_image.content_hash, ANALYSIS_RESPONSE_KEYS, check_cache=False
+                    )
+
+            # Calculate processing time
+            processing_time = int((time.time() - start_time) * 1000)  # Convert to milliseconds
+
+            # Store API call data
+            with timing.stage('db_write'):
+                vision_call = record_vision_call(product_image, responses, product_image.content_hash, cache_hit, processing_time)
+            with timing.stage('thumbnail'):
+                imaging.ensure_thumbnail(product_image, image_content)
+
+            yield 'summary', _summary(responses, reused)
+
+            # Extract eBay-specific results with details, looking the items up concurrently
+            web = responses['web_response'].web_detection
+            ebay_pages = _ebay_pages(web)
+            pending = dict(enumerate(ebay_pages))
+            with timing.stage('ebay_details'):
+                for item_id, details in iter_ebay_items_details([item_id for page, item_id in ebay_pages if item_id]):
+                    yield from _resolve(pending, item_id, details)
+            # Pages without an item ID, or whose lookup failed, are listed without details
+            for position, (page, item_id) in pending.items():
+                yield 'ebay_listing', (position, _listing_info(page))
+
+            with timing.stage('image_probes'):
+                similar_images = filter_accessible_images(_similar_image_urls(web))
+            yield 'similar_images', [{'url': url} for url in similar_images]
+        finally:
+            if vision_call is not None:
+                VisionAPICall.objects.filter(id=vision_call.id).update(stage_timings=timings)
+
+
+async def aiter_analysis(product_image, image_content):
+    """Async version of ``iter_analysis``.
+
+    The similar-image probes run while the eBay lookups stream in.
+    """
+    vision_call = None
+    probes = None
+    with timing.collect() as timings:
+        try:
+            start_time = time.time()
+
+            with timing.stage('vision'):
+                responses = await sync_to_async(vision_api.cached_responses)(
+                    product_image.content_hash, ANALYSIS_RESPONSE_KEYS
+                )
+            with timing.stage('near_duplicates'):
+                reused = await sync_to_async(_find_reusable)(product_image, image_content, responses)
+            if responses is not None:
+                cache_hit = True
+            elif reused:
+                responses, cache_hit = reused[0], True
+            else:
+                with timing.stage('vision'):
+                    responses, cache_hit = await vision_api.adetect_image(
+                        image_content, product_image.content_hash, ANALYSIS_RESPONSE_KEYS, check_cache=False
+                    )
+
+            processing_time = int((time.time() - start_time) * 1000)
+
+            with timing.stage('db_write'):
+                vision_call = await sync_to_async(record_vision_call)(
+                    product_image, responses, product_image.content_hash, cache_hit, processing_time
+                )
+
+            web = responses['web_response'].web_detection
+            probes = asyncio.ensure_future(_atimed('image_probes', afilter_accessible_images(_similar_image_urls(web))))
+
+            with timing.stage('thumbnail'):
+                await sync_to_async(imaging.ensure_thumbnail)(product_image, image_content)
+
+            yield 'summary', _summary(responses, reused)
+
+            ebay_pages = _ebay_pages(web)
+            pending = dict(enumerate(ebay_pages))
+            with timing.stage('ebay_details'):
+                async for item_id, details in aiter_ebay_items_details([item_id for page, item_id in ebay_pages if item_id]):
+                    for event in _resolve(pending, item_id, details):
+                        yield event
+            for position, (page, item_id) in pending.items():
+                yield 'ebay_listing', (position, _listing_info(page))
+
+            yield 'similar_images', [{'url': url} for url in await probes]
+        finally:
+            if probes is not None:
+                probes.cancel()
+            if vision_call is not None:
+                await VisionAPICall.objects.filter(id=vision_call.id).aupdate(stage_timings=timings)
+
+
+def _find_reusable(product_image, image_content, cached):
+    """Hash the image, and look for a near-duplicate to reuse only when the Vision cache missed."""
+    if cached is not None:
+        near_duplicates.assign_hash(product_image, image_content)
+        return None
+    return near_duplicates.find_reusable(product_image, image_content, ANALYSIS_RESPONSE_KEYS)
+
+
+async def _atimed(name, awaitable):
+    with timing.stage(name):
+        return await awaitable
+
+
+def _summary(responses, reused):
+    label_response = responses['label_response']
+    web_response = responses['web_response']
+    text_response = responses['text_response']
+    web = web_response.web_detection
+
+    # Collect results for template
+    return {
+        'near_duplicate': {
+            'image_id': reused[1]['product_image_id'],
+            'vision_call_id': reused[1]['vision_call'].id,
+            'distance': reused[1]['distance'],
+            'analyzed_at': reused[1]['vision_call'].request_timestamp,
+        } if reused else None,
+        'labels': [
+            {'description': label.description, 'score': f"{label.score:.2%}"}
+            for label in label_response.label_annotations
+        ],
+        'web_entities': [
+            {'description': entity.description, 'score': f"{entity.score:.2%}"}
+            for entity in web.web_entities
+        ],
+        'text': text_response.text_annotations[0].description if text_response.text_annotations else None,
+        'web_matches': {
+            'ebay_listings': [],
+            'similar_images': [],
+            'pages': [
+                {'url': page.url, 'title': page.page_title}
+                for page in web.pages_with_matching_images[:5]
+                if page.page_title
+            ] if web.pages_with_matching_images else []
+        }
+    }
+
+
+def _collect(results, ebay_results):
+    # Listings arrive as their lookups finish; show them in Vision's order
+    results['web_matches']['ebay_listings'] = [listing for position, listing in sorted(ebay_results, key=lambda r: r[0])]
+    return results
+
+
+def _ebay_pages(web):
+    return [
+        (page, extract_ebay_item_id(page.url))
+        for page in web.pages_with_matching_images
+        if 'ebay' in page.url.lower()
+    ]
+
+
+def _similar_image_urls(web):
+    return [image.url for image in web.visually_similar_images[:5]]
+
+
+def _resolve(pending, item_id, details):
+    # Several pages can point at the same item
+    for position, (page, page_item_id) in list(pending.items()):
+        if page_item_id == item_id:
+            del pending[position]
+            yield 'ebay_listing', (position, _listing_info(page, details))
+
+
+def _listing_info(page, details=None):
+    listing_info = {
+        'url': page.url,
+        'title': page.page_title if page.page_title else 'eBay Listing'
+    }
+    if details:
+        listing_info.update(details)
+    return listing_info
@@ -0,0 +1,412 @@
+"""Offline benchmark harness for the upload, analysis and history views.
+
+Google Vision and the eBay Finding/Shopping APIs are replaced by local fakes
+that answer after a configurable latency. Vision answers are either
+synthetic or replayed from responses recorded in the database
+(``manage.py benchmark --record``). Listing pictures and image probes are
+faked the same way, so a run needs no credentials and no network.
+
+Each scenario reports requests per second, p50/p95/p99 latency and the
+number of database queries per request. Queries are counted on every
+connection, including those opened by worker threads. Used by the
+``benchmark`` management command.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest import mock
+
+import numpy as np
+from django.db.backends.signals import connection_created
+from django.test import Client
+from ebaysdk.response import ResponseDataObject
+from google.cloud import vision
+from google.protobuf.json_format import ParseDict
+from PIL import Image
+
+from . import clients
+
+SCENARIOS = ('upload', 'pipeline', 'test_vision', 'history')
+
+LABEL_VOCABULARY = [
+    'Power Drill', 'Cordless Drill', 'Hammer', 'Wrench', 'Sneakers', 'Handbag', 'Watch',
+    'Camera', 'Headphones', 'Guitar', 'Lamp', 'Teapot', 'Backpack', 'Sunglasses',
+]
+
+
+class Latency:
+    """Sleeps for ``mean`` seconds, give or take ``jitter`` (a fraction of the mean)."""
+
+    def __init__(self, mean, jitter=0.2):
+        self.mean = mean
+        self.jitter = jitter
+
+    def wait(self):
+        if self.mean > 0:
+            time.sleep(self._sample())
+
+    async def async_wait(self):
+        if self.mean > 0:
+            await asyncio.sleep(self._sample())
+
+    def _sample(self):
+        return random.uniform(self.mean * (1 - self.jitter), self.mean * (1 + self.jitter))
+
+
+def make_corpus(count, size=(1024, 768), duplicate_ratio=0.0, seed=0):
+    """Return ``count`` JPEG images with distinct, photo-like content.
+
+    ``duplicate_ratio`` of them are re-encoded, resized copies of earlier
+    images, so the Vision cache and near-duplicate paths get exercised too.
+    """
+    rng = np.random.default_rng(seed)
+    originals, corpus = [], []
+    for index in range(count):
+        if originals and rng.random() < duplicate_ratio:
+            image = originals[rng.integers(len(originals))]
+            image = image.resize((int(size[0] * 0.8), int(size[1] * 0.8)), Image.LANCZOS)
+            quality = 70
+        else:
+            # Smooth colour fields look more like photos to the encoders than pure noise
+            base = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+            image = Image.fromarray(base).resize(size, Image.BICUBIC)
+            originals.append(image)
+            quality = 90
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality)
+        corpus.append(output.getvalue())
+    return corpus
+
+
+def _synthetic_response(content):
+    # Derive the answer from the image so identical images get identical answers
+    seed = int(hashlib.sha256(content).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    labels = rng.sample(LABEL_VOCABULARY, 3)
+
+    response = vision.AnnotateImageResponse()
+    for label in labels:
+        response.label_annotations.append(vision.EntityAnnotation(description=label, score=rng.uniform(0.8, 0.99)))
+    web = response.web_detection
+    web.web_entities.append(vision.WebDetection.WebEntity(description=labels[0], score=0.9))
+    for index in range(3):
+        item_id = str(100000000000 + rng.randrange(10 ** 6))
+        web.pages_with_matching_images.append(
+            vision.WebDetection.WebPage(url=f'https://www.ebay.com/itm/{item_id}', page_title=f'{labels[0]} {index}')
+        )
+    for index in range(5):
+        web.visually_similar_images.append(
+            vision.WebDetection.WebImage(url=f'https://images.benchmark.invalid/{seed}/{index}.jpg')
+        )
+    response.text_annotations.append(vision.EntityAnnotation(description=' '.join(labels), locale='en'))
+    return response
+
+
+def _recorded_response(payload):
+    # Recorded payloads hold one response per detection; merge them back together
+    response = vision.AnnotateImageResponse()
+    for part in payload.values():
+        merged = vision.AnnotateImageResponse()
+        ParseDict(part, merged._pb, ignore_unknown_fields=True)
+        response._pb.MergeFrom(merged._pb)
+    return response
+
+
+class FakeVisionClient:
+    def __init__(self, latency, recorded=None):
+        self.latency = latency
+        self.recorded = recorded or []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        # Stands in for the ImageAnnotatorClient class
+        return self
+
+    def batch_annotate_images(self, requests=None, **kwargs):
+        self.latency.wait()
+        return self.answer(requests)
+
+    def answer(self, requests):
+        with self.lock:
+            self.calls += 1
+        responses = []
+        for request in requests:
+            if self.recorded:
+                index = int(hashlib.sha256(request.image.content).hexdigest()[:8], 16) % len(self.recorded)
+                responses.append(_recorded_response(self.recorded[index]))
+            else:
+                responses.append(_synthetic_response(request.image.content))
+        return vision.BatchAnnotateImagesResponse(responses=responses)
+
+
+class FakeAsyncVisionClient:
+    """Stands in for ImageAnnotatorAsyncClient, answering like ``fake``."""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    async def batch_annotate_images(self, requests=None, **kwargs):
+        await self.fake.latency.async_wait()
+        return self.fake.answer(requests)
+
+
+def _fake_item(item_id, keywords):
+    return {
+        'itemId': item_id,
+        'title': f'{keywords} #{item_id[-4:]}',
+        'viewItemURL': f'https://www.ebay.com/itm/{item_id}',
+        'location': 'Austin, TX',
+        'sellingStatus': {'currentPrice': {'value': f'{random.uniform(5, 500):.2f}', '_currencyID': 'USD'}},
+        'condition': {'conditionDisplayName': 'Used'},
+        'sellerInfo': {'sellerUserName': 'benchmark_seller'},
+        'galleryURL': f'https://i.benchmark.invalid/{item_id}.jpg',
+    }
+
+
+class FakeEbayConnection:
+    """Answers findItemsByKeywords and GetSingleItem like the ebaysdk connections do."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        # Stands in for the Finding and Shopping connection classes
+        return self
+
+    def execute(self, verb, data):
+        self.latency.wait()
+        with self.lock:
+            self.calls += 1
+        if verb == 'findItemsByKeywords':
+            seed = int(hashlib.sha256(data['keywords'].encode()).hexdigest()[:8], 16)
+            items = [_fake_item(str(100000000000 + seed % 10 ** 6 + index), data['keywords']) for index in range(10)]
+            return ResponseDataObject({'reply': {'searchResult': {'item': items}}}, [])
+        return ResponseDataObject({'reply': {'Item': {
+            'Title': f'Item {data["ItemID"]}',
+            'CurrentPrice': {'value': '42.00', '_currencyID': 'USD'},
+            'ConditionDisplayName': 'Used',
+            'Location': 'Austin, TX',
+            'ViewItemURLForNaturalSearch': f'https://www.ebay.com/itm/{data["ItemID"]}',
+        }}}, [])
+
+    async def afetch_item(self, client, item_id):
+        # Stands in for ebay_api._afetch_item, which reads the JSON flavour of GetSingleItem
+        await self.latency.async_wait()
+        with self.lock:
+            self.calls += 1
+        return {'Ack': 'Success', 'Item': {
+            'Title': f'Item {item_id}',
+            'CurrentPrice': {'Value': 42.0, 'CurrencyID': 'USD'},
+            'ConditionDisplayName': 'Used',
+            'Location': 'Austin, TX',
+            'ViewItemURLForNaturalSearch': f'https://www.ebay.com/itm/{item_id}',
+        }}
+
+
+@contextmanager
+def fake_upstreams(vision_latency, ebay_latency, http_latency, recorded=None):
+    """Patch every outbound call with a local fake; yields the fakes for call counts."""
+    fake_vision = FakeVisionClient(vision_latency, recorded)
+    fake_ebay = FakeEbayConnection(ebay_latency)
+    picture = make_corpus(1, size=(300, 225), seed=1)[0]
+
+    def fake_probe(url):
+        http_latency.wait()
+        return True
+
+    async def fake_async_probe(client, url):
+        await http_latency.async_wait()
+        return True
+
+    def fake_download(url):
+        http_latency.wait()
+        return picture
+
+    # Clients built before or during the run must not outlive the patches
+    clients.reset()
+    with mock.patch('google.cloud.vision.ImageAnnotatorClient', fake_vision), \
+            mock.patch('google.cloud.vision.ImageAnnotatorAsyncClient', FakeAsyncVisionClient(fake_vision)), \
+            mock.patch('ebaysdk.finding.Connection', fake_ebay), \
+            mock.patch('ebaysdk.shopping.Connection', fake_ebay), \
+            mock.patch('product_matcher.ebay_api._afetch_item', fake_ebay.afetch_item), \
+            mock.patch('product_matcher.image_probe.is_image_accessible', fake_probe), \
+            mock.patch('product_matcher.image_probe.ais_image_accessible', fake_async_probe), \
+            mock.patch('product_matcher.listing_ranking._download', fake_download):
+        try:
+            yield {'vision': fake_vision, 'ebay': fake_ebay}
+        finally:
+            clients.reset()
+
+
+class QueryCounter:
+    """Counts queries on every database connection opened while it is active."""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _wrapper(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self._wrapper)
+
+    def __enter__(self):
+        connection_created.connect(self._install)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._install)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(scenario, latencies, errors, elapsed, queries):
+    latencies = sorted(latencies)
+    count = len(latencies) + errors
+    return {
+        'scenario': scenario,
+        'requests': count,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'rps': round(count / elapsed, 2) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'queries_per_request': round(queries / count, 1) if count else 0,
+    }
+
+
+def run_requests(scenario, send, payloads, concurrency):
+    """Call ``send(client, payload)`` for every payload on ``concurrency`` threads and summarize."""
+    from django.db import connections
+
+    local = threading.local()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def task(payload):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = Client()
+        start = time.perf_counter()
+        try:
+            ok = send(client, payload)
+        except Exception:
+            ok = False
+        duration = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(duration)
+            else:
+                errors[0] += 1
+
+    def close_connections(payload):
+        connections.close_all()
+
+    with QueryCounter() as queries:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency, thread_name_prefix='benchmark') as pool:
+            list(pool.map(task, payloads))
+            # Connections opened by the pool threads would otherwise outlive the test database
+            list(pool.map(close_connections, range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return summarize(scenario, latencies, errors[0], elapsed, queries.count)
+
+
+def _post_image(url):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    def send(client, payload):
+        index, content = payload
+        response = client.post(url, {'image': SimpleUploadedFile(f'bench_{index}.jpg', content, 'image/jpeg')})
+        return response.status_code < 400 and b'Error processing image' not in response.content
+    return send
+
+
+def run_upload(corpus, concurrency):
+    return run_requests('upload', _post_image('/upload/'), list(enumerate(corpus)), concurrency)
+
+
+def run_pipeline(batch_size):
+    """Process every queued job the way ``run_worker`` does; latency is per job."""
+    from django.db import connections
+
+    from .models import ProcessingJob
+    from .pipeline import claim_jobs, execute_jobs
+
+    with QueryCounter() as queries:
+        start = time.perf_counter()
+        while True:
+            jobs = claim_jobs(batch_size)
+            if not jobs:
+                break
+            execute_jobs(jobs)
+        elapsed = time.perf_counter() - start
+    connections.close_all()
+
+    finished = ProcessingJob.objects.exclude(started_at=None).exclude(finished_at=None)
+    latencies = [(job.finished_at - job.started_at).total_seconds()
+                 for job in finished.filter(status=ProcessingJob.STATUS_SUCCEEDED)]
+    errors = finished.filter(status=ProcessingJob.STATUS_FAILED).count()
+    return summarize('pipeline', latencies, errors, elapsed, queries.count)
+
+
+def run_test_vision(corpus, concurrency):
+    return run_requests('test_vision', _post_image('/test-vision/'), list(enumerate(corpus)), concurrency)
+
+
+def run_history(requests, concurrency):
+    from .history import get_history_page
+
+    # Walk the pages once to collect cursors, then request them round-robin
+    urls, cursor = ['/history/'], None
+    while True:
+        page = get_history_page(cursor=cursor)
+        if not page['has_older']:
+            break
+        cursor = page['older_cursor']
+        urls.append(f'/history/?cursor={cursor}&direction=older')
+
+    def send(client, url):
+        return client.get(url).status_code == 200
+    return run_requests('history', send, [urls[index % len(urls)] for index in range(requests)], concurrency)
+
+
+def load_recorded(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def record_responses(path, limit):
+    """Write up to ``limit`` stored Vision responses to ``path`` as JSON lines; return how many."""
+    from .models import VisionAPICall
+
+    written = 0
+    with open(path, 'w') as f:
+        for vision_call in VisionAPICall.objects.filter(error__isnull=True).defer(None).iterator():
+            if written >= limit:
+                break
+            payload = vision_call.get_api_response()
+            if payload:
+                f.write(json.dumps(payload) + '\n')
+                written += 1
+    return written
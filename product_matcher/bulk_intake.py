@@ -0,0 +1,122 @@
+"""Intake for bulk uploads: many image files and/or zip archives in one request.
+
+Each accepted image is stored as its own ProductImage with a pending
+ProcessingJob attached to a single UploadBatch. Files and archive members are
+read one at a time through ``intake.ImageStream``, the same check as single
+uploads: anything Pillow does not recognize as an image is skipped, and
+reading stops at the upload size limit whatever size the archive declares for
+a member. Memory use therefore does not grow with the size of the archive. If
+the batch is rolled back, the files already stored are deleted again.
+"""
+import os
+import zipfile
+import zlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .intake import CHUNK_SIZE, ImageStream, RejectedUpload, read_upload
+from .models import MAX_UPLOAD_MEGABYTES, ProcessingJob, ProductImage, UploadBatch
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+
+
+def _rejection_reason(name, size):
+    if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+        return 'Not an image file'
+    if size > MAX_UPLOAD_MEGABYTES * 1024 * 1024:
+        return f'Larger than {MAX_UPLOAD_MEGABYTES}MB'
+    return None
+
+
+def _read_member(zf, member):
+    """Return ``(content, content_hash)`` for an archive member, decompressing at most the upload limit."""
+    stream = ImageStream()
+    with zf.open(member) as member_file:
+        # The sizes in the archive are not trusted: a zip bomb is stopped by ImageStream
+        for chunk in iter(lambda: member_file.read(CHUNK_SIZE), b''):
+            stream.write(chunk)
+    stream.close()
+    return stream.buffer.getvalue(), stream.content_hash
+
+
+def _store_image(batch, name, content, content_hash, stored):
+    product_image = ProductImage(content_hash=content_hash)
+    product_image.image.save(name, ContentFile(content), save=False)
+    stored.append(product_image.image.name)
+    product_image.save()
+    ProcessingJob.objects.create(product_image=product_image, batch=batch)
+    return product_image
+
+
+def _archive_images(archive, skipped):
+    try:
+        zf = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile:
+        skipped.append({'name': archive.name, 'reason': 'Not a valid zip archive'})
+        return
+
+    with zf:
+        for member in zf.infolist():
+            basename = os.path.basename(member.filename)
+            if member.is_dir() or not basename or basename.startswith('.') or member.filename.startswith('__MACOSX/'):
+                continue
+            reason = _rejection_reason(basename, member.file_size)
+            if reason:
+                skipped.append({'name': member.filename, 'reason': reason})
+                continue
+            try:
+                content, content_hash = _read_member(zf, member)
+            except RejectedUpload as e:
+                skipped.append({'name': member.filename, 'reason': str(e)})
+                continue
+            except (zipfile.BadZipFile, zlib.error, RuntimeError, NotImplementedError):
+                # Corrupt, encrypted or compressed with an unsupported method
+                skipped.append({'name': member.filename, 'reason': 'Could not be extracted'})
+                continue
+            yield basename, content, content_hash
+
+
+def create_batch(image_files, archives):
+    """Store every acceptable image from ``image_files`` and ``archives`` and queue it.
+
+    Returns the UploadBatch; rejected files are listed in ``batch.skipped``.
+    """
+    skipped = []
+
+    def candidates():
+        for image_file in image_files:
+            reason = _rejection_reason(image_file.name, image_file.size)
+            if reason:
+                skipped.append({'name': image_file.name, 'reason': reason})
+                continue
+            try:
+                content, content_hash = read_upload(image_file)
+            except RejectedUpload as e:
+                skipped.append({'name': image_file.name, 'reason': str(e)})
+                continue
+            yield image_file.name, content, content_hash
+        for archive in archives:
+            yield from _archive_images(archive, skipped)
+
+    stored = []  # Names of the files written to storage so far
+    try:
+        with transaction.atomic():
+            batch = UploadBatch.objects.create()
+            for name, content, content_hash in candidates():
+                if batch.file_count >= settings.BULK_UPLOAD_MAX_FILES:
+                    skipped.append({'name': name, 'reason': f'Batch limit of {settings.BULK_UPLOAD_MAX_FILES} files reached'})
+                    continue
+                _store_image(batch, name, content, content_hash, stored)
+                batch.file_count += 1
+
+            batch.skipped = skipped
+            batch.save(update_fields=['file_count', 'skipped'])
+    except BaseException:
+        # The rows were rolled back; do not leave their files behind in storage
+        for name in stored:
+            default_storage.delete(name)
+        raise
+    return batch
@@ -0,0 +1,147 @@
+"""Process-wide registry of the clients used to reach Vision, eBay and remote images.
+
+Building a Vision client opens a gRPC channel and loads credentials, and an
+ebaysdk connection or requests session sets up its own connection pool. Each
+client is therefore created on first use and reused:
+
+* ``vision()`` and ``http_session(name)``: one per process. gRPC channels and
+  requests sessions are safe to share between threads.
+* ``finding()`` and ``shopping()``: one per thread, as ebaysdk connections are
+  not thread-safe.
+* ``vision_async()`` and ``http_async(name)``: under an ASGI server, one per
+  event loop, as asyncio clients are bound to the loop that created them.
+  Elsewhere (WSGI, management commands) every async view runs on a loop of
+  its own, so they return the per-process blocking clients instead, with
+  each call run in a worker thread.
+
+The client libraries are imported when the first client is built, not when
+this module is. A forked child (gunicorn workers forked from a ``--preload``
+master, ``process_images`` workers) starts with an empty registry, so it
+opens its own channels and sockets instead of sharing the parent's.
+"""
+import asyncio
+import os
+import threading
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+_lock = threading.Lock()
+_process_clients = {}
+_thread_clients = threading.local()
+_loop_clients = weakref.WeakKeyDictionary()
+_per_loop_enabled = False
+
+
+def serve_async():
+    """Build asyncio clients per event loop from now on; for ASGI servers, whose loop lives as long as the process."""
+    global _per_loop_enabled
+    _per_loop_enabled = True
+
+
+def reset():
+    """Forget every client, so the next use builds a new one."""
+    global _lock, _process_clients, _thread_clients, _loop_clients
+    # Replaced rather than cleared: in a forked child the old lock may be held
+    # by a thread that no longer exists
+    _lock = threading.Lock()
+    _process_clients = {}
+    _thread_clients = threading.local()
+    _loop_clients = weakref.WeakKeyDictionary()
+
+
+os.register_at_fork(after_in_child=reset)
+
+
+def _per_process(name, factory):
+    client = _process_clients.get(name)
+    if client is None:
+        with _lock:
+            client = _process_clients.get(name)
+            if client is None:
+                client = _process_clients[name] = factory()
+    return client
+
+
+def _per_thread(name, factory):
+    client = getattr(_thread_clients, name, None)
+    if client is None:
+        client = factory()
+        setattr(_thread_clients, name, client)
+    return client
+
+
+class _InThreads:
+    """Awaitable methods over a blocking client, each call made in a worker thread."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return sync_to_async(getattr(self._client, name), thread_sensitive=False)
+
+
+def _per_loop(name, factory):
+    clients = _loop_clients.setdefault(asyncio.get_running_loop(), {})
+    if name not in clients:
+        clients[name] = factory()
+    return clients[name]
+
+
+def vision():
+    from google.cloud import vision as vision_client
+
+    return _per_process('vision', vision_client.ImageAnnotatorClient)
+
+
+def vision_async():
+    from google.cloud import vision as vision_client
+
+    if not _per_loop_enabled:
+        client = vision()
+        return _per_process('vision:threads', lambda: _InThreads(client))
+    return _per_loop('vision', vision_client.ImageAnnotatorAsyncClient)
+
+
+def finding():
+    from ebaysdk.finding import Connection as Finding
+
+    return _per_thread('finding', lambda: Finding(domain='svcs.ebay.com',
+                                                  appid=os.getenv('EBAY_APP_ID'),
+                                                  config_file=None))
+
+
+def shopping():
+    from ebaysdk.shopping import Connection as Shopping
+
+    return _per_thread('shopping', lambda: Shopping(domain='open.api.ebay.com',
+                                                    appid=os.getenv('EBAY_APP_ID'),
+                                                    config_file=None,
+                                                    timeout=settings.EBAY_DETAILS_TIMEOUT_SECONDS))
+
+
+def http_session(name, pool_size):
+    """A requests session for ``name`` whose pool keeps up to ``pool_size`` connections per host."""
+    def build():
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    return _per_process(f'http_session:{name}', build)
+
+
+def http_async(name, pool_size):
+    """An httpx client for ``name`` to await on the running event loop; pass timeouts per request."""
+    import httpx
+
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    if not _per_loop_enabled:
+        client = _per_process(f'http_client:{name}', lambda: httpx.Client(limits=limits))
+        return _per_process(f'http_client:{name}:threads', lambda: _InThreads(client))
+    return _per_loop(f'http_async:{name}', lambda: httpx.AsyncClient(limits=limits))
@@ -0,0 +1,211 @@
+"""Helpers for the eBay Shopping API.
+
+Item detail lookups are fanned out over a bounded, process-wide thread pool
+and cached per item ID in the Django cache, so popular listings are not
+fetched again for every upload. An item that is already being looked up,
+in this or another process, is waited for rather than fetched again (see
+``singleflight``). ``iter_ebay_items_details`` yields each item as its lookup
+finishes, for the streaming Image Analysis page.
+
+The ``a``-prefixed functions are their async counterparts for the async
+views. They call the Shopping API's JSON endpoint with httpx, bounded by a
+semaphore instead of the thread pool, and share the same item cache.
+"""
+import asyncio
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+
+from django.conf import settings
+from django.core.cache import cache
+from ebaysdk.exception import ConnectionError as EbayConnectionError
+
+from . import clients, singleflight, upstream
+
+ITEM_CACHE_PREFIX = 'ebay_item:'
+SHOPPING_URL = 'https://open.api.ebay.com/shopping'
+SHOPPING_VERSION = '967'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EBAY_DETAILS_MAX_WORKERS,
+                thread_name_prefix='ebay-details',
+            )
+        return _executor
+
+
+def extract_ebay_item_id(url):
+    # Common eBay URL patterns
+    patterns = [
+        r'/itm/(?:[^/]+/)?(\d+)',  # Matches /itm/title/123456 or /itm/123456
+        r'item=(\d+)',             # Matches item=123456
+        r'ItemId=(\d+)',          # Matches ItemId=123456
+        r'/(\d{12})',             # Matches 12-digit item IDs in URL
+    ]
+    
+    for pattern in patterns:
+        match = re.search(pattern, url)
+        if match:
+            return match.group(1)
+    return None
+
+
+def get_ebay_item_details(item_id):
+    return singleflight.do(ITEM_CACHE_PREFIX + item_id, lambda: _get_ebay_item_details(item_id))
+
+
+def _get_ebay_item_details(item_id):
+    try:
+        api = clients.shopping()
+
+        response = upstream.call(upstream.EBAY_SHOPPING, api.execute, 'GetSingleItem', {
+            'ItemID': item_id,
+            'IncludeSelector': 'Details,ItemSpecifics'
+        })
+
+        item = response.reply.Item
+        return {
+            'title': item.Title,
+            'price': f"${float(item.CurrentPrice.value):.2f}",
+            'currency': item.CurrentPrice._currencyID,
+            'condition': item.ConditionDisplayName if hasattr(item, 'ConditionDisplayName') else 'Not specified',
+            'location': item.Location if hasattr(item, 'Location') else 'Not specified',
+            'url': item.ViewItemURLForNaturalSearch if hasattr(item, 'ViewItemURLForNaturalSearch') else None
+        }
+    except Exception as e:
+        print(f"Error fetching eBay item details: {str(e)}")
+        return None
+
+
+def get_ebay_items_details(item_ids):
+    """Fetch details for several items concurrently.
+
+    Returns a dict of item ID -> details for every lookup that succeeded
+    before ``EBAY_DETAILS_DEADLINE_SECONDS``; failed or late items are left out.
+    """
+    return dict(iter_ebay_items_details(item_ids))
+
+
+def iter_ebay_items_details(item_ids):
+    """Like ``get_ebay_items_details``, but yield ``(item_id, details)`` as each lookup finishes.
+
+    Cached items come first. Items are cached as they arrive, so a consumer
+    that stops early keeps what was fetched.
+    """
+    item_ids = list(dict.fromkeys(item_ids))
+    if not item_ids:
+        return
+
+    cached = cache.get_many([ITEM_CACHE_PREFIX + item_id for item_id in item_ids])
+    for key, value in cached.items():
+        yield key[len(ITEM_CACHE_PREFIX):], value
+
+    missing = [item_id for item_id in item_ids if ITEM_CACHE_PREFIX + item_id not in cached]
+    if not missing:
+        return
+
+    executor = _get_executor()
+    futures = {executor.submit(get_ebay_item_details, item_id): item_id for item_id in missing}
+    try:
+        for future in as_completed(futures, timeout=settings.EBAY_DETAILS_DEADLINE_SECONDS):
+            result = future.result()
+            if result:
+                cache.set(ITEM_CACHE_PREFIX + futures[future], result,
+                          timeout=settings.EBAY_DETAILS_CACHE_TTL_SECONDS)
+                yield futures[future], result
+    except TimeoutError:
+        pass
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def _afetch_item(client, item_id):
+    """Call GetSingleItem and return the decoded reply."""
+    response = await client.get(SHOPPING_URL, params={
+        'callname': 'GetSingleItem',
+        'responseencoding': 'JSON',
+        'appid': os.getenv('EBAY_APP_ID'),
+        'siteid': '0',
+        'version': SHOPPING_VERSION,
+        'ItemID': item_id,
+        'IncludeSelector': 'Details,ItemSpecifics',
+    }, timeout=settings.EBAY_DETAILS_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    reply = response.json()
+    if reply.get('Ack') == 'Failure':
+        # Raised like ebaysdk does, so upstream.is_retryable treats call limits the same way
+        errors = '; '.join(error.get('LongMessage', '') for error in reply.get('Errors', []))
+        raise EbayConnectionError(errors, response)
+    return reply
+
+
+async def aget_ebay_item_details(client, item_id):
+    return await singleflight.ado(ITEM_CACHE_PREFIX + item_id, lambda: _aget_ebay_item_details(client, item_id))
+
+
+async def _aget_ebay_item_details(client, item_id):
+    try:
+        reply = await upstream.acall(upstream.EBAY_SHOPPING, _afetch_item, client, item_id)
+
+        item = reply['Item']
+        return {
+            'title': item['Title'],
+            'price': f"${float(item['CurrentPrice']['Value']):.2f}",
+            'currency': item['CurrentPrice']['CurrencyID'],
+            'condition': item.get('ConditionDisplayName', 'Not specified'),
+            'location': item.get('Location', 'Not specified'),
+            'url': item.get('ViewItemURLForNaturalSearch')
+        }
+    except Exception as e:
+        print(f"Error fetching eBay item details: {str(e)}")
+        return None
+
+
+async def aget_ebay_items_details(item_ids):
+    """Async version of ``get_ebay_items_details``."""
+    return {item_id: details async for item_id, details in aiter_ebay_items_details(item_ids)}
+
+
+async def aiter_ebay_items_details(item_ids):
+    """Async version of ``iter_ebay_items_details``."""
+    item_ids = list(dict.fromkeys(item_ids))
+    if not item_ids:
+        return
+
+    cached = await cache.aget_many([ITEM_CACHE_PREFIX + item_id for item_id in item_ids])
+    for key, value in cached.items():
+        yield key[len(ITEM_CACHE_PREFIX):], value
+
+    missing = [item_id for item_id in item_ids if ITEM_CACHE_PREFIX + item_id not in cached]
+    if not missing:
+        return
+
+    semaphore = asyncio.Semaphore(settings.EBAY_DETAILS_MAX_WORKERS)
+
+    async def fetch(client, item_id):
+        async with semaphore:
+            return item_id, await aget_ebay_item_details(client, item_id)
+
+    client = clients.http_async('ebay_shopping', settings.EBAY_DETAILS_MAX_WORKERS)
+    tasks = [asyncio.ensure_future(fetch(client, item_id)) for item_id in missing]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=settings.EBAY_DETAILS_DEADLINE_SECONDS):
+            item_id, result = await next_done
+            if result:
+                await cache.aset(ITEM_CACHE_PREFIX + item_id, result,
+                                 timeout=settings.EBAY_DETAILS_CACHE_TTL_SECONDS)
+                yield item_id, result
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,261 @@
+"""Streaming export of the upload history as CSV or NDJSON.
+
+Each uploaded image is exported with the labels and text of its latest
+Vision call and the eBay listings found for it: one CSV row per listing (one
+row with empty listing columns for an image without any), or one JSON object
+per image. Images are read in keyset batches of ``BATCH_SIZE`` ordered by id
+and their listings with ``.iterator()``, and the output is produced in
+chunks of about ``CHUNK_BYTES``, so memory stays flat however many rows are
+exported.
+
+An export covers the images up to its *cursor*: the newest image uploaded
+more than ``EXPORT_SETTLE_SECONDS`` ago that is not behind an image still
+being processed. Passing the cursor back as ``after`` exports what was added
+since; a named checkpoint does the same on the server, and is only moved
+forward once an export under that name has run to the end. A checkpoint
+belongs to one format and pair of date bounds: the same name with other
+filters starts from the beginning.
+"""
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import EbayListing, ExportCheckpoint, ProcessingJob, ProductImage, VisionAPICall
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+BATCH_SIZE = 1000  # Images per query
+CHUNK_BYTES = 64 * 1024
+
+IMAGE_COLUMNS = ('image_id', 'uploaded_at', 'image_url', 'vision_call_id', 'analyzed_at', 'labels', 'text')
+LISTING_COLUMNS = (
+    'rank', 'item_id', 'title', 'price', 'current_price', 'url', 'condition', 'location', 'seller',
+    'similarity_score', 'matched_at'
+)
+
+
+def parse_bound(value, end=False):
+    """Parse an ISO date or date-time; an ``end`` date stands for the start of the next day."""
+    # Dates first: parse_datetime also accepts a bare date, as midnight
+    day = parse_date(value)
+    if day is not None:
+        parsed = datetime.combine(day + timedelta(days=1) if end else day, datetime.min.time())
+    else:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(f'{value!r} is not an ISO date or date-time')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _settled_cursor(start):
+    """Return the id of the last image after ``start`` whose results will not change any more."""
+    images = ProductImage.objects.filter(
+        id__gt=start,
+        # Recent uploads may still be committing, or not have their job yet
+        uploaded_at__lte=timezone.now() - timedelta(seconds=settings.EXPORT_SETTLE_SECONDS)
+    )
+    unfinished = ProcessingJob.objects.filter(
+        product_image_id__gt=start,
+        status__in=[ProcessingJob.STATUS_PENDING, ProcessingJob.STATUS_RUNNING]
+    ).aggregate(first=Min('product_image_id'))['first']
+    if unfinished is not None:
+        images = images.filter(id__lt=unfinished)
+    return images.aggregate(last=Max('id'))['last'] or start
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class HistoryExport:
+    """One export run; ``ValueError`` is raised for invalid filters."""
+
+    def __init__(self, format='csv', since=None, until=None, after=None, checkpoint=None):
+        if format not in FORMATS:
+            raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+        if after is not None and checkpoint:
+            raise ValueError('after and checkpoint cannot be combined')
+        self.format = format
+        self.checkpoint = checkpoint
+
+        bounds = {}
+        if since:
+            bounds['uploaded_at__gte'] = parse_bound(since)
+        if until:
+            # A date covers the whole day, a date-time is taken as is
+            bounds['uploaded_at__lt' if parse_date(until) is not None else 'uploaded_at__lte'] = parse_bound(until, end=True)
+        images = ProductImage.objects.filter(**bounds)
+
+        if checkpoint:
+            # Exports under one name with other bounds have their own checkpoint, so neither skips the other's images
+            self.checkpoint_filters = ' '.join(
+                [format] + [f'{lookup}={value.isoformat()}' for lookup, value in sorted(bounds.items())]
+            )
+            self.start = ExportCheckpoint.objects.get_or_create(
+                name=checkpoint, filters=self.checkpoint_filters
+            )[0].last_image_id
+        else:
+            try:
+                self.start = int(after or 0)
+            except ValueError:
+                raise ValueError('after must be an image id')
+        self.cursor = _settled_cursor(self.start)
+        self.images = images.filter(id__gt=self.start, id__lte=self.cursor).order_by('id')
+
+    @property
+    def content_type(self):
+        return FORMATS[self.format]
+
+    @property
+    def filename(self):
+        return f'history-{self.start + 1}-{self.cursor}.{self.format}'
+
+    def _batches(self):
+        last_id = self.start
+        while True:
+            batch = list(self.images.filter(id__gt=last_id).values('id', 'uploaded_at', 'image')[:BATCH_SIZE])
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1]['id']
+
+    def _records(self):
+        """Yield ``(image, vision_call, listings)`` for every exported image, in id order."""
+        for batch in self._batches():
+            ids = [image['id'] for image in batch]
+            vision_calls = {}
+            # Later calls overwrite earlier ones, leaving the latest per image
+            for call in (
+                VisionAPICall.objects
+                .filter(product_image_id__in=ids)
+                .order_by('product_image_id', 'request_timestamp', 'id')
+                .values('product_image_id', 'id', 'request_timestamp', 'labels', 'text')
+            ):
+                vision_calls[call['product_image_id']] = call
+
+            listing_rows = (
+                EbayListing.objects
+                .filter(product_image_id__in=ids)
+                .order_by('product_image_id', 'rank', 'id')
+                .values(
+                    'product_image_id', 'rank', 'item_id', 'item__title', 'price', 'item__price', 'item__url',
+                    'item__condition', 'item__location', 'item__seller', 'similarity_score', 'created_at'
+                )
+                .iterator(chunk_size=2000)
+            )
+            groups = groupby(listing_rows, key=itemgetter('product_image_id'))
+            group = next(groups, None)
+            for image in batch:
+                listings = []
+                if group is not None and group[0] == image['id']:
+                    listings = list(group[1])
+                    group = next(groups, None)
+                yield image, vision_calls.get(image['id']), listings
+
+    def _image_fields(self, image, vision_call):
+        text = vision_call and vision_call['text']
+        return {
+            'image_id': image['id'],
+            'uploaded_at': _isoformat(image['uploaded_at']),
+            'image_url': default_storage.url(image['image']) if image['image'] else None,
+            'vision_call_id': vision_call['id'] if vision_call else None,
+            'analyzed_at': _isoformat(vision_call['request_timestamp']) if vision_call else None,
+            'labels': (vision_call['labels'] or []) if vision_call else [],
+            # The first annotation holds all the text found in the image
+            'text': text[0].get('description', '') if text else '',
+        }
+
+    def _listing_fields(self, listing):
+        return {
+            'rank': listing['rank'],
+            'item_id': listing['item_id'],
+            'title': listing['item__title'],
+            'price': listing['price'],
+            'current_price': listing['item__price'],
+            'url': listing['item__url'],
+            'condition': listing['item__condition'],
+            'location': listing['item__location'],
+            'seller': listing['item__seller'],
+            'similarity_score': listing['similarity_score'],
+            'matched_at': _isoformat(listing['created_at']),
+        }
+
+    def _csv_chunks(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(IMAGE_COLUMNS + LISTING_COLUMNS)
+        for image, vision_call, listings in self._records():
+            fields = self._image_fields(image, vision_call)
+            fields['labels'] = '; '.join(label.get('description', '') for label in fields['labels'])
+            image_row = [fields[column] for column in IMAGE_COLUMNS]
+            if not listings:
+                writer.writerow(image_row + [None] * len(LISTING_COLUMNS))
+            for listing in listings:
+                listing_fields = self._listing_fields(listing)
+                writer.writerow(image_row + [listing_fields[column] for column in LISTING_COLUMNS])
+            if buffer.tell() >= CHUNK_BYTES:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def _ndjson_chunks(self):
+        lines, size = [], 0
+        for image, vision_call, listings in self._records():
+            fields = self._image_fields(image, vision_call)
+            line = json.dumps({
+                'image_id': fields['image_id'],
+                'uploaded_at': fields['uploaded_at'],
+                'image_url': fields['image_url'],
+                'vision_call': {
+                    'id': fields['vision_call_id'],
+                    'analyzed_at': fields['analyzed_at'],
+                    'labels': fields['labels'],
+                    'text': fields['text'],
+                } if vision_call else None,
+                'listings': [self._listing_fields(listing) for listing in listings],
+            }, cls=DjangoJSONEncoder) + '\n'
+            lines.append(line)
+            size += len(line)
+            if size >= CHUNK_BYTES:
+                yield ''.join(lines)
+                lines, size = [], 0
+        if lines:
+            yield ''.join(lines)
+
+    def chunks(self):
+        """Yield the export as text chunks, then move the checkpoint forward."""
+        yield from self._csv_chunks() if self.format == 'csv' else self._ndjson_chunks()
+        if self.checkpoint and self.cursor > self.start:
+            # Never move a checkpoint back, should two exports under one name overlap
+            ExportCheckpoint.objects.filter(
+                name=self.checkpoint, filters=self.checkpoint_filters, last_image_id__lt=self.cursor
+            ).update(
+                last_image_id=self.cursor, updated_at=timezone.now()
+            )
+
+    async def achunks(self):
+        """Async version of ``chunks``, for streaming responses under ASGI."""
+        chunks = self.chunks()
+        # Every batch is read in the thread that owns this request's database connection
+        next_chunk = sync_to_async(next, thread_sensitive=True)
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
@@ -0,0 +1,114 @@
+"""Data access for the upload history page.
+
+Pages are fetched with keyset pagination on ``(uploaded_at, id)`` instead of
+OFFSET, and everything the page shows comes from a constant number of
+queries: one for the images (with their listing count as a correlated
+subquery) plus one prefetch each for the latest Vision call and the most
+recent listings.
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
+
+from .models import EbayListing, ProductImage, VisionAPICall
+
+PAGE_SIZE = 10
+LISTINGS_PER_IMAGE = 5
+
+
+def encode_cursor(image):
+    raw = f'{image.uploaded_at.isoformat()},{image.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return ``(uploaded_at, id)`` for a cursor token, or None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        uploaded_at, image_id = raw.rsplit(',', 1)
+        return datetime.fromisoformat(uploaded_at), int(image_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def _first_per_image(queryset, order_by, limit):
+    # Keep only the first `limit` rows per image according to `order_by`
+    return queryset.annotate(
+        row_number=Window(RowNumber(), partition_by=F('product_image_id'), order_by=order_by)
+    ).filter(row_number__lte=limit)
+
+
+def get_history_page(cursor=None, direction='older', page_size=PAGE_SIZE):
+    """Return a page of uploads, newest first.
+
+    ``cursor`` is a token from a previous page; ``direction`` says whether to
+    fetch the page of ``older`` or ``newer`` uploads next to it.
+    """
+    listing_count = (
+        EbayListing.objects
+        .filter(product_image=OuterRef('pk'))
+        .order_by()
+        .values('product_image')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    images = ProductImage.objects.annotate(total_listings=Coalesce(Subquery(listing_count), 0))
+
+    position = decode_cursor(cursor) if cursor else None
+    newer = position is not None and direction == 'newer'
+    if position is None:
+        images = images.order_by('-uploaded_at', '-id')
+    elif newer:
+        uploaded_at, image_id = position
+        images = images.filter(
+            Q(uploaded_at__gt=uploaded_at) | Q(uploaded_at=uploaded_at, id__gt=image_id)
+        ).order_by('uploaded_at', 'id')
+    else:
+        uploaded_at, image_id = position
+        images = images.filter(
+            Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=image_id)
+        ).order_by('-uploaded_at', '-id')
+
+    images = images.prefetch_related(
+        Prefetch(
+            'vision_api_calls',
+            queryset=_first_per_image(
+                VisionAPICall.objects.only('id', 'product_image', 'request_timestamp', 'labels'),
+                F('request_timestamp').desc(),
+                1
+            ),
+            to_attr='latest_vision_calls'
+        ),
+        Prefetch(
+            'ebay_listings',
+            queryset=_first_per_image(
+                EbayListing.objects.select_related('item'),
+                [F('created_at').desc(), F('rank').asc()],
+                LISTINGS_PER_IMAGE
+            ),
+            to_attr='recent_listings'
+        ),
+    )
+
+    # Fetch one extra row to learn whether there is another page in this direction
+    page = list(images[:page_size + 1])
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    if newer:
+        page.reverse()
+
+    return {
+        'items': [{
+            'image': image,
+            'vision_call': image.latest_vision_calls[0] if image.latest_vision_calls else None,
+            'ebay_listings': image.recent_listings,
+            'total_listings': image.total_listings,
+        } for image in page],
+        'has_newer': has_more if newer else position is not None,
+        'has_older': True if newer else has_more,
+        'newer_cursor': encode_cursor(page[0]) if page else None,
+        'older_cursor': encode_cursor(page[-1]) if page else None,
+    }
@@ -0,0 +1,133 @@
+"""Accessibility checks for remote images (e.g. Vision's visually similar images).
+
+HEAD probes run concurrently over a pooled keep-alive session, bounded by an
+overall deadline. Outcomes are cached per URL in the Django cache: reachable
+images for ``IMAGE_PROBE_CACHE_TTL_SECONDS``, unreachable ones for the shorter
+``IMAGE_PROBE_NEGATIVE_CACHE_TTL_SECONDS``.
+
+``afilter_accessible_images`` runs the same probes with httpx for the async
+views.
+"""
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import clients
+
+PROBE_CACHE_PREFIX = 'image_probe:'
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_PROBE_MAX_WORKERS,
+                thread_name_prefix='image-probe',
+            )
+        return _executor
+
+
+def _cache_key(url):
+    return PROBE_CACHE_PREFIX + hashlib.sha1(url.encode()).hexdigest()
+
+
+def is_image_accessible(url):
+    try:
+        # Set a short timeout to avoid long waits
+        response = clients.http_session('image_probe', settings.IMAGE_PROBE_MAX_WORKERS).head(
+            url, timeout=settings.IMAGE_PROBE_TIMEOUT_SECONDS
+        )
+        # Check if the response is successful and the content type is an image
+        return (response.status_code == 200 and
+                response.headers.get('content-type', '').startswith('image/'))
+    except Exception:
+        return False
+
+
+def filter_accessible_images(urls):
+    """Return the URLs that point at reachable images, keeping their order.
+
+    URLs whose probe has not finished by ``IMAGE_PROBE_DEADLINE_SECONDS`` are
+    left out and not cached.
+    """
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return []
+
+    keys = {url: _cache_key(url) for url in urls}
+    cached = cache.get_many(keys.values())
+    accessible = {url: cached[key] for url, key in keys.items() if key in cached}
+
+    missing = [url for url in urls if url not in accessible]
+    if missing:
+        executor = _get_executor()
+        futures = {executor.submit(is_image_accessible, url): url for url in missing}
+        done, not_done = wait(futures, timeout=settings.IMAGE_PROBE_DEADLINE_SECONDS)
+        for future in not_done:
+            future.cancel()
+
+        positive, negative = {}, {}
+        for future in done:
+            url = futures[future]
+            accessible[url] = future.result()
+            (positive if accessible[url] else negative)[keys[url]] = accessible[url]
+        if positive:
+            cache.set_many(positive, timeout=settings.IMAGE_PROBE_CACHE_TTL_SECONDS)
+        if negative:
+            cache.set_many(negative, timeout=settings.IMAGE_PROBE_NEGATIVE_CACHE_TTL_SECONDS)
+
+    return [url for url in urls if accessible.get(url)]
+
+
+async def ais_image_accessible(client, url):
+    try:
+        response = await client.head(url, timeout=settings.IMAGE_PROBE_TIMEOUT_SECONDS)
+        return (response.status_code == 200 and
+                response.headers.get('content-type', '').startswith('image/'))
+    except Exception:
+        return False
+
+
+async def afilter_accessible_images(urls):
+    """Async version of ``filter_accessible_images``."""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return []
+
+    keys = {url: _cache_key(url) for url in urls}
+    cached = await cache.aget_many(keys.values())
+    accessible = {url: cached[key] for url, key in keys.items() if key in cached}
+
+    missing = [url for url in urls if url not in accessible]
+    if missing:
+        semaphore = asyncio.Semaphore(settings.IMAGE_PROBE_MAX_WORKERS)
+
+        async def probe(client, url):
+            async with semaphore:
+                return await ais_image_accessible(client, url)
+
+        client = clients.http_async('image_probe', settings.IMAGE_PROBE_MAX_WORKERS)
+        tasks = {asyncio.ensure_future(probe(client, url)): url for url in missing}
+        done, not_done = await asyncio.wait(tasks, timeout=settings.IMAGE_PROBE_DEADLINE_SECONDS)
+        for task in not_done:
+            task.cancel()
+
+        positive, negative = {}, {}
+        for task in done:
+            url = tasks[task]
+            accessible[url] = task.result()
+            (positive if accessible[url] else negative)[keys[url]] = accessible[url]
+        if positive:
+            await cache.aset_many(positive, timeout=settings.IMAGE_PROBE_CACHE_TTL_SECONDS)
+        if negative:
+            await cache.aset_many(negative, timeout=settings.IMAGE_PROBE_NEGATIVE_CACHE_TTL_SECONDS)
+
+    return [url for url in urls if accessible.get(url)]
@@ -0,0 +1,68 @@
+"""Image normalization and thumbnails.
+
+Before an image is sent to Vision it is rotated according to its EXIF
+orientation, downscaled to ``VISION_IMAGE_MAX_EDGE`` and re-encoded as a
+JPEG without metadata. Listing pages show a small cached thumbnail instead
+of the original upload.
+"""
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+
+def _open(content, max_edge):
+    image = Image.open(io.BytesIO(content))
+    # Let the JPEG decoder skip detail we are about to throw away
+    image.draft('RGB', (max_edge, max_edge))
+    return ImageOps.exif_transpose(image)
+
+
+def _to_rgb(image):
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        # Flatten transparency onto white rather than JPEG's default black
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _resize_jpeg(content, max_edge, quality):
+    image = _open(content, max_edge)
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    output = io.BytesIO()
+    # No exif/icc arguments, so metadata is dropped
+    _to_rgb(image).save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def normalize_for_vision(content):
+    """Return the bytes to send to Vision for ``content``.
+
+    Falls back to the original bytes if Pillow cannot decode them.
+    """
+    try:
+        return _resize_jpeg(content, settings.VISION_IMAGE_MAX_EDGE, settings.VISION_IMAGE_JPEG_QUALITY)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return content
+
+
+def ensure_thumbnail(product_image, content=None):
+    """Create the thumbnail for ``product_image`` if it does not have one yet; return whether it has one."""
+    if product_image.thumbnail:
+        return True
+    try:
+        if content is None:
+            with product_image.image.open('rb') as f:
+                content = f.read()
+        data = _resize_jpeg(content, settings.THUMBNAIL_MAX_EDGE, settings.THUMBNAIL_JPEG_QUALITY)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error creating thumbnail for image {product_image.id}: {str(e)}")
+        return False
+
+    product_image.thumbnail.save(f'{product_image.id}.jpg', ContentFile(data), save=False)
+    type(product_image).objects.filter(id=product_image.id).update(thumbnail=product_image.thumbnail.name)
+    return True
@@ -0,0 +1,154 @@
+"""Streaming intake for single-image uploads.
+
+``HashingUploadHandler`` replaces Django's default upload handlers for the
+upload and Image Analysis views. As chunks arrive from the client it
+
+* hashes them for the Vision cache,
+* checks the upload starts like an image Pillow can identify, and
+* stops at ``MAX_UPLOAD_MEGABYTES`` instead of spooling an oversized body.
+
+The image is kept in one in-memory buffer, bounded by the upload limit. That
+buffer is written to storage and handed to the Vision stage, so the upload is
+never read back from a temporary file or from ``MEDIA_ROOT``. Clipboard images
+sent as base64 text are decoded in chunks the same way.
+"""
+import base64
+import binascii
+import hashlib
+import io
+
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from PIL import Image, UnidentifiedImageError
+
+from .models import MAX_UPLOAD_MEGABYTES
+
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MEGABYTES * 1024 * 1024
+# EXIF and ICC segments can push the image size past the first chunk; a header longer than this is rejected
+MAX_HEADER_BYTES = 1024 * 1024
+
+
+class RejectedUpload(ValueError):
+    pass
+
+
+class ImageStream:
+    """Accumulates an image chunk by chunk, hashing and validating it on the way."""
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.buffer = io.BytesIO()
+        self.identified = False
+        # Size at which to try identifying the image next
+        self.identify_at = 0
+
+    def _identify(self, complete):
+        size = self.buffer.tell()
+        try:
+            # Only the header is parsed, straight from the buffer
+            self.buffer.seek(0)
+            Image.open(self.buffer)
+            self.identified = True
+        except (UnidentifiedImageError, OSError):
+            # The header may just not have arrived yet; try again once the buffer has doubled
+            if complete or size >= MAX_HEADER_BYTES:
+                raise RejectedUpload("The uploaded file is not a supported image")
+            self.identify_at = min(size * 2, MAX_HEADER_BYTES)
+        finally:
+            self.buffer.seek(size)
+
+    def write(self, chunk):
+        if self.buffer.tell() + len(chunk) > MAX_UPLOAD_BYTES:
+            raise RejectedUpload(f"The maximum file size that can be uploaded is {MAX_UPLOAD_MEGABYTES}MB")
+        self.hasher.update(chunk)
+        self.buffer.write(chunk)
+        if not self.identified and self.buffer.tell() >= self.identify_at:
+            self._identify(complete=False)
+
+    def close(self):
+        """Check the whole upload once it has arrived, if its header was not recognized before."""
+        if not self.identified:
+            self._identify(complete=True)
+
+    @property
+    def content_hash(self):
+        return self.hasher.hexdigest()
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Keep uploaded images in memory, hashing and validating them as they stream in.
+
+    A rejected file is skipped and the reason is left in ``request.upload_error``.
+    """
+    chunk_size = CHUNK_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.stream = ImageStream()
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.stream.write(raw_data)
+        except RejectedUpload as e:
+            self.request.upload_error = str(e)
+            raise SkipFile()
+        return None
+
+    def file_complete(self, file_size):
+        if not file_size:
+            return None
+        try:
+            self.stream.close()
+        except RejectedUpload as e:
+            self.request.upload_error = str(e)
+            return None
+        self.stream.buffer.seek(0)
+        uploaded = InMemoryUploadedFile(
+            file=self.stream.buffer,
+            field_name=self.field_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra
+        )
+        uploaded.content_hash = self.stream.content_hash
+        return uploaded
+
+
+def read_upload(uploaded_file):
+    """Return ``(content, content_hash)`` for an uploaded file.
+
+    Files received by HashingUploadHandler are already hashed and in memory;
+    anything else is read and hashed in chunks.
+    """
+    content_hash = getattr(uploaded_file, 'content_hash', None)
+    if content_hash is not None:
+        return uploaded_file.file.getvalue(), content_hash
+
+    stream = ImageStream()
+    for chunk in uploaded_file.chunks(CHUNK_SIZE):
+        stream.write(chunk)
+    stream.close()
+    uploaded_file.seek(0)
+    return stream.buffer.getvalue(), stream.content_hash
+
+
+def decode_base64_image(data):
+    """Decode a base64 image (bare, or as a ``data:`` URL) in chunks; return ``(content, content_hash)``."""
+    start = data.find(',') + 1 if data.startswith('data:') else 0
+    # Pasted data is often wrapped into lines; whitespace would shift the slices below
+    data = ''.join(data[start:].split())
+    # Slices of a multiple of 4 characters decode independently
+    step = CHUNK_SIZE // 3 * 4
+    stream = ImageStream()
+    try:
+        for offset in range(0, len(data), step):
+            stream.write(base64.b64decode(data[offset:offset + step], validate=True))
+    except binascii.Error:
+        raise RejectedUpload("The pasted image data is not valid base64")
+    if not stream.buffer.tell():
+        raise RejectedUpload("The pasted image is empty")
+    stream.close()
+    return stream.buffer.getvalue(), stream.content_hash
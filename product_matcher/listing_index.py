@@ -0,0 +1,196 @@
+"""Local full-text index over the eBay items found for earlier uploads.
+
+Every stored EbayItem is indexed by the words of its title and, with less
+weight, by the Vision labels of the images it was matched to. The inverted
+index lives in each process, like the near-duplicate index: it picks up
+items refreshed since the last lookup and listings created since then, and
+is rebuilt from the database every ``LOCAL_SEARCH_INDEX_REBUILD_SECONDS``.
+Items and listings are read in batches of ``BATCH_SIZE`` by key, and the
+labels of each batch of listings are fetched with it.
+
+``search`` answers a keyword search from the index. The eBay stage only
+calls the Finding API when fewer than ``LOCAL_SEARCH_MIN_HITS`` items match
+well enough and were returned by eBay within
+``LOCAL_SEARCH_MAX_AGE_SECONDS``.
+"""
+import math
+import re
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from ebaysdk.response import ResponseDataObject
+
+from .models import EbayItem, EbayListing, VisionAPICall
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+STOP_WORDS = {'a', 'an', 'and', 'for', 'in', 'of', 'on', 'or', 'the', 'to', 'with'}
+# A word that only appears in an item's labels counts for less than one in its title
+LABEL_WEIGHT = 0.5
+# Rows read per query, so a rebuild never holds every item, link or image id at once
+BATCH_SIZE = 2000
+
+
+def tokenize(text):
+    return {token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOP_WORDS}
+
+
+class ListingIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+        self.built_at = 0
+
+    def _reset(self):
+        self.postings = {}      # token -> {item_id: weight}
+        self.title_tokens = {}  # item_id -> tokens of its title
+        self.label_tokens = {}  # item_id -> tokens of the labels of its images
+        self.updated_at = {}    # item_id -> when eBay last returned it
+        self.items_seen_at = None
+        self.last_listing_id = 0
+
+    def _weights(self, item_id):
+        weights = {token: LABEL_WEIGHT for token in self.label_tokens.get(item_id, ())}
+        weights.update((token, 1.0) for token in self.title_tokens.get(item_id, ()))
+        return weights
+
+    def _reindex(self, item_id, old_weights):
+        new_weights = self._weights(item_id)
+        for token in old_weights.keys() - new_weights.keys():
+            postings = self.postings[token]
+            del postings[item_id]
+            if not postings:
+                del self.postings[token]
+        for token, weight in new_weights.items():
+            self.postings.setdefault(token, {})[item_id] = weight
+
+    def _load_items(self, queryset):
+        rows = queryset.order_by('item_id').values_list('item_id', 'title', 'updated_at')
+        while True:
+            batch = list(rows[:BATCH_SIZE])
+            for item_id, title, updated_at in batch:
+                self._add_item(item_id, title, updated_at)
+            if len(batch) < BATCH_SIZE:
+                return
+            # Each batch is a short query starting after the last item read
+            rows = rows.filter(item_id__gt=batch[-1][0])
+
+    def _add_item(self, item_id, title, updated_at):
+        old_weights = self._weights(item_id)
+        self.title_tokens[item_id] = tokenize(title)
+        self.updated_at[item_id] = updated_at
+        self._reindex(item_id, old_weights)
+        if self.items_seen_at is None or updated_at > self.items_seen_at:
+            self.items_seen_at = updated_at
+
+    def _load_labels(self):
+        """Add the labels of the listings created since the last call, in batches keyed by listing id."""
+        while True:
+            links = list(
+                EbayListing.objects
+                .filter(id__gt=self.last_listing_id)
+                .order_by('id')
+                .values_list('id', 'item_id', 'product_image_id')[:BATCH_SIZE]
+            )
+            if links:
+                self._add_labels(links)
+                self.last_listing_id = links[-1][0]
+            if len(links) < BATCH_SIZE:
+                return
+
+    def _add_labels(self, links):
+        image_labels = {}
+        calls = VisionAPICall.objects.filter(
+            product_image_id__in={image_id for listing_id, item_id, image_id in links}
+        ).order_by().values_list('product_image_id', 'labels')
+        for image_id, labels in calls:
+            image_labels.setdefault(image_id, set()).update(
+                token for label in labels or [] for token in tokenize(label.get('description', ''))
+            )
+        for listing_id, item_id, image_id in links:
+            tokens = image_labels.get(image_id)
+            if tokens and not tokens <= self.label_tokens.get(item_id, set()):
+                old_weights = self._weights(item_id)
+                self.label_tokens.setdefault(item_id, set()).update(tokens)
+                self._reindex(item_id, old_weights)
+
+    def sync(self):
+        with self.lock:
+            if time.monotonic() - self.built_at > settings.LOCAL_SEARCH_INDEX_REBUILD_SECONDS:
+                self._reset()
+                self._load_items(EbayItem.objects.all())
+                self._load_labels()
+                self.built_at = time.monotonic()
+                return
+            items = EbayItem.objects.all()
+            if self.items_seen_at is not None:
+                # Items saved in the same batch share a timestamp, so the last one is read again
+                items = items.filter(updated_at__gte=self.items_seen_at)
+            self._load_items(items)
+            self._load_labels()
+
+    def search(self, query, fresh_since=None):
+        """Return ``(score, item_id)`` for items matching at least ``LOCAL_SEARCH_MIN_SCORE`` of ``query``, best first.
+
+        The score is the share of the query's words, weighted by how rare
+        they are, found in the item. Items last returned by eBay before
+        ``fresh_since`` are left out.
+        """
+        tokens = tokenize(query)
+        self.sync()
+        with self.lock:
+            total = len(self.updated_at)
+            weights = {
+                token: math.log(1 + total / len(self.postings[token]))
+                for token in tokens if token in self.postings
+            }
+            if not weights:
+                return []
+            # Words no item contains count as the rarest possible
+            norm = sum(weights.values()) + math.log(1 + total) * len(tokens - weights.keys())
+            scores = {}
+            for token, idf in weights.items():
+                for item_id, weight in self.postings[token].items():
+                    scores[item_id] = scores.get(item_id, 0) + idf * weight
+            return sorted(
+                (
+                    (score / norm, item_id) for item_id, score in scores.items()
+                    if score / norm >= settings.LOCAL_SEARCH_MIN_SCORE
+                    and (fresh_since is None or self.updated_at[item_id] >= fresh_since)
+                ),
+                key=lambda match: (-match[0], match[1])
+            )
+
+
+index = ListingIndex()
+
+
+def as_search_item(item):
+    """Shape a stored EbayItem like an item of a ``findItemsByKeywords`` reply."""
+    fields = {
+        'itemId': item.item_id,
+        'title': item.title,
+        'viewItemURL': item.url,
+        'location': item.location,
+        'sellingStatus': {'currentPrice': {'value': str(item.price)}},
+        'condition': {'conditionDisplayName': item.condition},
+        'sellerInfo': {'sellerUserName': item.seller},
+    }
+    if item.picture_url:
+        fields['pictureURLSuperSize'] = item.picture_url
+    return ResponseDataObject(fields, [])
+
+
+def search(query, limit):
+    """Return up to ``limit`` stored items for ``query``, or None when eBay should be searched instead."""
+    if not settings.LOCAL_SEARCH or not query.strip():
+        return None
+    fresh_since = timezone.now() - timedelta(seconds=settings.LOCAL_SEARCH_MAX_AGE_SECONDS)
+    matches = index.search(query, fresh_since)
+    if len(matches) < settings.LOCAL_SEARCH_MIN_HITS:
+        return None
+    item_ids = [item_id for score, item_id in matches[:limit]]
+    items = EbayItem.objects.in_bulk(item_ids, field_name='item_id')
+    return [as_search_item(items[item_id]) for item_id in item_ids if item_id in items]
@@ -0,0 +1,151 @@
+"""Visual re-ranking of eBay search results against the uploaded photo.
+
+Each listing's picture is downloaded concurrently and reduced to a small
+feature vector: an HSV colour histogram plus a coarse grid of gradient
+orientation histograms. Vectors are cached per eBay item ID, so an item that
+shows up in many searches is only downloaded once per
+``LISTING_FEATURES_CACHE_TTL_SECONDS``. All candidates of a search are scored
+against the uploaded image with a single matrix product.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import clients
+
+FEATURES_CACHE_PREFIX = 'listing_features:'
+SAMPLE_SIZE = 128
+HUE_BINS, SATURATION_BINS = 16, 8
+GRID_CELLS, ORIENTATION_BINS = 2, 9
+# Listing pictures larger than this are not worth downloading for a histogram
+MAX_PICTURE_BYTES = 5 * 1024 * 1024
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.LISTING_IMAGE_MAX_WORKERS,
+                thread_name_prefix='listing-image',
+            )
+        return _executor
+
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def extract_features(content):
+    """Return the feature vector of an encoded image, or None if it cannot be decoded."""
+    image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    image = cv2.resize(image, (SAMPLE_SIZE, SAMPLE_SIZE), interpolation=cv2.INTER_AREA)
+
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    colour = cv2.calcHist([hsv], [0, 1], None, [HUE_BINS, SATURATION_BINS], [0, 180, 0, 256]).flatten()
+    # Square-rooted histograms make the dot product a Bhattacharyya coefficient
+    colour = _unit(np.sqrt(colour / max(colour.sum(), 1)))
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    magnitude, angle = cv2.cartToPolar(
+        cv2.Sobel(gray, cv2.CV_32F, 1, 0), cv2.Sobel(gray, cv2.CV_32F, 0, 1), angleInDegrees=True
+    )
+    bins = (np.mod(angle, 180) / (180 / ORIENTATION_BINS)).astype(np.intp).clip(0, ORIENTATION_BINS - 1)
+    cell = SAMPLE_SIZE // GRID_CELLS
+    shape = np.concatenate([
+        np.bincount(
+            bins[y:y + cell, x:x + cell].ravel(),
+            weights=magnitude[y:y + cell, x:x + cell].ravel(),
+            minlength=ORIENTATION_BINS
+        )
+        for y in range(0, SAMPLE_SIZE, cell)
+        for x in range(0, SAMPLE_SIZE, cell)
+    ])
+
+    # Colour and shape count equally towards the score
+    return np.concatenate([colour, _unit(shape)]).astype(np.float32) / np.sqrt(2)
+
+
+def _download(url):
+    response = clients.http_session('listing_image', settings.LISTING_IMAGE_MAX_WORKERS).get(
+        url, timeout=settings.LISTING_IMAGE_TIMEOUT_SECONDS, stream=True
+    )
+    response.raise_for_status()
+    content = response.raw.read(MAX_PICTURE_BYTES + 1, decode_content=True)
+    if len(content) > MAX_PICTURE_BYTES:
+        raise ValueError(f'Picture larger than {MAX_PICTURE_BYTES} bytes')
+    return content
+
+
+def _fetch_features(url):
+    try:
+        return extract_features(_download(url))
+    except Exception as e:
+        print(f"Error fetching listing picture {url}: {str(e)}")
+        return None
+
+
+def get_listing_features(pictures):
+    """Return feature vectors for a dict of item ID -> picture URL.
+
+    Pictures that fail to download or decode, or are not ready by
+    ``LISTING_IMAGE_DEADLINE_SECONDS``, are left out.
+    """
+    if not pictures:
+        return {}
+
+    cached = cache.get_many([FEATURES_CACHE_PREFIX + item_id for item_id in pictures])
+    features = {
+        key[len(FEATURES_CACHE_PREFIX):]: np.frombuffer(value, dtype=np.float32)
+        for key, value in cached.items()
+    }
+
+    missing = [item_id for item_id in pictures if item_id not in features]
+    if missing:
+        executor = _get_executor()
+        futures = {executor.submit(_fetch_features, pictures[item_id]): item_id for item_id in missing}
+        done, not_done = wait(futures, timeout=settings.LISTING_IMAGE_DEADLINE_SECONDS)
+        for future in not_done:
+            future.cancel()
+
+        fetched = {}
+        for future in done:
+            vector = future.result()
+            if vector is not None:
+                fetched[futures[future]] = vector
+        if fetched:
+            cache.set_many(
+                {FEATURES_CACHE_PREFIX + item_id: vector.tobytes() for item_id, vector in fetched.items()},
+                timeout=settings.LISTING_FEATURES_CACHE_TTL_SECONDS,
+            )
+        features.update(fetched)
+
+    return features
+
+
+def score_listings(image_content, pictures):
+    """Score how much each listing picture looks like ``image_content``.
+
+    ``pictures`` maps item IDs to picture URLs. Returns a dict of item ID ->
+    similarity between 0 and 1 for every picture that could be compared.
+    """
+    query = extract_features(image_content)
+    if query is None:
+        return {}
+    features = get_listing_features(pictures)
+    if not features:
+        return {}
+
+    item_ids = list(features)
+    scores = np.stack([features[item_id] for item_id in item_ids]) @ query
+    return {item_id: float(score) for item_id, score in zip(item_ids, scores.clip(0, 1))}
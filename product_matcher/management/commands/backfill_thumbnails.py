@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from product_matcher import imaging
+from product_matcher.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = 'Create the missing thumbnails of images uploaded before thumbnails existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Images read per query')
+
+    def handle(self, *args, **options):
+        created = failed = 0
+        last_id = 0
+        while True:
+            # Keyset batches: images whose thumbnail fails stay without one and must not be read again
+            batch = list(
+                ProductImage.objects.filter(thumbnail='', id__gt=last_id).order_by('id')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            for product_image in batch:
+                if imaging.ensure_thumbnail(product_image):
+                    created += 1
+                else:
+                    failed += 1
+            last_id = batch[-1].id
+        self.stdout.write(self.style.SUCCESS(f'Created {created} thumbnails; {failed} images could not be read'))
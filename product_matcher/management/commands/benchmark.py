@@ -0,0 +1,137 @@
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from product_matcher import benchmarking, search_cache
+
+REPORT_COLUMNS = ('scenario', 'requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the upload, pipeline, analysis and history paths offline against fake Vision and eBay APIs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(benchmarking.SCENARIOS),
+                            help=f'Comma-separated scenarios to run (default: all of {", ".join(benchmarking.SCENARIOS)})')
+        parser.add_argument('--images', type=int, default=50, help='Number of synthetic images to upload and analyze')
+        parser.add_argument('--image-size', default='1024x768', help='Synthetic image size as WIDTHxHEIGHT')
+        parser.add_argument('--duplicate-ratio', type=float, default=0.2,
+                            help='Fraction of images that are resized copies of earlier ones')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients per scenario')
+        parser.add_argument('--history-requests', type=int, default=200, help='Number of history page requests')
+        parser.add_argument('--batch-size', type=int, default=settings.PIPELINE_BATCH_SIZE,
+                            help='Jobs claimed at once in the pipeline scenario')
+        parser.add_argument('--vision-latency', type=float, default=0.3, help='Seconds per fake Vision request')
+        parser.add_argument('--ebay-latency', type=float, default=0.2, help='Seconds per fake eBay call')
+        parser.add_argument('--http-latency', type=float, default=0.05,
+                            help='Seconds per fake image probe or listing picture download')
+        parser.add_argument('--jitter', type=float, default=0.2, help='Latency jitter as a fraction of the mean')
+        parser.add_argument('--replay', help='Replay Vision responses recorded with --record instead of synthetic ones')
+        parser.add_argument('--record', help='Write Vision responses stored in the database to this file and exit')
+        parser.add_argument('--record-limit', type=int, default=500, help='Maximum number of responses to record')
+        parser.add_argument('--json', help='Also write the report to this file as JSON')
+        parser.add_argument('--keep-rate-limits', action='store_true',
+                            help='Apply the configured upstream rate limits to the fakes too')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic corpus')
+
+    def handle(self, *args, **options):
+        if options['record']:
+            written = benchmarking.record_responses(options['record'], options['record_limit'])
+            self.stdout.write(self.style.SUCCESS(f'Recorded {written} Vision responses to {options["record"]}'))
+            return
+
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(benchmarking.SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        try:
+            width, height = (int(value) for value in options['image_size'].lower().split('x'))
+        except ValueError:
+            raise CommandError('--image-size must look like 1024x768')
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        if connection.vendor == 'sqlite' and options['concurrency'] > 1:
+            self.stderr.write(self.style.WARNING(
+                'SQLite allows one writer at a time, so concurrent scenarios may report lock errors. '
+                'Benchmark against PostgreSQL, or give the SQLite test database a file name and a busy timeout.'
+            ))
+
+        recorded = benchmarking.load_recorded(options['replay']) if options['replay'] else None
+        corpus = benchmarking.make_corpus(
+            options['images'], (width, height), options['duplicate_ratio'], options['seed']
+        )
+        self.stdout.write(f'Generated {len(corpus)} images ({sum(map(len, corpus)) / 1024 / 1024:.1f} MB)')
+
+        overrides = {'MEDIA_ROOT': tempfile.mkdtemp(prefix='benchmark-media-'), 'UPLOAD_JOBS_INLINE': False}
+        if not options['keep_rate_limits']:
+            overrides.update(
+                RATE_LIMIT_VISION_PER_SECOND=0,
+                RATE_LIMIT_EBAY_FINDING_PER_SECOND=0,
+                RATE_LIMIT_EBAY_SHOPPING_PER_SECOND=0,
+            )
+
+        # Run against a throwaway database, like the test runner does
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            with override_settings(**overrides), benchmarking.fake_upstreams(
+                benchmarking.Latency(options['vision_latency'], options['jitter']),
+                benchmarking.Latency(options['ebay_latency'], options['jitter']),
+                benchmarking.Latency(options['http_latency'], options['jitter']),
+                recorded,
+            ) as fakes:
+                cache.clear()
+                search_cache.get_backend().clear()
+                report = self._run(scenarios, corpus, options)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+            shutil.rmtree(overrides['MEDIA_ROOT'], ignore_errors=True)
+
+        self._print_report(report, fakes)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'options': {key: options[key] for key in (
+                    'images', 'image_size', 'duplicate_ratio', 'concurrency', 'vision_latency',
+                    'ebay_latency', 'http_latency', 'batch_size', 'replay'
+                )}, 'results': report}, f, indent=2)
+
+    def _run(self, scenarios, corpus, options):
+        report = []
+        concurrency = options['concurrency']
+        # The pipeline processes the jobs queued by the uploads
+        if 'upload' in scenarios or 'pipeline' in scenarios:
+            self.stdout.write('Running upload...')
+            result = benchmarking.run_upload(corpus, concurrency)
+            if 'upload' in scenarios:
+                report.append(result)
+        if 'pipeline' in scenarios:
+            self.stdout.write('Running pipeline...')
+            report.append(benchmarking.run_pipeline(options['batch_size']))
+        if 'test_vision' in scenarios:
+            self.stdout.write('Running test_vision...')
+            report.append(benchmarking.run_test_vision(corpus, concurrency))
+        if 'history' in scenarios:
+            self.stdout.write('Running history...')
+            report.append(benchmarking.run_history(options['history_requests'], concurrency))
+        return report
+
+    def _print_report(self, report, fakes):
+        widths = [max([len(column)] + [len(str(row[column])) for row in report]) for column in REPORT_COLUMNS]
+        self.stdout.write('')
+        self.stdout.write('  '.join(column.ljust(width) for column, width in zip(REPORT_COLUMNS, widths)))
+        for row in report:
+            line = '  '.join(str(row[column]).ljust(width) for column, width in zip(REPORT_COLUMNS, widths))
+            self.stdout.write(self.style.ERROR(line) if row['errors'] else line)
+        self.stdout.write(
+            f'\nFake upstream calls: Vision {fakes["vision"].calls}, eBay {fakes["ebay"].calls}'
+        )
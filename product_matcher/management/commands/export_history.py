@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from product_matcher.export import FORMATS, HistoryExport
+
+
+class Command(BaseCommand):
+    help = 'Export uploaded images with their labels, text and eBay listings as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(FORMATS), default='csv', help='Output format (default: csv)')
+        parser.add_argument('--output', help='File to write to (default: standard output)')
+        parser.add_argument('--since', help='Only images uploaded on or after this ISO date or date-time')
+        parser.add_argument('--until', help='Only images uploaded up to this ISO date (inclusive) or date-time')
+        parser.add_argument('--after', type=int, help='Only images after this id, e.g. the cursor of an earlier export')
+        parser.add_argument('--checkpoint',
+                            help='Continue from where the last export under this name stopped, and record where this one stops')
+
+    def handle(self, *args, **options):
+        try:
+            export = HistoryExport(
+                format=options['format'],
+                since=options['since'],
+                until=options['until'],
+                after=options['after'],
+                checkpoint=options['checkpoint']
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                for chunk in export.chunks():
+                    output.write(chunk)
+        else:
+            for chunk in export.chunks():
+                self.stdout.write(chunk, ending='')
+        # On stderr so it never ends up in the exported data
+        if export.cursor > export.start:
+            self.stderr.write(f'Exported images {export.start + 1} to {export.cursor}; next export: --after {export.cursor}')
+        else:
+            self.stderr.write(f'No new images after {export.start}')
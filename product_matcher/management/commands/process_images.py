@@ -0,0 +1,213 @@
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+
+import django
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from product_matcher.bulk_intake import IMAGE_EXTENSIONS
+
+CHECKPOINT_FILENAME = '.process_images_checkpoint.jsonl'
+
+_limiter = None
+
+
+class RateLimiter:
+    """Space calls out so that at most ``rate`` start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _init_worker(rate):
+    global _limiter
+    # Needed when the pool spawns fresh interpreters instead of forking
+    django.setup()
+    _limiter = RateLimiter(rate)
+
+
+def _process_file(path, relative_path, started_before=None):
+    """Analyze one image; ``started_before`` is when an interrupted run started it, if one did."""
+    from product_matcher import vision_cache
+    from product_matcher.analysis import analyze_image
+    from product_matcher.models import ProductImage
+
+    _limiter.wait()
+    start_time = time.monotonic()
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        content_hash = vision_cache.hash_image_bytes(content)
+        product_image = None
+        if started_before is not None:
+            # The interrupted run may already have stored the image
+            product_image = ProductImage.objects.filter(
+                content_hash=content_hash,
+                uploaded_at__gte=datetime.fromtimestamp(started_before, timezone.utc)
+            ).order_by('id').first()
+        if product_image is None:
+            product_image = ProductImage.objects.create(
+                image=ContentFile(content, name=os.path.basename(path)),
+                content_hash=content_hash
+            )
+        results = analyze_image(product_image, content)
+    except Exception as e:
+        return {
+            'path': relative_path,
+            'status': 'failed',
+            'error': str(e),
+            'seconds': time.monotonic() - start_time,
+        }
+    return {
+        'path': relative_path,
+        'status': 'ok',
+        'image_id': product_image.id,
+        'labels': len(results['labels']),
+        'ebay_listings': len(results['web_matches']['ebay_listings']),
+        'seconds': time.monotonic() - start_time,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Analyze every image in a directory the way the Image Analysis page does, resuming from a checkpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory containing the images')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes (defaults to the number of CPUs)')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum images started per second across all workers (0 = unlimited)')
+        parser.add_argument('--checkpoint',
+                            help=f'Checkpoint file (defaults to {CHECKPOINT_FILENAME} inside the directory)')
+        parser.add_argument('--recursive', action='store_true', help='Include images in subdirectories')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also reprocess images that failed in an earlier run')
+        parser.add_argument('--limit', type=int, help='Process at most this many images')
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options['directory'])
+        if not os.path.isdir(directory):
+            raise CommandError(f'{directory} is not a directory')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        checkpoint_path = options['checkpoint'] or os.path.join(directory, CHECKPOINT_FILENAME)
+        done, interrupted = self._load_checkpoint(checkpoint_path, options['retry_failed'])
+
+        paths = [path for path in self._find_images(directory, options['recursive']) if path not in done]
+        skipped = len(done)
+        if options['limit'] is not None:
+            paths = paths[:options['limit']]
+        self.stdout.write(f'{len(paths)} images to process, {skipped} already done according to {checkpoint_path}')
+        if not paths:
+            return
+
+        # Worker processes must open their own database connections
+        connections.close_all()
+
+        succeeded, failed, latencies = 0, 0, []
+        start_time = time.monotonic()
+        with open(checkpoint_path, 'a') as checkpoint, ProcessPoolExecutor(
+            max_workers=options['workers'],
+            initializer=_init_worker,
+            initargs=(options['rate'] / options['workers'],)
+        ) as pool:
+            # Keep a bounded number of tasks in flight instead of submitting the whole directory
+            remaining = iter(paths)
+            in_flight = set()
+            while True:
+                for relative_path in remaining:
+                    # Recorded first, so that a run interrupted now does not store the image twice on resume
+                    checkpoint.write(json.dumps({'path': relative_path, 'status': 'started', 'at': time.time()}) + '\n')
+                    in_flight.add(pool.submit(
+                        _process_file, os.path.join(directory, relative_path), relative_path,
+                        interrupted.get(relative_path)
+                    ))
+                    if len(in_flight) >= options['workers'] * 4:
+                        break
+                checkpoint.flush()
+                if not in_flight:
+                    break
+
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    checkpoint.write(json.dumps(result) + '\n')
+                    latencies.append(result['seconds'])
+                    if result['status'] == 'ok':
+                        succeeded += 1
+                    else:
+                        failed += 1
+                        self.stderr.write(f"{result['path']}: {result['error']}")
+                checkpoint.flush()
+
+                total = succeeded + failed
+                if total % 100 < len(finished):
+                    os.fsync(checkpoint.fileno())
+                    self.stdout.write(f'{total}/{len(paths)} images processed')
+
+        self._print_stats(succeeded, failed, skipped, latencies, time.monotonic() - start_time)
+
+    def _find_images(self, directory, recursive):
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.')) if recursive else []
+            for name in sorted(files):
+                if not name.startswith('.') and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    paths.append(os.path.relpath(os.path.join(root, name), directory))
+        return paths
+
+    def _load_checkpoint(self, checkpoint_path, retry_failed):
+        """Return the paths already done, and path -> start time for those an interrupted run left unfinished."""
+        done, interrupted = set(), {}
+        if not os.path.exists(checkpoint_path):
+            return done, interrupted
+        with open(checkpoint_path) as checkpoint:
+            for line in checkpoint:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A run killed mid-write can leave a partial last line
+                    continue
+                if entry['status'] == 'started':
+                    # Keep the first start: the image may have been stored by any run since
+                    interrupted.setdefault(entry['path'], entry['at'])
+                    continue
+                interrupted.pop(entry['path'], None)
+                if entry['status'] == 'ok' or not retry_failed:
+                    done.add(entry['path'])
+                else:
+                    done.discard(entry['path'])
+        return done, interrupted
+
+    def _print_stats(self, succeeded, failed, skipped, latencies, elapsed):
+        total = succeeded + failed
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {total} images in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.2f} images/s)'
+        ))
+        self.stdout.write(f'  succeeded: {succeeded}, failed: {failed}, skipped from checkpoint: {skipped}')
+        if latencies:
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            self.stdout.write(
+                f'  per-image latency: mean {statistics.mean(latencies):.2f}s, '
+                f'median {statistics.median(latencies):.2f}s, p95 {p95:.2f}s'
+            )
@@ -0,0 +1,60 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from product_matcher.models import ProcessingJob
+from product_matcher.pipeline import claim_jobs, execute_jobs, requeue_stale_jobs
+
+
+class Command(BaseCommand):
+    help = 'Process queued image uploads (Vision -> eBay) from the database job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL_SECONDS,
+                            help='Seconds to wait before checking an empty queue again')
+        parser.add_argument('--batch-size', type=int, default=settings.PIPELINE_BATCH_SIZE,
+                            help='Maximum number of jobs claimed and pipelined together')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit as soon as the queue is empty')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        self.stdout.write('Worker started, waiting for jobs...')
+        last_requeue = 0
+        while not self.stopping:
+            close_old_connections()
+
+            if time.monotonic() - last_requeue > settings.JOB_STALE_SECONDS / 10:
+                requeued, failed = requeue_stale_jobs()
+                if requeued or failed:
+                    self.stdout.write(f'Requeued {requeued} stale jobs, failed {failed}')
+                last_requeue = time.monotonic()
+
+            jobs = claim_jobs(options['batch_size'])
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            start_time = time.time()
+            execute_jobs(jobs)
+            elapsed = time.time() - start_time
+            for job in jobs:
+                if job.status == ProcessingJob.STATUS_SUCCEEDED:
+                    self.stdout.write(self.style.SUCCESS(f'Job {job.id} succeeded'))
+                else:
+                    self.stdout.write(self.style.ERROR(f'Job {job.id} failed: {job.error}'))
+            self.stdout.write(f'Processed {len(jobs)} jobs in {elapsed:.2f}s')
+
+        self.stdout.write('Worker stopped')
+
+    def _stop(self, signum, frame):
+        # Finish the current jobs before exiting
+        self.stopping = True
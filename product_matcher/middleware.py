@@ -0,0 +1,45 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import timing
+
+
+class ServerTimingMiddleware:
+    """Report the stages timed during a request in a ``Server-Timing`` header.
+
+    Supports both sync and async requests, so async views are not pushed onto
+    a thread under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with timing.collect() as timings:
+            response = self.get_response(request)
+        return self._finish(request, response, timings, start)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with timing.collect() as timings:
+            response = await self.get_response(request)
+        return self._finish(request, response, timings, start)
+
+    def _finish(self, request, response, timings, start):
+        total = time.perf_counter() - start
+
+        match = request.resolver_match
+        timing.request_durations.observe(match.url_name if match and match.url_name else 'unmatched', total)
+
+        entries = [f'{name};dur={duration}' for name, duration in timings.items()]
+        entries.append(f'total;dur={total * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(entries)
+        return response
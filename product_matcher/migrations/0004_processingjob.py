@@ -0,0 +1,33 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0003_vision_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('stage', models.CharField(choices=[('queued', 'Waiting for a worker'), ('vision', 'Analyzing image'), ('search', 'Building search terms'), ('ebay', 'Searching eBay'), ('saving', 'Saving listings'), ('done', 'Done')], default='queued', max_length=20)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('product_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='product_matcher.productimage')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='product_mat_status_093399_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0005_uploadbatch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ebaylisting',
+            index=models.Index(fields=['product_image', 'created_at'], name='product_mat_product_7c2b03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productimage',
+            index=models.Index(fields=['uploaded_at', 'id'], name='product_mat_uploade_6aade7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visionapicall',
+            index=models.Index(fields=['product_image', 'request_timestamp'], name='product_mat_product_f64763_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0006_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visionapicall',
+            name='api_response_ref',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='visionapicall',
+            name='api_response',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations
+
+from product_matcher import response_store
+
+BATCH_SIZE = 500
+
+
+def offload_responses(apps, schema_editor):
+    VisionAPICall = apps.get_model('product_matcher', 'VisionAPICall')
+    pending = VisionAPICall.objects.filter(api_response__isnull=False, api_response_ref__isnull=True)
+
+    # Page by id so each batch is a fresh query and memory stays flat on big tables
+    last_id = 0
+    while True:
+        batch = list(pending.filter(id__gt=last_id).order_by('id').only('id', 'api_response')[:BATCH_SIZE])
+        if not batch:
+            break
+        for vision_call in batch:
+            vision_call.api_response_ref = response_store.save(vision_call.api_response)
+            vision_call.api_response = None
+        VisionAPICall.objects.bulk_update(batch, ['api_response_ref', 'api_response'])
+        last_id = batch[-1].id
+
+
+def restore_responses(apps, schema_editor):
+    VisionAPICall = apps.get_model('product_matcher', 'VisionAPICall')
+    offloaded = VisionAPICall.objects.filter(api_response_ref__isnull=False)
+
+    last_id = 0
+    while True:
+        batch = list(offloaded.filter(id__gt=last_id).order_by('id').only('id', 'api_response_ref')[:BATCH_SIZE])
+        if not batch:
+            break
+        for vision_call in batch:
+            vision_call.api_response = response_store.load(vision_call.api_response_ref)
+            vision_call.api_response_ref = None
+        VisionAPICall.objects.bulk_update(batch, ['api_response_ref', 'api_response'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own so a large table is not rewritten in one transaction
+    atomic = False
+
+    dependencies = [
+        ('product_matcher', '0007_visionapicall_api_response_ref'),
+    ]
+
+    operations = [
+        migrations.RunPython(offload_responses, restore_responses),
+    ]
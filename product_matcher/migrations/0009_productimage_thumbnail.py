@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0008_offload_api_responses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to='thumbnails/'),
+        ),
+    ]
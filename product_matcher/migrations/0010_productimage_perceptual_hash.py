@@ -0,0 +1,24 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0009_productimage_thumbnail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='near_duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='near_duplicates', to='product_matcher.productimage'),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0010_productimage_perceptual_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ebaylisting',
+            name='similarity_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='processingjob',
+            name='stage',
+            field=models.CharField(choices=[('queued', 'Waiting for a worker'), ('vision', 'Analyzing image'), ('search', 'Building search terms'), ('ebay', 'Searching eBay'), ('ranking', 'Comparing listing photos'), ('saving', 'Saving listings'), ('done', 'Done')], default='queued', max_length=20),
+        ),
+    ]
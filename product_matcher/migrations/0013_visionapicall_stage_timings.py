@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0012_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visionapicall',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,99 @@
+from django.db import migrations, models
+from django.db.models import Q
+import django.utils.timezone
+
+BATCH_SIZE = 500
+ITEM_FIELDS = ['title', 'price', 'url', 'condition', 'location', 'seller']
+
+
+def populate_items(apps, schema_editor):
+    EbayItem = apps.get_model('product_matcher', 'EbayItem')
+    EbayListing = apps.get_model('product_matcher', 'EbayListing')
+
+    # Walk the listings image by image, oldest first, so ranks follow the original insertion order
+    image_id, last_id = 0, 0
+    seen, next_rank = set(), 0
+    while True:
+        batch = list(
+            EbayListing.objects
+            .filter(Q(product_image_id__gt=image_id) | Q(product_image_id=image_id, id__gt=last_id))
+            .order_by('product_image_id', 'id')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        items, ranked, duplicates = {}, [], []
+        for listing in batch:
+            if listing.product_image_id != image_id:
+                image_id, seen, next_rank = listing.product_image_id, set(), 0
+            items[listing.item_id] = EbayItem(
+                item_id=listing.item_id,
+                created_at=listing.created_at,
+                updated_at=listing.created_at,
+                **{field: getattr(listing, field) for field in ITEM_FIELDS}
+            )
+            # The same item stored twice for one image collapses into one link
+            if listing.item_id in seen:
+                duplicates.append(listing.id)
+                continue
+            seen.add(listing.item_id)
+            listing.rank = next_rank
+            next_rank += 1
+            ranked.append(listing)
+        EbayItem.objects.bulk_create(
+            items.values(), update_conflicts=True, unique_fields=['item_id'], update_fields=ITEM_FIELDS + ['updated_at']
+        )
+        EbayListing.objects.bulk_update(ranked, ['rank'])
+        EbayListing.objects.filter(id__in=duplicates).delete()
+        last_id = batch[-1].id
+
+
+def restore_listing_fields(apps, schema_editor):
+    EbayItem = apps.get_model('product_matcher', 'EbayItem')
+    EbayListing = apps.get_model('product_matcher', 'EbayListing')
+
+    last_id = 0
+    while True:
+        batch = list(EbayListing.objects.filter(id__gt=last_id).order_by('id')[:BATCH_SIZE])
+        if not batch:
+            break
+        items = EbayItem.objects.in_bulk({listing.item_id for listing in batch}, field_name='item_id')
+        for listing in batch:
+            item = items[listing.item_id]
+            for field in ITEM_FIELDS:
+                if field != 'price':
+                    setattr(listing, field, getattr(item, field))
+        EbayListing.objects.bulk_update(batch, [field for field in ITEM_FIELDS if field != 'price'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # Keep the data copy in its own transaction; PostgreSQL refuses to alter a table with pending trigger events
+    atomic = False
+
+    dependencies = [
+        ('product_matcher', '0013_visionapicall_stage_timings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EbayItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item_id', models.CharField(max_length=100, unique=True)),
+                ('title', models.CharField(max_length=255)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('url', models.URLField()),
+                ('condition', models.CharField(max_length=100)),
+                ('location', models.CharField(max_length=255)),
+                ('seller', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ebaylisting',
+            name='rank',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_items, restore_listing_fields, atomic=True),
+    ]
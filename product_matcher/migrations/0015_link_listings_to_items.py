@@ -0,0 +1,73 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0014_ebay_items'),
+    ]
+
+    operations = [
+        # item_id keeps its column and values, and becomes a foreign key to EbayItem.item_id
+        migrations.RenameField(
+            model_name='ebaylisting',
+            old_name='item_id',
+            new_name='item',
+        ),
+        migrations.AlterField(
+            model_name='ebaylisting',
+            name='item',
+            field=models.ForeignKey(db_column='item_id', on_delete=django.db.models.deletion.CASCADE, related_name='listings', to='product_matcher.ebayitem', to_field='item_id'),
+        ),
+        # Defaults let the removed columns be added back when the migration is reversed
+        migrations.AlterField(
+            model_name='ebaylisting',
+            name='condition',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='ebaylisting',
+            name='location',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='ebaylisting',
+            name='seller',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='ebaylisting',
+            name='title',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='ebaylisting',
+            name='url',
+            field=models.URLField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='ebaylisting',
+            name='condition',
+        ),
+        migrations.RemoveField(
+            model_name='ebaylisting',
+            name='location',
+        ),
+        migrations.RemoveField(
+            model_name='ebaylisting',
+            name='seller',
+        ),
+        migrations.RemoveField(
+            model_name='ebaylisting',
+            name='title',
+        ),
+        migrations.RemoveField(
+            model_name='ebaylisting',
+            name='url',
+        ),
+        migrations.AddConstraint(
+            model_name='ebaylisting',
+            constraint=models.UniqueConstraint(fields=('product_image', 'item'), name='unique_listing_per_image'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 09:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0015_link_listings_to_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ebayitem',
+            name='picture_url',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0017_export_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ebaylisting',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.10 on 2026-10-18 10:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_matcher', '0018_ebay_listing_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportcheckpoint',
+            name='filters',
+            field=models.CharField(default='', max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='exportcheckpoint',
+            name='name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='exportcheckpoint',
+            constraint=models.UniqueConstraint(fields=('name', 'filters'), name='unique_export_checkpoint'),
+        ),
+    ]
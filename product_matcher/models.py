@@ -2,9 +2,13 @@ from django.db import models
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
+from . import response_store
+
+MAX_UPLOAD_MEGABYTES = 6
+
 def validate_file_size(value):
     filesize = value.size
-    megabyte_limit = 6
+    megabyte_limit = MAX_UPLOAD_MEGABYTES
     if filesize > megabyte_limit * 1024 * 1024:
         raise ValidationError(f"The maximum file size that can be uploaded is {megabyte_limit}MB")
 
@@ -13,39 +17,185 @@ def validate_file_size(value):
 class ProductImage(models.Model):
     image = models.ImageField(upload_to='product_images/', validators=[validate_file_size])
     uploaded_at = models.DateTimeField(default=timezone.now)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of the image bytes
+    thumbnail = models.ImageField(upload_to='thumbnails/', blank=True)  # Small JPEG shown on listing pages
+    perceptual_hash = models.CharField(max_length=16, blank=True, db_index=True)  # 64-bit DCT hash for near-duplicate lookups
+    near_duplicate_of = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='near_duplicates'
+    )  # Image whose stored results were reused for this one
     
     def __str__(self):
         return f"Product Image {self.id} - {self.uploaded_at}"
 
+    @property
+    def thumbnail_url(self):
+        # Images uploaded before thumbnails existed get theirs from the backfill_thumbnails command
+        return self.thumbnail.url if self.thumbnail else self.image.url
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['uploaded_at', 'id']),  # Keyset pagination in the history view
+        ]
+
+class VisionAPICallManager(models.Manager):
+    # Raw responses and OCR text are large and most pages never show them
+    def get_queryset(self):
+        return super().get_queryset().defer('api_response', 'text')
+
 class VisionAPICall(models.Model):
     product_image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name='vision_api_calls')
     request_timestamp = models.DateTimeField(default=timezone.now)
-    api_response = models.JSONField()  # Stores the complete API response
+    api_response = models.JSONField(null=True, blank=True)  # Complete API response (rows created before offloading)
+    api_response_ref = models.CharField(max_length=64, null=True, blank=True)  # Complete API response in response_store
     labels = models.JSONField(null=True, blank=True)  # Stores label detection results
     text = models.JSONField(null=True, blank=True)    # Stores text detection results
     detected_objects = models.JSONField(null=True, blank=True)  # Stores object detection results
     error = models.TextField(null=True, blank=True)    # Stores any error messages
     processing_time_ms = models.IntegerField(null=True)  # Time taken for API call
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # Vision cache key, cleared on eviction
+    cache_hit = models.BooleanField(default=False)  # True when the response was served from the Vision cache
+    stage_timings = models.JSONField(null=True, blank=True)  # Milliseconds spent in each processing stage
+
+    objects = VisionAPICallManager()
     
     def __str__(self):
         return f"Vision API Call for Image {self.product_image_id} at {self.request_timestamp}"
+
+    def get_api_response(self):
+        """Return the complete API response, wherever it is stored."""
+        if self.api_response_ref:
+            return response_store.load(self.api_response_ref)
+        return self.api_response or {}
     
     class Meta:
         ordering = ['-request_timestamp']
+        indexes = [
+            models.Index(fields=['product_image', 'request_timestamp']),
+        ]
 
-class EbayListing(models.Model):
-    product_image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name='ebay_listings')
+class EbayItem(models.Model):
+    """An eBay listing, stored once however many uploads it matches and refreshed whenever it is found again."""
+    item_id = models.CharField(max_length=100, unique=True)
     title = models.CharField(max_length=255)
-    price = models.DecimalField(max_digits=10, decimal_places=2)
+    price = models.DecimalField(max_digits=10, decimal_places=2)  # Latest price seen
     url = models.URLField()
-    item_id = models.CharField(max_length=100)
     condition = models.CharField(max_length=100)
     location = models.CharField(max_length=255)
     seller = models.CharField(max_length=100)
+    picture_url = models.URLField(max_length=500, blank=True)  # For re-ranking when the item is found in the local index
     created_at = models.DateTimeField(default=timezone.now)
-    
+    updated_at = models.DateTimeField(default=timezone.now)  # Last time an eBay search returned the item
+
     def __str__(self):
         return self.title
 
+class EbayListing(models.Model):
+    """An eBay item matched to an upload."""
+    product_image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name='ebay_listings')
+    item = models.ForeignKey(
+        EbayItem, on_delete=models.CASCADE, to_field='item_id', db_column='item_id', related_name='listings'
+    )  # item_id holds the eBay item ID
+    rank = models.PositiveIntegerField(default=0)  # Position in eBay's search results
+    price = models.DecimalField(max_digits=10, decimal_places=2)  # Price when the match was made
+    similarity_score = models.FloatField(null=True, blank=True)  # Visual similarity of the listing picture to the upload (0-1)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)  # Last time a search saved the link again
+    
+    def __str__(self):
+        return f"{self.item_id} for Image {self.product_image_id}"
+
     class Meta:
         ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['product_image', 'item'], name='unique_listing_per_image'),
+        ]
+        indexes = [
+            models.Index(fields=['product_image', 'created_at']),
+        ]
+
+class UploadBatch(models.Model):
+    created_at = models.DateTimeField(default=timezone.now)
+    file_count = models.IntegerField(default=0)
+    skipped = models.JSONField(default=list, blank=True)  # Archive members rejected at intake, with the reason
+
+    def __str__(self):
+        return f"Upload Batch {self.id} ({self.file_count} files)"
+
+    class Meta:
+        ordering = ['-created_at']
+
+class ProcessingJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    STAGE_QUEUED = 'queued'
+    STAGE_VISION = 'vision'
+    STAGE_SEARCH = 'search'
+    STAGE_EBAY = 'ebay'
+    STAGE_RANKING = 'ranking'
+    STAGE_SAVING = 'saving'
+    STAGE_DONE = 'done'
+    STAGE_CHOICES = [
+        (STAGE_QUEUED, 'Waiting for a worker'),
+        (STAGE_VISION, 'Analyzing image'),
+        (STAGE_SEARCH, 'Building search terms'),
+        (STAGE_EBAY, 'Searching eBay'),
+        (STAGE_RANKING, 'Comparing listing photos'),
+        (STAGE_SAVING, 'Saving listings'),
+        (STAGE_DONE, 'Done'),
+    ]
+
+    product_image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name='jobs')
+    batch = models.ForeignKey(UploadBatch, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, default=STAGE_QUEUED)
+    error = models.TextField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job {self.id} for Image {self.product_image_id} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCEEDED, self.STATUS_FAILED)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),  # Workers claim the oldest pending job
+        ]
+
+class ExportCheckpoint(models.Model):
+    # Where the last incremental history export under this name and filters stopped, see export.py
+    name = models.CharField(max_length=100)
+    filters = models.CharField(max_length=200, default='')  # Format and upload date bounds of the export
+    last_image_id = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Export checkpoint {self.name} (image {self.last_image_id})"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'filters'], name='unique_export_checkpoint'),
+        ]
+
+class RateLimitBucket(models.Model):
+    # Token bucket shared by every process calling an upstream API, see upstream.py
+    name = models.CharField(max_length=50, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.FloatField()  # Unix time of the last refill
+
+    def __str__(self):
+        return f"Rate limit bucket {self.name} ({self.tokens:.1f} tokens)"
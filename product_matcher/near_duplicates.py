@@ -0,0 +1,231 @@
+"""Perceptual-hash index for finding near-duplicate product photos.
+
+Each ProductImage gets a 64-bit DCT perceptual hash, which changes little
+under re-encoding, small crops or lighting changes. Hashes live in an
+in-process BK-tree for fast Hamming-distance lookups. The tree picks up new
+rows incrementally by id and is rebuilt from the database every
+``NEAR_DUPLICATE_INDEX_REBUILD_SECONDS`` to include hashes assigned late or
+by other processes.
+
+When an upload is within ``NEAR_DUPLICATE_MAX_DISTANCE`` bits of an image
+that was already analysed, its stored Vision response (and eBay listings)
+can be reused instead of calling the APIs again.
+"""
+import io
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import vision_cache
+from .models import EbayListing, ProductImage, VisionAPICall
+
+HASH_SIZE = 8
+SAMPLE_SIZE = 32
+# Nearly flat images all hash alike, so they are left out of the index
+MIN_PIXEL_STDDEV = 2.0
+# Only the nearest few images are checked for a usable Vision call
+MAX_CANDIDATES = 10
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(SAMPLE_SIZE)
+
+
+def compute_hash(content):
+    """Return the perceptual hash of an image as 16 hex characters."""
+    image = Image.open(io.BytesIO(content))
+    image.draft('L', (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4))
+    image = ImageOps.exif_transpose(image).convert('L').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS)
+
+    pixels = np.asarray(image, dtype=np.float64)
+    if pixels.std() < MIN_PIXEL_STDDEV:
+        raise ValueError('Image has too little detail for a perceptual hash')
+    # Keep the lowest frequencies and compare them to their median (the DC term is left out)
+    coefficients = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = coefficients > np.median(coefficients[1:])
+    return f'{int("".join("1" if bit else "0" for bit in bits), 2):016x}'
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes under Hamming distance."""
+
+    def __init__(self):
+        # Each node is [hash, ids, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Return ``(distance, item)`` pairs within ``max_distance``, nearest first."""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+class NearDuplicateIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+        self.last_id = 0
+        self.indexed_ids = set()
+        self.built_at = 0
+
+    def _load(self, queryset):
+        for image_id, perceptual_hash in queryset.values_list('id', 'perceptual_hash').iterator(chunk_size=2000):
+            self._add(image_id, perceptual_hash)
+
+    def _add(self, image_id, perceptual_hash):
+        if image_id not in self.indexed_ids:
+            self.indexed_ids.add(image_id)
+            self.tree.add(int(perceptual_hash, 16), image_id)
+            self.last_id = max(self.last_id, image_id)
+
+    def sync(self):
+        hashed = ProductImage.objects.exclude(perceptual_hash='').order_by('id')
+        with self.lock:
+            if time.monotonic() - self.built_at > settings.NEAR_DUPLICATE_INDEX_REBUILD_SECONDS:
+                self.tree, self.last_id, self.indexed_ids = BKTree(), 0, set()
+                self._load(hashed)
+                self.built_at = time.monotonic()
+            else:
+                self._load(hashed.filter(id__gt=self.last_id))
+
+    def add(self, image_id, perceptual_hash):
+        with self.lock:
+            self._add(image_id, perceptual_hash)
+
+    def search(self, perceptual_hash, max_distance):
+        self.sync()
+        with self.lock:
+            return self.tree.search(int(perceptual_hash, 16), max_distance)
+
+
+index = NearDuplicateIndex()
+
+
+def assign_hash(product_image, content):
+    """Compute and store the perceptual hash of ``product_image`` if it has none yet."""
+    if product_image.perceptual_hash:
+        return product_image.perceptual_hash
+    try:
+        product_image.perceptual_hash = compute_hash(content)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return ''
+    ProductImage.objects.filter(id=product_image.id).update(perceptual_hash=product_image.perceptual_hash)
+    index.add(product_image.id, product_image.perceptual_hash)
+    return product_image.perceptual_hash
+
+
+def find_match(product_image, response_keys):
+    """Find the nearest other image whose stored Vision response holds ``response_keys``.
+
+    Returns a dict with the matching ``product_image_id``, its ``vision_call``,
+    the Hamming ``distance`` and the stored ``api_response``, or None.
+    """
+    if not product_image.perceptual_hash:
+        return None
+
+    matches = [
+        (distance, image_id)
+        for distance, image_id in index.search(product_image.perceptual_hash, settings.NEAR_DUPLICATE_MAX_DISTANCE)
+        if image_id != product_image.id
+    ][:MAX_CANDIDATES]
+    if not matches:
+        return None
+
+    calls_by_image = {}
+    candidates = (
+        VisionAPICall.objects
+        .filter(
+            product_image_id__in=[image_id for distance, image_id in matches],
+            error__isnull=True,
+            # Stored results are reused for as long as the exact-match Vision cache would reuse them
+            request_timestamp__gte=timezone.now() - timedelta(seconds=settings.VISION_CACHE_TTL_SECONDS)
+        )
+        .only('id', 'product_image', 'request_timestamp', 'api_response', 'api_response_ref')
+    )
+    for vision_call in candidates:
+        calls_by_image.setdefault(vision_call.product_image_id, []).append(vision_call)
+
+    for distance, image_id in matches:
+        for vision_call in calls_by_image.get(image_id, []):
+            api_response = vision_call.get_api_response()
+            if all(key in api_response for key in response_keys):
+                return {
+                    'product_image_id': image_id,
+                    'vision_call': vision_call,
+                    'distance': distance,
+                    'api_response': api_response,
+                }
+    return None
+
+
+def find_reusable(product_image, content, response_keys):
+    """Hash ``product_image`` and look for a near-duplicate whose results can be reused.
+
+    Returns ``(responses, match)`` for the Vision responses of the match, or
+    None. The match is recorded in ``product_image.near_duplicate_of``.
+    Only call it after a Vision cache miss: a byte-identical upload would
+    match its original at distance 0, bypassing the cache's accounting.
+    """
+    assign_hash(product_image, content)
+    if not settings.NEAR_DUPLICATE_REUSE:
+        return None
+    match = find_match(product_image, response_keys)
+    if match is None:
+        return None
+
+    product_image.near_duplicate_of_id = match['product_image_id']
+    ProductImage.objects.filter(id=product_image.id).update(near_duplicate_of_id=match['product_image_id'])
+    return vision_cache.load_responses(match['api_response'], response_keys), match
+
+
+def copy_listings(source_image_id, product_image):
+    """Link ``product_image`` to the eBay items of ``source_image_id``; return how many were linked."""
+    listings = list(EbayListing.objects.filter(product_image_id=source_image_id).order_by('rank', 'id'))
+    now = timezone.now()
+    for listing in listings:
+        listing.pk = None
+        listing.product_image = product_image
+        listing.created_at = now
+    EbayListing.objects.bulk_create(listings, ignore_conflicts=True)
+    return len(listings)
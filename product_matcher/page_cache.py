@@ -0,0 +1,121 @@
+"""Conditional GET and fragment caching for the results and Vision call pages.
+
+A page's *version* is read with one aggregate query: the image, its latest
+job, and the count and newest timestamps of its listings and their eBay
+items. Saving listings, a job moving to another stage and an item refreshed
+by another search all change the version. Pages and JSON responses derive a
+strong ``ETag`` and a ``Last-Modified`` from it, so a repeat request for an
+unchanged page is answered with a 304 after that single query. When a page
+has to be rendered, its listings come from a cached fragment keyed by the
+version, so they are only queried and rendered once per version.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .models import ProcessingJob, ProductImage, VisionAPICall
+
+JSON_CACHE_PREFIX = 'page_json:v2:'  # Bumped whenever the JSON format changes
+
+
+class Version:
+    """What a page shows, reduced to an ETag and a Last-Modified date."""
+
+    def __init__(self, fields, timestamps, settled=True):
+        self.etag = '"{}"'.format(hashlib.sha256(
+            json.dumps(fields, default=str, sort_keys=True).encode()
+        ).hexdigest()[:32])
+        # Some changes (a job's stage, timings stored after the call) carry no
+        # timestamp; until the page settles only the ETag can describe it
+        self.last_modified = max(t for t in timestamps if t is not None).timestamp() if settled else None
+
+    @property
+    def key(self):
+        return self.etag.strip('"')
+
+    def not_modified(self, request):
+        """Return the 304 (or 412) response for ``request`` if it already has this version, else None."""
+        return get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+
+    def stamp(self, response):
+        """Add the validators to ``response``; clients must revalidate before reusing it."""
+        response['ETag'] = self.etag
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified)
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+def _listing_aggregates(prefix):
+    return {
+        'listing_count': Count(f'{prefix}ebay_listings'),
+        'listings_changed': Max(f'{prefix}ebay_listings__updated_at'),
+        'items_changed': Max(f'{prefix}ebay_listings__item__updated_at'),
+    }
+
+
+def results_version(image_id):
+    """Return the Version of the results for ``image_id``, or None if there is no such image."""
+    latest_job = ProcessingJob.objects.filter(product_image=OuterRef('pk')).order_by('-created_at')
+    row = (
+        ProductImage.objects
+        .filter(id=image_id)
+        .annotate(
+            job_id=Subquery(latest_job.values('id')[:1]),
+            job_status=Subquery(latest_job.values('status')[:1]),
+            job_stage=Subquery(latest_job.values('stage')[:1]),
+            job_finished_at=Subquery(latest_job.values('finished_at')[:1]),
+            **_listing_aggregates('')
+        )
+        .values(
+            # Not the thumbnail: pages without one show the full image, which stays valid
+            'id', 'uploaded_at', 'near_duplicate_of_id', 'job_id', 'job_status', 'job_stage',
+            'job_finished_at', 'listing_count', 'listings_changed', 'items_changed'
+        )
+        .first()
+    )
+    if row is None:
+        return None
+    finished = row['job_status'] in (None, ProcessingJob.STATUS_SUCCEEDED, ProcessingJob.STATUS_FAILED)
+    return Version(
+        row,
+        [row['uploaded_at'], row['job_finished_at'], row['listings_changed'], row['items_changed']],
+        settled=finished
+    )
+
+
+def vision_call_version(call_id):
+    """Return the Version of the detail page of Vision call ``call_id``, or None if there is no such call."""
+    row = (
+        VisionAPICall.objects
+        .filter(id=call_id)
+        .annotate(**_listing_aggregates('product_image__'))
+        .values(
+            'id', 'product_image_id', 'request_timestamp', 'stage_timings',
+            'listing_count', 'listings_changed', 'items_changed'
+        )
+        .first()
+    )
+    if row is None:
+        return None
+    return Version(
+        row,
+        [row['request_timestamp'], row['listings_changed'], row['items_changed']],
+        settled=row['stage_timings'] is not None
+    )
+
+
+def cached_json(name, version, build):
+    """Return the JSON body for ``name`` at ``version``, building it with ``build()`` on a miss."""
+    key = f'{JSON_CACHE_PREFIX}{name}:{version.key}'
+    body = cache.get(key)
+    if body is None:
+        body = json.dumps(build(), cls=DjangoJSONEncoder)
+        cache.set(key, body, timeout=settings.PAGE_CACHE_TTL_SECONDS)
+    return body
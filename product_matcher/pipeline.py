@@ -0,0 +1,451 @@
+"""Upload processing pipeline: Vision -> search terms -> eBay -> EbayListing.
+
+``upload_image`` only stores the image and queues a ProcessingJob; the
+``run_worker`` management command claims queued jobs from the database and
+runs them through this pipeline.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from google.protobuf.json_format import MessageToDict
+
+from . import clients, imaging, listing_index, listing_ranking, near_duplicates, response_store, search_cache, timing, upstream, vision_api
+from .models import EbayItem, EbayListing, ProcessingJob, VisionAPICall
+
+UPLOAD_RESPONSE_KEYS = ['label_response', 'web_response']
+
+logger = logging.getLogger(__name__)
+
+
+def record_vision_call(product_image, responses, content_hash, cache_hit, processing_time, stage_timings=None):
+    label_response = responses.get('label_response')
+    web_response = responses.get('web_response')
+    text_response = responses.get('text_response')
+    web = web_response.web_detection if web_response else None
+
+    # Per-image failures come back inside the response rather than as an exception
+    errors = {response.error.message for response in responses.values() if response.error.message}
+
+    return VisionAPICall.objects.create(
+        product_image=product_image,
+        api_response_ref=response_store.save(
+            {key: MessageToDict(response._pb) for key, response in responses.items()}
+        ),
+        labels=[{
+            'description': label.description,
+            'score': label.score
+        } for label in label_response.label_annotations] if label_response else [],
+        text=[{
+            'description': text.description,
+            'locale': text.locale if hasattr(text, 'locale') else None
+        } for text in text_response.text_annotations] if text_response and text_response.text_annotations else [],
+        detected_objects=[{
+            'url': image.url
+            for image in web.visually_similar_images
+        }] if web and web.visually_similar_images else [],
+        error='; '.join(sorted(errors)) or None,
+        processing_time_ms=processing_time,
+        content_hash=content_hash,
+        cache_hit=cache_hit,
+        stage_timings=stage_timings
+    )
+
+
+def build_search_query(labels, web):
+    # Collect all relevant terms
+    search_terms = []
+
+    # Add labels (general image classification)
+    for label in labels[:3]:  # Top 3 labels
+        if label.score > 0.8:  # Only high confidence labels
+            search_terms.append(label.description)
+            print("label API", label.description)
+
+    # Add web entities
+    for entity in web.web_entities[:3]:  # Top 3 web entities
+        if entity.score > 0.8:  # Only high confidence entities
+            search_terms.append(entity.description)
+            print("entity API", entity.description)
+
+    # Create search query from the collected terms
+    return ' '.join(search_terms)
+
+
+SEARCH_PARAMS = {
+    'outputSelector': ['SellerInfo', 'PictureURLSuperSize'],
+    'paginationInput': {'entriesPerPage': 10},
+    'sortOrder': 'BestMatch'  # Sort by best match
+}
+
+
+def _find_items(keywords):
+    api = clients.finding()
+
+    response = upstream.call(
+        upstream.EBAY_FINDING, api.execute, 'findItemsByKeywords', dict(SEARCH_PARAMS, keywords=keywords)
+    )
+    return response.reply.searchResult.item
+
+
+def search_ebay(search_query):
+    return search_cache.get_or_fetch(search_query, SEARCH_PARAMS, _find_items)
+
+
+def picture_url(item):
+    return getattr(item, 'pictureURLSuperSize', None) or getattr(item, 'galleryURL', None)
+
+
+def rank_listings(product_image, items):
+    """Return item ID -> visual similarity to ``product_image`` for the items that could be compared."""
+    pictures = {item.itemId: picture_url(item) for item in items if picture_url(item)}
+    if not pictures:
+        return {}
+    # The thumbnail is plenty for a histogram comparison and much cheaper to read
+    source = product_image.thumbnail or product_image.image
+    with source.open('rb') as f:
+        return listing_ranking.score_listings(f.read(), pictures)
+
+
+def save_listings(product_image, items, scores=None, refresh_items=True):
+    """Store the search results for ``product_image`` in two bulk upserts.
+
+    Each eBay item is stored once and refreshed in place whenever a search
+    finds it again; the link to the image keeps its rank in the results and
+    the price at the time. Saving the same results again updates the links.
+    Pass ``refresh_items=False`` for items that came from the local index
+    rather than from eBay, so they are only linked.
+    """
+    scores = scores or {}
+    now = timezone.now()
+    ebay_items, listings = {}, {}
+    for rank, item in enumerate(items):
+        price = float(item.sellingStatus.currentPrice.value)
+        ebay_items[item.itemId] = EbayItem(
+            item_id=item.itemId,
+            title=item.title,
+            price=price,
+            url=item.viewItemURL,
+            condition=getattr(item, 'condition', {}).get('conditionDisplayName', 'Not specified'),
+            location=item.location,
+            seller=item.sellerInfo.sellerUserName,
+            picture_url=picture_url(item) or '',
+            updated_at=now
+        )
+        # eBay occasionally repeats an item; the first position counts
+        listings.setdefault(item.itemId, EbayListing(
+            product_image=product_image,
+            item_id=item.itemId,
+            rank=rank,
+            price=price,
+            similarity_score=scores.get(item.itemId),
+            created_at=now,
+            updated_at=now
+        ))
+
+    with transaction.atomic():
+        if refresh_items:
+            EbayItem.objects.bulk_create(
+                ebay_items.values(),
+                update_conflicts=True,
+                unique_fields=['item_id'],
+                update_fields=['title', 'price', 'url', 'condition', 'location', 'seller', 'picture_url', 'updated_at']
+            )
+        EbayListing.objects.bulk_create(
+            listings.values(),
+            update_conflicts=True,
+            unique_fields=['product_image', 'item'],
+            update_fields=['rank', 'price', 'similarity_score', 'updated_at']
+        )
+
+
+def _set_stage(job, stage):
+    job.stage = stage
+    job.save(update_fields=['stage'])
+
+
+def _read_image(product_image):
+    with product_image.image.open('rb') as f:
+        return f.read()
+
+
+def run_vision_stage(jobs, contents=None):
+    """Annotate the images of several jobs with one batched Vision request.
+
+    ``contents`` may be passed when the image bytes are already in memory;
+    otherwise they are read from storage. Returns ``(responses, vision_call)``
+    for each job.
+    """
+    for job in jobs:
+        _set_stage(job, ProcessingJob.STAGE_VISION)
+
+    with timing.collect() as timings:
+        if contents is None:
+            with timing.stage('read_image'):
+                contents = [_read_image(job.product_image) for job in jobs]
+
+        start_time = time.time()
+        # Byte-identical uploads are served by the Vision cache
+        with timing.stage('vision'):
+            cached = [vision_api.cached_responses(job.product_image.content_hash, UPLOAD_RESPONSE_KEYS) for job in jobs]
+        results = [None if responses is None else (responses, True) for responses in cached]
+        # Near-duplicates of an earlier upload reuse its responses
+        with timing.stage('near_duplicates'):
+            for index, (job, content) in enumerate(zip(jobs, contents)):
+                if results[index] is not None:
+                    near_duplicates.assign_hash(job.product_image, content)
+                    continue
+                reused = near_duplicates.find_reusable(job.product_image, content, UPLOAD_RESPONSE_KEYS)
+                if reused:
+                    results[index] = (reused[0], True)
+        fresh = [index for index, result in enumerate(results) if result is None]
+
+        # Perform label and web detection in a single request
+        with timing.stage('vision'):
+            detected = vision_api.detect_images(
+                [(contents[index], jobs[index].product_image.content_hash) for index in fresh],
+                UPLOAD_RESPONSE_KEYS,
+                check_cache=False
+            )
+        for index, result in zip(fresh, detected):
+            results[index] = result
+        processing_time = int((time.time() - start_time) * 1000)
+
+        with timing.stage('thumbnail'):
+            for job, content in zip(jobs, contents):
+                imaging.ensure_thumbnail(job.product_image, content)
+
+    with timing.stage('db_write'):
+        return [
+            (responses, record_vision_call(
+                job.product_image, responses, job.product_image.content_hash, cache_hit, processing_time,
+                stage_timings=dict(timings)
+            ))
+            for job, (responses, cache_hit) in zip(jobs, results)
+        ]
+
+
+def _search_and_save(job, responses):
+    source_image_id = job.product_image.near_duplicate_of_id
+    if source_image_id and EbayListing.objects.filter(product_image_id=source_image_id).exists():
+        _set_stage(job, ProcessingJob.STAGE_SAVING)
+        with timing.stage('db_write'):
+            near_duplicates.copy_listings(source_image_id, job.product_image)
+        return
+
+    _set_stage(job, ProcessingJob.STAGE_SEARCH)
+    search_query = build_search_query(
+        responses['label_response'].label_annotations,
+        responses['web_response'].web_detection
+    )
+
+    # Items found for earlier uploads answer the search when enough of them match and are recent
+    with timing.stage('local_search'):
+        items = listing_index.search(search_query, SEARCH_PARAMS['paginationInput']['entriesPerPage'])
+    found_locally = items is not None
+    if not found_locally:
+        _set_stage(job, ProcessingJob.STAGE_EBAY)
+        with timing.stage('ebay_search'):
+            items = search_ebay(search_query)
+
+    scores = {}
+    if settings.LISTING_RERANK and items:
+        _set_stage(job, ProcessingJob.STAGE_RANKING)
+        with timing.stage('ranking'):
+            scores = rank_listings(job.product_image, items)
+
+    _set_stage(job, ProcessingJob.STAGE_SAVING)
+    with timing.stage('db_write'), transaction.atomic():
+        save_listings(job.product_image, items, scores, refresh_items=not found_locally)
+
+
+def run_ebay_stage(job, responses, vision_call=None):
+    with timing.collect() as timings:
+        _search_and_save(job, responses)
+
+    if vision_call is not None:
+        # Add the eBay stages to the breakdown stored with the Vision call
+        vision_call.stage_timings = {**(vision_call.stage_timings or {}), **timings}
+        VisionAPICall.objects.filter(id=vision_call.id).update(stage_timings=vision_call.stage_timings)
+
+
+def run_upload_pipeline(job, content=None):
+    """Run the Vision -> eBay pipeline for the job's image."""
+    responses, vision_call = run_vision_stage([job], None if content is None else [content])[0]
+    run_ebay_stage(job, responses, vision_call)
+
+
+def _start_job(job):
+    if job.status == ProcessingJob.STATUS_PENDING:
+        job.status = ProcessingJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=['status', 'started_at', 'attempts'])
+
+
+def _finish_job(job, error=None):
+    if error is not None:
+        job.status = ProcessingJob.STATUS_FAILED
+        job.error = str(error)
+    else:
+        job.status = ProcessingJob.STATUS_SUCCEEDED
+        job.stage = ProcessingJob.STAGE_DONE
+        job.error = None
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'stage', 'error', 'finished_at'])
+    return job
+
+
+def _finish_job_safely(job, error=None):
+    """Finish the job; if its status cannot be saved, mark it failed on a fresh connection."""
+    try:
+        _finish_job(job, error)
+    except Exception as e:
+        logger.exception('Could not save the result of job %s', job.id)
+        # The connection may be broken or stuck in a failed transaction
+        connections.close_all()
+        job.status = ProcessingJob.STATUS_FAILED
+        job.error = f'Could not save the job result: {e}'
+        ProcessingJob.objects.filter(id=job.id).update(
+            status=job.status, error=job.error, finished_at=timezone.now()
+        )
+
+
+def execute_job(job, content=None):
+    """Run a job to completion, recording success or failure on the job row."""
+    _start_job(job)
+    try:
+        run_upload_pipeline(job, content=content)
+    except Exception as e:
+        return _finish_job(job, e)
+    return _finish_job(job)
+
+
+def execute_jobs(jobs):
+    """Run several jobs with their Vision and eBay stages overlapping.
+
+    Jobs go through Vision in batches of ``vision_api.MAX_BATCH_SIZE`` on a pool
+    of ``PIPELINE_VISION_WORKERS`` threads. As soon as a batch is annotated its
+    jobs move on to the eBay stage, which runs on its own pool of
+    ``PIPELINE_EBAY_WORKERS`` threads while later batches are still in Vision.
+    """
+    for job in jobs:
+        _start_job(job)
+
+    ebay_futures = []
+    ebay_futures_lock = threading.Lock()
+
+    def ebay_task(job, responses, vision_call):
+        try:
+            run_ebay_stage(job, responses, vision_call)
+        except Exception as e:
+            _finish_job_safely(job, e)
+        else:
+            _finish_job_safely(job)
+        finally:
+            connections.close_all()
+
+    def vision_task(batch):
+        try:
+            batch_responses = run_vision_stage(batch)
+        except Exception as e:
+            for job in batch:
+                _finish_job_safely(job, e)
+            return
+        finally:
+            connections.close_all()
+
+        for job, (responses, vision_call) in zip(batch, batch_responses):
+            with ebay_futures_lock:
+                ebay_futures.append(ebay_pool.submit(ebay_task, job, responses, vision_call))
+
+    batches = [jobs[i:i + vision_api.MAX_BATCH_SIZE] for i in range(0, len(jobs), vision_api.MAX_BATCH_SIZE)]
+    with ThreadPoolExecutor(settings.PIPELINE_VISION_WORKERS, thread_name_prefix='pipeline-vision') as vision_pool, \
+            ThreadPoolExecutor(settings.PIPELINE_EBAY_WORKERS, thread_name_prefix='pipeline-ebay') as ebay_pool:
+        # All Vision batches must have handed their jobs over before the eBay pool shuts down
+        vision_futures = [vision_pool.submit(vision_task, batch) for batch in batches]
+        wait(vision_futures)
+        with ebay_futures_lock:
+            pending = list(ebay_futures)
+        wait(pending)
+
+    # Only reached when not even the failure of a job could be saved; let the worker see it
+    errors = [future.exception() for future in vision_futures + pending if future.exception() is not None]
+    for error in errors:
+        logger.error('Pipeline task failed', exc_info=error)
+    if errors:
+        raise errors[0]
+    return jobs
+
+
+def enqueue_upload(product_image, content=None):
+    job = ProcessingJob.objects.create(product_image=product_image)
+    if settings.UPLOAD_JOBS_INLINE:
+        execute_job(job, content=content)
+    return job
+
+
+def enqueue_batch(batch):
+    if settings.UPLOAD_JOBS_INLINE:
+        execute_jobs(list(batch.jobs.select_related('product_image')))
+
+
+def claim_next_job():
+    """Mark the oldest pending job as running and return it, or None if the queue is empty."""
+    while True:
+        with transaction.atomic():
+            job = (
+                ProcessingJob.objects
+                .select_for_update(skip_locked=True)
+                .filter(status=ProcessingJob.STATUS_PENDING)
+                .order_by('created_at')
+                .first()
+            )
+            if job is None:
+                return None
+
+            # The status check keeps the claim safe on databases without row locks
+            claimed = ProcessingJob.objects.filter(
+                id=job.id, status=ProcessingJob.STATUS_PENDING
+            ).update(
+                status=ProcessingJob.STATUS_RUNNING,
+                started_at=timezone.now(),
+                attempts=F('attempts') + 1
+            )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def claim_jobs(limit):
+    """Claim up to ``limit`` pending jobs, oldest first."""
+    jobs = []
+    while len(jobs) < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def requeue_stale_jobs():
+    """Put jobs whose worker died back in the queue, or fail them after too many attempts."""
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_STALE_SECONDS)
+    stale = ProcessingJob.objects.filter(status=ProcessingJob.STATUS_RUNNING, started_at__lt=cutoff)
+
+    failed = stale.filter(attempts__gte=settings.JOB_MAX_ATTEMPTS).update(
+        status=ProcessingJob.STATUS_FAILED,
+        error='Worker stopped responding',
+        finished_at=timezone.now()
+    )
+    requeued = stale.update(
+        status=ProcessingJob.STATUS_PENDING,
+        stage=ProcessingJob.STAGE_QUEUED
+    )
+    return requeued, failed
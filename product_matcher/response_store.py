@@ -0,0 +1,47 @@
+"""Content-addressed, gzip-compressed file store for raw Vision API responses.
+
+Raw responses are large (OCR and web detection especially), so instead of
+keeping them in ``VisionAPICall`` rows they are written once to
+``MEDIA_ROOT/vision_responses/`` under the SHA-256 of their canonical JSON,
+and the row only keeps that hash in ``api_response_ref``. Identical
+responses, e.g. repeated cache hits, share one file.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+from django.conf import settings
+
+STORE_DIRNAME = 'vision_responses'
+
+
+def _path(ref):
+    return os.path.join(settings.MEDIA_ROOT, STORE_DIRNAME, ref[:2], ref[2:4], f'{ref}.json.gz')
+
+
+def save(payload):
+    """Store ``payload`` and return its reference."""
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()
+    ref = hashlib.sha256(data).hexdigest()
+
+    path = _path(ref)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(data))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return ref
+
+
+def load(ref):
+    with gzip.open(_path(ref), 'rb') as f:
+        return json.loads(f.read())
+
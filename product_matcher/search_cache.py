@@ -0,0 +1,161 @@
+"""Cache for eBay keyword search results.
+
+Uploads of the same kind of product tend to produce the same search terms,
+so ``findItemsByKeywords`` results are cached under the normalized query and
+search parameters. Entries younger than ``EBAY_SEARCH_CACHE_TTL_SECONDS``
+are served as they are. Older entries are still served for up to
+``EBAY_SEARCH_CACHE_STALE_SECONDS`` longer, while a background thread
+refreshes them (stale-while-revalidate).
+
+A query that is already being fetched, by a request in this or another
+process, is not fetched again: callers wait for that result (see
+``singleflight``).
+
+The cache backend is chosen with ``EBAY_SEARCH_CACHE_BACKEND``:
+``lru`` keeps entries in a per-process LRU bounded by
+``EBAY_SEARCH_CACHE_MAX_ENTRIES``; ``django`` keeps them in the Django
+cache, which applies its own culling. They are shared between processes
+through the ``shared`` cache when ``CACHE_REDIS_URL`` configures one, and
+fall back to the per-process default cache otherwise.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from . import singleflight
+
+SEARCH_CACHE_PREFIX = 'ebay_search:'
+SHARED_CACHE_ALIAS = 'shared'
+
+
+class LRUBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DjangoCacheBackend:
+    def __init__(self):
+        self.cache = caches[SHARED_CACHE_ALIAS if SHARED_CACHE_ALIAS in settings.CACHES else 'default']
+
+    def get(self, key):
+        return self.cache.get(SEARCH_CACHE_PREFIX + key)
+
+    def set(self, key, value, timeout):
+        self.cache.set(SEARCH_CACHE_PREFIX + key, value, timeout=timeout)
+
+    def clear(self):
+        pass
+
+
+_backend = None
+_executor = None
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            if settings.EBAY_SEARCH_CACHE_BACKEND == 'django':
+                _backend = DjangoCacheBackend()
+            elif settings.EBAY_SEARCH_CACHE_BACKEND == 'lru':
+                _backend = LRUBackend(settings.EBAY_SEARCH_CACHE_MAX_ENTRIES)
+            else:
+                raise ValueError(f"Unknown EBAY_SEARCH_CACHE_BACKEND: {settings.EBAY_SEARCH_CACHE_BACKEND}")
+        return _backend
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ebay-search-refresh')
+        return _executor
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def cache_key(query, params):
+    raw = json.dumps({'keywords': query, **params}, sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _store(key, query, fetch):
+    items = singleflight.do(SEARCH_CACHE_PREFIX + key, lambda: fetch(query))
+    get_backend().set(
+        key,
+        {'items': items, 'fetched_at': time.time()},
+        settings.EBAY_SEARCH_CACHE_TTL_SECONDS + settings.EBAY_SEARCH_CACHE_STALE_SECONDS
+    )
+    return items
+
+
+def _refresh(key, query, fetch):
+    try:
+        _store(key, query, fetch)
+    except Exception as e:
+        # The stale entry keeps being served until it expires
+        print(f"Error refreshing eBay search '{query}': {str(e)}")
+    finally:
+        with _lock:
+            _refreshing.discard(key)
+        # Refresh threads are reused; do not keep a connection open in each
+        connections.close_all()
+
+
+def get_or_fetch(query, params, fetch):
+    """Return the search results for ``query``, calling ``fetch(query)`` only when needed.
+
+    ``params`` are the other search parameters, which are part of the key.
+    """
+    query = normalize_query(query)
+    if settings.EBAY_SEARCH_CACHE_TTL_SECONDS <= 0:
+        return singleflight.do(SEARCH_CACHE_PREFIX + cache_key(query, params), lambda: fetch(query))
+
+    key = cache_key(query, params)
+    entry = get_backend().get(key)
+    if entry is None:
+        return _store(key, query, fetch)
+
+    if time.time() - entry['fetched_at'] > settings.EBAY_SEARCH_CACHE_TTL_SECONDS:
+        with _lock:
+            start_refresh = key not in _refreshing
+            _refreshing.add(key)
+        if start_refresh:
+            _get_executor().submit(_refresh, key, query, fetch)
+    return entry['items']
@@ -0,0 +1,366 @@
+"""Coalescing of identical upstream calls that are in flight at the same time.
+
+When several requests need the same thing at once (the Vision responses for
+an image hash, an eBay search, an item's details), the first caller for a
+key becomes the *leader* and makes the call; the others wait for its result.
+
+* Threads of one process wait on the leader's in-memory call.
+* Processes on the same host coordinate through a lock file per key under
+  ``SINGLE_FLIGHT_LOCK_DIR``, locked with ``flock``. The leader pickles its
+  result into the file and unlinks it before unlocking, so processes queued
+  on the file read the result from it while later callers start a new file.
+  A lock held by a process that dies is released by the kernel.
+
+Followers give up after ``SINGLE_FLIGHT_WAIT_SECONDS`` and make the call
+themselves, as they do when the leader failed: errors are not shared across
+processes, so the next caller in line retries. ``do_many`` leads every key it
+can and makes a single call for all of them, which keeps Vision batching
+intact. ``ado`` and ``ado_many`` are the async versions.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: coalesce within each process only
+    fcntl = None
+
+POLL_INTERVAL_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_lock_dirs = {}  # SINGLE_FLIGHT_LOCK_DIR -> the checked directory, or None
+_calls = {}
+_NO_RESULT = object()
+
+
+class _Call:
+    """A call in progress in this process, which other threads and event loops can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = _NO_RESULT
+        self.error = None
+        self.waiters = []
+
+    def finish(self, result=_NO_RESULT, error=None):
+        self.result, self.error = result, error
+        with _lock:
+            self.done.set()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                pass  # The waiting loop has closed
+
+    async def wait_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with _lock:
+            if self.done.is_set():
+                return True
+            self.waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _check_lock_dir(configured):
+    path = configured or os.path.join(tempfile.gettempdir(), f'product_matcher-flights-{os.getuid()}')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    # Results are unpickled from these files, so nobody else may be able to write them
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logger.warning('Not coalescing calls across processes: %s is writable by other users', path)
+        return None
+    return path
+
+
+def lock_dir():
+    """Return the directory for lock files, or None if processes cannot coordinate here."""
+    if fcntl is None:
+        return None
+    configured = settings.SINGLE_FLIGHT_LOCK_DIR
+    # Checked once per process, not on every call
+    if configured not in _lock_dirs:
+        _lock_dirs[configured] = _check_lock_dir(configured)
+    return _lock_dirs[configured]
+
+
+class _LockFile:
+    def __init__(self, directory, key):
+        self.path = os.path.join(directory, hashlib.sha1(key.encode()).hexdigest())
+        self.fd = None
+
+    def try_acquire(self):
+        """Try to lock the file once.
+
+        Returns True when this process now leads the key, False while another
+        process holds the lock, or a one-element tuple with the result handed
+        off by the leader that just finished.
+        """
+        while True:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if self._is_current():
+                return True
+            # The leader unlinked the file after we opened it, leaving its result in it
+            data = b''.join(iter(lambda: os.read(self.fd, 1 << 20), b''))
+            self.close()
+            if data:
+                return (pickle.loads(data),)
+            # The leader failed; queue up on the new file
+
+    def _is_current(self):
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def release(self, result=_NO_RESULT):
+        """Hand ``result`` to the processes queued on the file, then unlock it."""
+        data = b''  # Without a result, followers make the call themselves
+        if result is not _NO_RESULT:
+            try:
+                data = pickle.dumps(result)
+            except Exception:
+                pass
+        # A leader that died may have left a result for an earlier call behind
+        os.ftruncate(self.fd, 0)
+        if data:
+            os.pwrite(self.fd, data, 0)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)  # Also releases the lock
+            self.fd = None
+
+
+def _register(keys):
+    """Split ``keys`` into calls this thread now owns and calls already in progress in this process."""
+    owned, joined = {}, {}
+    with _lock:
+        for key in keys:
+            if key in _calls:
+                joined[key] = _calls[key]
+            else:
+                owned[key] = _calls[key] = _Call()
+    return owned, joined
+
+
+def _unregister(owned):
+    with _lock:
+        for key, call in owned.items():
+            if _calls.get(key) is call:
+                del _calls[key]
+
+
+def _lead_locks(keys):
+    """Try to lock every key; return ``(locks, handed_off, busy)``."""
+    directory = lock_dir() if keys else None
+    locks, handed_off, busy = {}, {}, {}
+    for key in keys:
+        if directory is None:
+            locks[key] = None
+            continue
+        lock = _LockFile(directory, key)
+        state = lock.try_acquire()
+        if state is True:
+            locks[key] = lock
+        elif state is False:
+            busy[key] = lock
+        else:
+            handed_off[key] = state[0]
+    return locks, handed_off, busy
+
+
+def _finish(owned, results, error=None):
+    _unregister(owned)
+    for key, call in owned.items():
+        if key in results:
+            call.finish(results[key])
+        else:
+            call.finish(error=error)
+
+
+def _release(held, results):
+    """Unlock the files of the keys this process led, handing off their results; empties ``held``."""
+    for key, lock in held.items():
+        if lock is not None:
+            lock.release(results.get(key, _NO_RESULT))
+    held.clear()
+
+
+def do(key, fn):
+    """Return ``fn()``, sharing one call with the callers of the same ``key`` in flight at the same time."""
+    results, shared = do_many([key], lambda keys: {key: fn()})
+    return results[key]
+
+
+def do_many(keys, fn):
+    """Coalesce the calls for several keys, making one ``fn(keys)`` call for every key this caller leads.
+
+    ``fn`` receives the list of keys to compute and returns a dict of key ->
+    result for all of them. Returns ``(results, shared)``: the result of every
+    key, and the set of keys whose result came from another caller.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return {}, set()
+    if settings.SINGLE_FLIGHT_WAIT_SECONDS <= 0:
+        return fn(keys), set()
+
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT_SECONDS
+    owned, joined = _register(keys)
+    results, shared = {}, set()
+    held = {}
+    try:
+        held, handed_off, busy = _lead_locks(list(owned))
+        results.update(handed_off)
+        shared.update(handed_off)
+
+        # Our own calls are made before waiting on anybody else's, so callers never wait on each other in a cycle
+        if held:
+            results.update(fn(list(held)))
+            _release(held, results)
+
+        # Keys another process is computing: wait for its result, or take over if it fails
+        for key, lock in busy.items():
+            while time.monotonic() < deadline:
+                state = lock.try_acquire()
+                if state is True:
+                    held[key] = lock
+                elif state is False:
+                    time.sleep(POLL_INTERVAL_SECONDS)
+                    continue
+                else:
+                    results[key] = state[0]
+                    shared.add(key)
+                break
+            else:
+                lock.close()
+        missing = [key for key in busy if key not in results]
+        if missing:
+            results.update(fn(missing))
+        _release(held, results)
+    except BaseException as e:
+        # A cancelled or interrupted leader leaves its followers to make the call themselves
+        _finish(owned, results, e if isinstance(e, Exception) else None)
+        raise
+    finally:
+        _release(held, {})
+    _finish(owned, results)
+
+    # Calls led by other threads of this process
+    missing = []
+    for key, call in joined.items():
+        if call.done.wait(max(deadline - time.monotonic(), 0)) and call.result is not _NO_RESULT:
+            results[key] = call.result
+            shared.add(key)
+        elif call.error is not None:
+            raise call.error
+        else:
+            missing.append(key)
+    if missing:
+        results.update(fn(missing))
+    return results, shared
+
+
+async def ado(key, fn):
+    """Async version of ``do``; ``fn`` is a coroutine function."""
+    async def compute(keys):
+        return {key: await fn()}
+
+    results, shared = await ado_many([key], compute)
+    return results[key]
+
+
+async def ado_many(keys, fn):
+    """Async version of ``do_many``; ``fn`` is a coroutine function."""
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return {}, set()
+    if settings.SINGLE_FLIGHT_WAIT_SECONDS <= 0:
+        return await fn(keys), set()
+
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT_SECONDS
+    owned, joined = _register(keys)
+    results, shared = {}, set()
+    held = {}
+    try:
+        held, handed_off, busy = _lead_locks(list(owned))
+        results.update(handed_off)
+        shared.update(handed_off)
+
+        # Our own calls are made before waiting on anybody else's, so callers never wait on each other in a cycle
+        if held:
+            results.update(await fn(list(held)))
+            _release(held, results)
+
+        # Keys another process is computing: wait for its result, or take over if it fails
+        for key, lock in busy.items():
+            while time.monotonic() < deadline:
+                state = lock.try_acquire()
+                if state is True:
+                    held[key] = lock
+                elif state is False:
+                    await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                    continue
+                else:
+                    results[key] = state[0]
+                    shared.add(key)
+                break
+            else:
+                lock.close()
+        missing = [key for key in busy if key not in results]
+        if missing:
+            results.update(await fn(missing))
+        _release(held, results)
+    except BaseException as e:
+        # A cancelled or interrupted leader leaves its followers to make the call themselves
+        _finish(owned, results, e if isinstance(e, Exception) else None)
+        raise
+    finally:
+        _release(held, {})
+    _finish(owned, results)
+
+    # Calls led by other threads of this process
+    missing = []
+    for key, call in joined.items():
+        if await call.wait_async(max(deadline - time.monotonic(), 0)) and call.result is not _NO_RESULT:
+            results[key] = call.result
+            shared.add(key)
+        elif call.error is not None:
+            raise call.error
+        else:
+            missing.append(key)
+    if missing:
+        results.update(await fn(missing))
+    return results, shared
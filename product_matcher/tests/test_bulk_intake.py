@@ -0,0 +1,94 @@
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+
+from product_matcher import bulk_intake, intake
+from product_matcher.bulk_intake import create_batch
+from product_matcher.models import ProcessingJob, ProductImage, UploadBatch
+
+from .test_intake import jpeg
+
+
+def archive(members, name='photos.zip'):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for member_name, content in members.items():
+            zf.writestr(member_name, content)
+    return SimpleUploadedFile(name, buf.getvalue(), 'application/zip')
+
+
+class CreateBatchTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, BULK_UPLOAD_MAX_FILES=3)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def stored_files(self):
+        directory = os.path.join(self.media_root, 'product_images')
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def reasons(self, batch):
+        return {entry['name']: entry['reason'] for entry in batch.skipped}
+
+    def test_stores_and_queues_images_from_files_and_archives(self):
+        content = jpeg()
+        batch = create_batch(
+            [SimpleUploadedFile('a.jpg', content)],
+            [archive({'b.jpg': jpeg(exif_bytes=100), 'nested/c.png': jpeg(exif_bytes=200), '.hidden.jpg': content})]
+        )
+        self.assertEqual((batch.file_count, batch.skipped), (3, []))
+        self.assertEqual(ProcessingJob.objects.filter(batch=batch).count(), 3)
+        first = ProductImage.objects.order_by('id').first()
+        self.assertEqual(first.content_hash, intake.hashlib.sha256(content).hexdigest())
+        self.assertEqual(len(self.stored_files()), 3)
+
+    def test_skips_members_that_are_not_images_whatever_their_name(self):
+        batch = create_batch(
+            [SimpleUploadedFile('fake.jpg', b'not an image' * 50)],
+            [archive({'notes.txt': b'text', 'renamed.jpg': b'<html>' * 50, 'ok.jpg': jpeg()})]
+        )
+        self.assertEqual(batch.file_count, 1)
+        self.assertEqual(self.reasons(batch), {
+            'fake.jpg': 'The uploaded file is not a supported image',
+            'notes.txt': 'Not an image file',
+            'renamed.jpg': 'The uploaded file is not a supported image',
+        })
+
+    def test_members_are_decompressed_up_to_the_size_limit(self):
+        batch = create_batch([], [archive({'bomb.jpg': b'\0' * (7 * 1024 * 1024)})])
+        self.assertEqual(self.reasons(batch), {'bomb.jpg': 'Larger than 6MB'})
+
+        # Sizes declared in the archive are not trusted
+        with mock.patch.object(bulk_intake, '_rejection_reason', return_value=None), \
+                mock.patch.object(intake, 'MAX_UPLOAD_BYTES', 1000):
+            batch = create_batch([], [archive({'big.jpg': jpeg(exif_bytes=2000)})])
+        self.assertEqual(batch.file_count, 0)
+        self.assertIn('maximum file size', self.reasons(batch)['big.jpg'])
+
+    def test_bad_archive_and_batch_limit(self):
+        batch = create_batch(
+            [SimpleUploadedFile(f'{n}.jpg', jpeg()) for n in range(4)],
+            [SimpleUploadedFile('broken.zip', b'not a zip')]
+        )
+        self.assertEqual(batch.file_count, 3)
+        self.assertEqual(self.reasons(batch), {
+            '3.jpg': 'Batch limit of 3 files reached',
+            'broken.zip': 'Not a valid zip archive',
+        })
+
+    def test_rollback_deletes_the_stored_files(self):
+        with mock.patch.object(ProcessingJob.objects, 'create', side_effect=[mock.DEFAULT, RuntimeError('db down')]):
+            with self.assertRaises(RuntimeError):
+                create_batch([SimpleUploadedFile(f'{n}.jpg', jpeg()) for n in range(2)], [])
+        self.assertFalse(UploadBatch.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+        self.assertFalse(default_storage.exists('product_images/0.jpg'))
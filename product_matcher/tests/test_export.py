@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from product_matcher import export
+from product_matcher.export import HistoryExport
+from product_matcher.models import (
+    EbayItem, EbayListing, ExportCheckpoint, ProcessingJob, ProductImage, VisionAPICall
+)
+
+
+@override_settings(EXPORT_SETTLE_SECONDS=60)
+class HistoryExportTests(TestCase):
+    def setUp(self):
+        self.uploaded_at = timezone.now() - timedelta(days=1)
+        # Uploads of one bulk batch share a timestamp
+        self.images = [self.add_image() for _ in range(7)]
+        item = EbayItem.objects.create(
+            item_id='1', title='Cordless drill', price=Decimal('20.00'), url='https://www.ebay.com/itm/1',
+            condition='Used', location='US', seller='seller'
+        )
+        EbayListing.objects.create(product_image=self.images[0], item=item, rank=0, price=Decimal('19.50'))
+        VisionAPICall.objects.create(
+            product_image=self.images[0], request_timestamp=self.uploaded_at,
+            labels=[{'description': 'Old', 'score': 0.5}], text=[]
+        )
+        VisionAPICall.objects.create(
+            product_image=self.images[0], request_timestamp=self.uploaded_at + timedelta(minutes=1),
+            labels=[{'description': 'Drill', 'score': 0.9}, {'description': 'Tool', 'score': 0.8}],
+            text=[{'description': 'DEWALT\n20V', 'locale': 'en'}, {'description': 'DEWALT', 'locale': None}]
+        )
+
+    def add_image(self, status=ProcessingJob.STATUS_SUCCEEDED, uploaded_at=None):
+        image = ProductImage.objects.create(image='product_images/a.jpg', uploaded_at=uploaded_at or self.uploaded_at)
+        ProcessingJob.objects.create(product_image=image, status=status)
+        return image
+
+    def read(self, **filters):
+        result = HistoryExport(**filters)
+        return result, ''.join(result.chunks())
+
+    def image_ids(self, **filters):
+        result, body = self.read(format='ndjson', **filters)
+        return result, [json.loads(line)['image_id'] for line in body.splitlines()]
+
+    def test_csv_has_one_row_per_listing_or_image(self):
+        result, body = self.read()
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual(len(rows), 7)
+        first = rows[0]
+        self.assertEqual(first['image_id'], str(self.images[0].id))
+        self.assertEqual(first['labels'], 'Drill; Tool')
+        self.assertEqual(first['text'], 'DEWALT\n20V')
+        self.assertEqual((first['title'], first['price'], first['current_price']), ('Cordless drill', '19.50', '20.00'))
+        self.assertEqual(rows[1]['item_id'], '')
+        self.assertEqual(result.cursor, self.images[-1].id)
+
+    def test_ndjson_nests_the_vision_call_and_listings(self):
+        result, body = self.read(format='ndjson')
+        first = json.loads(body.splitlines()[0])
+        self.assertEqual(first['vision_call']['labels'][0]['description'], 'Drill')
+        self.assertEqual(first['listings'][0]['price'], '19.50')
+        self.assertIsNone(json.loads(body.splitlines()[1])['vision_call'])
+
+    def test_batches_cover_tied_timestamps_without_gaps(self):
+        with mock.patch.object(export, 'BATCH_SIZE', 2), mock.patch.object(export, 'CHUNK_BYTES', 1):
+            result, ids = self.image_ids()
+        self.assertEqual(ids, [image.id for image in self.images])
+
+    def test_stops_before_unfinished_uploads(self):
+        pending = self.add_image(status=ProcessingJob.STATUS_PENDING)
+        later = self.add_image()
+        result, ids = self.image_ids()
+        self.assertEqual(result.cursor, self.images[-1].id)
+        self.assertNotIn(pending.id, ids)
+        self.assertNotIn(later.id, ids)
+
+    def test_stops_before_recent_uploads(self):
+        self.add_image(uploaded_at=timezone.now())
+        result, ids = self.image_ids()
+        self.assertEqual(ids[-1], self.images[-1].id)
+
+    def test_after_continues_from_the_cursor(self):
+        first, first_ids = self.image_ids()
+        added = [self.add_image() for _ in range(3)]
+        second, second_ids = self.image_ids(after=first.cursor)
+        self.assertEqual(second_ids, [image.id for image in added])
+        _, none = self.image_ids(after=second.cursor)
+        self.assertEqual(none, [])
+
+    def test_checkpoint_moves_only_after_a_complete_export(self):
+        abandoned = HistoryExport(format='ndjson', checkpoint='tool')
+        next(abandoned.chunks())
+        self.assertEqual(ExportCheckpoint.objects.get(name='tool').last_image_id, 0)
+
+        result, ids = self.image_ids(checkpoint='tool')
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(ExportCheckpoint.objects.get(name='tool').last_image_id, result.cursor)
+        added = self.add_image()
+        _, ids = self.image_ids(checkpoint='tool')
+        self.assertEqual(ids, [added.id])
+
+    def test_checkpoint_is_kept_per_format_and_date_range(self):
+        other_day = self.add_image(uploaded_at=self.uploaded_at - timedelta(days=2))
+        until = (self.uploaded_at - timedelta(days=1)).date().isoformat()
+        _, ids = self.image_ids(checkpoint='tool', until=until)
+        self.assertEqual(ids, [other_day.id])
+
+        # The bounded export must not make an unbounded one under the same name skip the other images
+        _, ids = self.image_ids(checkpoint='tool')
+        self.assertEqual(len(ids), 8)
+        _, body = self.read(format='csv', checkpoint='tool')
+        self.assertEqual(len(list(csv.DictReader(io.StringIO(body)))), 8)
+        _, ids = self.image_ids(checkpoint='tool', until=until)
+        self.assertEqual(ids, [])
+        self.assertEqual(ExportCheckpoint.objects.filter(name='tool').count(), 3)
+
+    def test_date_range(self):
+        other_day = self.add_image(uploaded_at=self.uploaded_at - timedelta(days=2))
+        day = self.uploaded_at.date().isoformat()
+        _, ids = self.image_ids(since=day, until=day)
+        self.assertNotIn(other_day.id, ids)
+        self.assertEqual(len(ids), 7)
+        _, ids = self.image_ids(until=(self.uploaded_at - timedelta(seconds=1)).isoformat())
+        self.assertEqual(ids, [other_day.id])
+
+    def test_invalid_filters(self):
+        for filters in ({'format': 'xml'}, {'since': 'yesterday'}, {'after': 'x'}, {'after': '1', 'checkpoint': 'a'}):
+            with self.subTest(filters=filters), self.assertRaises(ValueError):
+                HistoryExport(**filters)
+
+    def test_endpoint_streams_with_the_cursor(self):
+        response = self.client.get('/export/', {'format': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['X-Export-Cursor'], str(self.images[-1].id))
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 7)
+        self.assertEqual(self.client.get('/export/', {'since': 'nope'}).status_code, 400)
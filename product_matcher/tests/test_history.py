@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from product_matcher.history import decode_cursor, encode_cursor, get_history_page
+from product_matcher.models import ProductImage
+
+
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # Several uploads share a timestamp, as bulk uploads do
+        self.images = ProductImage.objects.bulk_create([
+            ProductImage(image=f'product_images/{i}.jpg', uploaded_at=now - timedelta(seconds=i // 4))
+            for i in range(23)
+        ])
+        self.newest_first = list(ProductImage.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True))
+
+    def ids(self, page):
+        return [item['image'].id for item in page['items']]
+
+    def test_older_pages_cover_every_image_once(self):
+        seen, page = [], get_history_page(page_size=5)
+        self.assertFalse(page['has_newer'])
+        while True:
+            seen.extend(self.ids(page))
+            if not page['has_older']:
+                break
+            page = get_history_page(cursor=page['older_cursor'], page_size=5)
+        self.assertEqual(seen, self.newest_first)
+
+    def test_newer_pages_walk_back(self):
+        pages = [get_history_page(page_size=5)]
+        while pages[-1]['has_older']:
+            pages.append(get_history_page(cursor=pages[-1]['older_cursor'], page_size=5))
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = get_history_page(cursor=page['newer_cursor'], direction='newer', page_size=5)
+            self.assertEqual(self.ids(page), self.ids(expected))
+        self.assertFalse(page['has_newer'])
+
+    def test_cursor_round_trip(self):
+        image = self.images[0]
+        self.assertEqual(decode_cursor(encode_cursor(image)), (image.uploaded_at, image.id))
+
+    def test_malformed_cursor_starts_from_the_newest(self):
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        self.assertEqual(self.ids(get_history_page(cursor='not-a-cursor', page_size=5)), self.newest_first[:5])
+
+    def test_constant_number_of_queries(self):
+        with self.assertNumQueries(3):
+            get_history_page(page_size=10)
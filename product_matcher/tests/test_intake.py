@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import io
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image
+
+from product_matcher import intake, views
+from product_matcher.models import ProcessingJob, ProductImage
+
+
+def jpeg(exif_bytes=0, icc_bytes=0):
+    buf = io.BytesIO()
+    options = {}
+    if exif_bytes:
+        exif = Image.Exif()
+        exif[0x010e] = 'x' * exif_bytes  # ImageDescription
+        options['exif'] = exif.tobytes()
+    if icc_bytes:
+        options['icc_profile'] = b'\0' * icc_bytes
+    Image.new('RGB', (32, 24), (200, 30, 30)).save(buf, 'JPEG', **options)
+    return buf.getvalue()
+
+
+def stream(content):
+    image_stream = intake.ImageStream()
+    for offset in range(0, len(content), intake.CHUNK_SIZE):
+        image_stream.write(content[offset:offset + intake.CHUNK_SIZE])
+    image_stream.close()
+    return image_stream
+
+
+class ImageStreamTests(SimpleTestCase):
+    def test_accepts_an_image_and_hashes_it(self):
+        content = jpeg()
+        image_stream = stream(content)
+        self.assertEqual(image_stream.buffer.getvalue(), content)
+        self.assertEqual(image_stream.content_hash, intake.hashlib.sha256(content).hexdigest())
+
+    def test_accepts_metadata_longer_than_the_first_chunk(self):
+        content = jpeg(exif_bytes=60000, icc_bytes=8000)
+        self.assertGreater(len(content), intake.CHUNK_SIZE)
+        self.assertTrue(stream(content).identified)
+
+    def test_identifies_the_header_at_doubling_sizes(self):
+        content = jpeg(exif_bytes=60000, icc_bytes=60000)
+        image_stream = intake.ImageStream()
+        with mock.patch.object(image_stream, '_identify', wraps=image_stream._identify) as identify:
+            for offset in range(0, len(content), 1024):
+                image_stream.write(content[offset:offset + 1024])
+            image_stream.close()
+        self.assertTrue(image_stream.identified)
+        # Tried after 1, 2, 4, ... KB rather than after every chunk
+        self.assertLessEqual(identify.call_count, 8)
+        self.assertEqual(image_stream.buffer.getvalue(), content)
+
+    def test_rejects_a_file_that_is_not_an_image(self):
+        with self.assertRaisesMessage(intake.RejectedUpload, 'not a supported image'):
+            stream(b'plain text, not an image' * 10)
+
+    def test_rejects_a_long_file_that_is_not_an_image(self):
+        image_stream = intake.ImageStream()
+        with self.assertRaisesMessage(intake.RejectedUpload, 'not a supported image'):
+            for _ in range(intake.MAX_HEADER_BYTES // intake.CHUNK_SIZE + 1):
+                image_stream.write(b'\0' * intake.CHUNK_SIZE)
+
+    def test_rejects_oversized_uploads(self):
+        with mock.patch.object(intake, 'MAX_UPLOAD_BYTES', 1000):
+            with self.assertRaisesMessage(intake.RejectedUpload, 'maximum file size'):
+                stream(jpeg(exif_bytes=2000))
+
+
+class Base64Tests(SimpleTestCase):
+    def test_decodes_a_data_url(self):
+        content = jpeg(exif_bytes=60000)
+        data = 'data:image/jpeg;base64,' + base64.b64encode(content).decode()
+        decoded, content_hash = intake.decode_base64_image(data)
+        self.assertEqual(decoded, content)
+        self.assertEqual(content_hash, intake.hashlib.sha256(content).hexdigest())
+
+    def test_ignores_line_breaks_and_spaces(self):
+        content = jpeg(exif_bytes=60000, icc_bytes=60000)
+        encoded = base64.encodebytes(content).decode()  # Wrapped at 76 characters
+        self.assertGreater(len(encoded), intake.CHUNK_SIZE // 3 * 4)
+        decoded, content_hash = intake.decode_base64_image(f'data:image/jpeg;base64, {encoded}\n')
+        self.assertEqual(decoded, content)
+
+    def test_rejects_invalid_base64(self):
+        with self.assertRaisesMessage(intake.RejectedUpload, 'not valid base64'):
+            intake.decode_base64_image('data:image/jpeg;base64,@@@@')
+
+    def test_rejects_empty_data(self):
+        with self.assertRaisesMessage(intake.RejectedUpload, 'empty'):
+            intake.decode_base64_image('data:image/jpeg;base64,')
+
+
+class UploadViewTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, UPLOAD_JOBS_INLINE=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_queues_a_valid_upload(self):
+        content = jpeg(exif_bytes=60000, icc_bytes=8000)
+        response = self.client.post('/upload/', {'image': SimpleUploadedFile('photo.jpg', content, 'image/jpeg')})
+        product_image = ProductImage.objects.get()
+        self.assertRedirects(response, f'/results/{product_image.id}/', fetch_redirect_response=False)
+        self.assertEqual(product_image.content_hash, intake.hashlib.sha256(content).hexdigest())
+        self.assertEqual(ProcessingJob.objects.get().product_image, product_image)
+
+    def test_rejects_a_file_that_is_not_an_image(self):
+        response = self.client.post('/upload/', {'image': SimpleUploadedFile('photo.jpg', b'garbage' * 100)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'The uploaded file is not a supported image'})
+        self.assertFalse(ProductImage.objects.exists())
+
+    def test_reads_the_upload_off_the_event_loop(self):
+        def read_upload(uploaded_file):
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return intake.read_upload(uploaded_file)
+
+        with mock.patch.object(views, 'read_upload', side_effect=read_upload) as patched:
+            response = self.client.post('/upload/', {'image': SimpleUploadedFile('photo.jpg', jpeg(), 'image/jpeg')})
+        self.assertEqual(response.status_code, 302)
+        patched.assert_called_once()
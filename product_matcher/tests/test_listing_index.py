@@ -0,0 +1,64 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from product_matcher import listing_index
+from product_matcher.listing_index import ListingIndex
+from product_matcher.models import EbayItem, ProductImage, VisionAPICall
+from product_matcher.pipeline import save_listings
+
+from .test_pipeline import search_item
+
+
+def labelled_image(name, *labels):
+    image = ProductImage.objects.create(image=f'product_images/{name}.jpg')
+    VisionAPICall.objects.create(product_image=image, labels=[{'description': label} for label in labels])
+    return image
+
+
+@override_settings(LOCAL_SEARCH_MIN_SCORE=0.5, LOCAL_SEARCH_INDEX_REBUILD_SECONDS=3600)
+class ListingIndexTests(TestCase):
+    def setUp(self):
+        self.index = ListingIndex()
+
+    def item_ids(self, query, **kwargs):
+        return [item_id for score, item_id in self.index.search(query, **kwargs)]
+
+    def test_title_words_rank_above_label_words(self):
+        save_listings(labelled_image('a', 'Cordless drill'), [search_item('1', title='Makita cordless drill')])
+        save_listings(labelled_image('b', 'Cordless drill'), [search_item('2', title='Makita battery pack')])
+        save_listings(labelled_image('c'), [search_item('3', title='Garden hose')])
+        matches = self.index.search('makita cordless drill')
+        self.assertEqual([item_id for score, item_id in matches], ['1', '2'])
+        self.assertEqual(matches[0][0], 1.0)
+        self.assertLess(matches[1][0], 1.0)
+        self.assertEqual(self.item_ids('the of'), [])
+
+    def test_leaves_out_items_not_returned_recently(self):
+        save_listings(labelled_image('a'), [search_item('1', title='Cordless drill'), search_item('2', title='Cordless drill kit')])
+        EbayItem.objects.filter(item_id='1').update(updated_at=timezone.now() - timedelta(days=1))
+        self.index = ListingIndex()
+        self.assertEqual(self.item_ids('cordless drill', fresh_since=timezone.now() - timedelta(hours=1)), ['2'])
+
+    def test_sync_picks_up_new_items_and_labels(self):
+        save_listings(labelled_image('a'), [search_item('1', title='Hammer')])
+        self.assertEqual(self.item_ids('hammer'), ['1'])
+        built_at = self.index.built_at
+
+        save_listings(labelled_image('b', 'Claw hammer'), [search_item('1', title='Hammer'), search_item('2', title='Mallet')])
+        save_listings(labelled_image('c'), [search_item('3', title='Rubber mallet', price='4.00')])
+        self.assertEqual(self.item_ids('mallet'), ['2', '3'])
+        # Item 1 gained the labels of the second image it was matched to
+        self.assertEqual(self.item_ids('claw hammer'), ['1', '2'])
+        self.assertEqual(self.index.built_at, built_at)
+
+    def test_rebuilds_in_batches(self):
+        for n in range(5):
+            save_listings(labelled_image(str(n), f'Label{n}'), [search_item(str(n), title=f'Wrench {n}')])
+        with mock.patch.object(listing_index, 'BATCH_SIZE', 2), self.assertNumQueries(3 + 3 * 2):
+            # Three batches of items, and three batches of listings with their labels
+            self.index.sync()
+        self.assertEqual(len(self.index.updated_at), 5)
+        self.assertEqual(self.item_ids('wrench label4'), ['4'])
@@ -0,0 +1,104 @@
+import io
+import random
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image, ImageDraw
+
+from product_matcher import near_duplicates, vision_api, vision_cache
+from product_matcher.models import ProcessingJob, ProductImage, VisionAPICall
+from product_matcher.near_duplicates import BKTree, hamming_distance
+from product_matcher.pipeline import UPLOAD_RESPONSE_KEYS, run_vision_stage
+
+
+def photo_jpeg(quality=90):
+    rng = random.Random(1)
+    image = Image.new('RGB', (160, 120), (240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(140), rng.randrange(100)
+        draw.rectangle([x, y, x + rng.randrange(10, 60), y + rng.randrange(10, 60)], fill=tuple(rng.randrange(256) for _ in 'rgb'))
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+class BKTreeTests(SimpleTestCase):
+    def test_matches_a_linear_scan(self):
+        rng = random.Random(0)
+        hashes = [rng.getrandbits(64) for _ in range(300)]
+        # Near copies of some of them, and an exact duplicate
+        hashes += [value ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)) for value in hashes[:50]]
+        hashes.append(hashes[0])
+
+        tree = BKTree()
+        for image_id, value in enumerate(hashes):
+            tree.add(value, image_id)
+        self.assertEqual(tree.size, len(hashes))
+
+        for query in hashes[:20] + [rng.getrandbits(64) for _ in range(20)]:
+            for max_distance in (0, 3, 10):
+                expected = sorted(
+                    (hamming_distance(query, value), image_id) for image_id, value in enumerate(hashes)
+                    if hamming_distance(query, value) <= max_distance
+                )
+                self.assertEqual(tree.search(query, max_distance), expected)
+
+    def test_empty_tree(self):
+        self.assertEqual(BKTree().search(0, 64), [])
+
+
+@override_settings(NEAR_DUPLICATE_REUSE=True, NEAR_DUPLICATE_MAX_DISTANCE=6, VISION_CACHE_EVICT_EVERY=0)
+class ReuseTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        patcher = mock.patch.object(near_duplicates, 'index', near_duplicates.NearDuplicateIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.content = photo_jpeg()
+        self.original = self.upload(self.content)
+        near_duplicates.assign_hash(self.original, self.content)
+        VisionAPICall.objects.create(
+            product_image=self.original,
+            api_response={key: {'labelAnnotations': [{'description': 'Drill'}]} for key in UPLOAD_RESPONSE_KEYS},
+            content_hash=self.original.content_hash,
+        )
+
+    def upload(self, content):
+        return ProductImage.objects.create(
+            image=ContentFile(content, name='photo.jpg'), content_hash=vision_cache.hash_image_bytes(content)
+        )
+
+    def run_vision(self, product_image, content):
+        job = ProcessingJob.objects.create(product_image=product_image)
+        with mock.patch.object(vision_api, 'annotate_images') as annotate_images:
+            (responses, vision_call), = run_vision_stage([job], [content])
+        annotate_images.assert_not_called()
+        product_image.refresh_from_db()
+        return vision_call
+
+    def test_byte_identical_upload_is_a_vision_cache_hit(self):
+        copy = self.upload(self.content)
+        vision_call = self.run_vision(copy, self.content)
+        self.assertTrue(vision_call.cache_hit)
+        self.assertIsNone(copy.near_duplicate_of_id)
+        self.assertEqual(copy.perceptual_hash, self.original.perceptual_hash)
+        self.assertEqual(vision_cache.get_stats()['hits'], 1)
+
+    def test_similar_upload_reuses_the_near_duplicate(self):
+        content = photo_jpeg(quality=60)
+        similar = self.upload(content)
+        vision_call = self.run_vision(similar, content)
+        self.assertTrue(vision_call.cache_hit)
+        self.assertEqual(similar.near_duplicate_of_id, self.original.id)
+        self.assertEqual(vision_cache.get_stats(), {'hits': 0, 'misses': 1, 'hit_rate': 0.0})
@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from product_matcher.models import EbayItem, EbayListing, ProcessingJob, ProductImage
+from product_matcher.page_cache import results_version
+from product_matcher.pipeline import save_listings
+
+from .test_pipeline import search_item
+
+
+class ResultsVersionTests(TestCase):
+    def setUp(self):
+        self.image = ProductImage.objects.create(image='product_images/a.jpg')
+        save_listings(self.image, [search_item('1'), search_item('2')])
+        # Back-date the rows so that saving again lands on a later timestamp
+        earlier = timezone.now() - timedelta(minutes=5)
+        EbayListing.objects.update(updated_at=earlier)
+        EbayItem.objects.update(updated_at=earlier)
+
+    def etag(self):
+        return results_version(self.image.id).etag
+
+    def test_unknown_image_has_no_version(self):
+        self.assertIsNone(results_version(self.image.id + 1))
+
+    def test_version_is_stable_while_nothing_changes(self):
+        self.assertEqual(self.etag(), self.etag())
+
+    def test_listings_updated_in_place_change_the_version(self):
+        before = results_version(self.image.id)
+        # Same items, same count, new ranks and scores
+        save_listings(self.image, [search_item('2'), search_item('1')], scores={'1': 0.5}, refresh_items=False)
+        after = results_version(self.image.id)
+        self.assertNotEqual(after.etag, before.etag)
+        self.assertGreater(after.last_modified, before.last_modified)
+
+    def test_item_refreshed_by_another_search_changes_the_version(self):
+        before = self.etag()
+        other_image = ProductImage.objects.create(image='product_images/b.jpg')
+        save_listings(other_image, [search_item('1', price='7.00')])
+        self.assertNotEqual(self.etag(), before)
+
+    def test_job_stage_changes_the_version_without_a_last_modified(self):
+        job = ProcessingJob.objects.create(product_image=self.image, status=ProcessingJob.STATUS_RUNNING)
+        before = self.etag()
+        job.stage = ProcessingJob.STAGE_EBAY
+        job.save(update_fields=['stage'])
+        version = results_version(self.image.id)
+        self.assertNotEqual(version.etag, before)
+        self.assertIsNone(version.last_modified)
@@ -0,0 +1,140 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from product_matcher import pipeline
+from product_matcher.listing_index import as_search_item
+from product_matcher.models import EbayItem, EbayListing, ProcessingJob, ProductImage
+from product_matcher.pipeline import claim_jobs, claim_next_job, requeue_stale_jobs, save_listings
+
+
+def search_item(item_id, price='10.00', title=None):
+    return as_search_item(EbayItem(
+        item_id=item_id, title=title or f'Drill {item_id}', price=Decimal(price), url=f'https://www.ebay.com/itm/{item_id}',
+        condition='Used', location='US', seller='seller', picture_url=''
+    ))
+
+
+class SaveListingsTests(TestCase):
+    def setUp(self):
+        self.image = ProductImage.objects.create(image='product_images/a.jpg')
+        self.other_image = ProductImage.objects.create(image='product_images/b.jpg')
+
+    def listings(self, image):
+        return list(image.ebay_listings.order_by('rank').values_list('item_id', 'rank', 'price', 'similarity_score'))
+
+    def test_stores_items_once_and_links_them(self):
+        save_listings(self.image, [search_item('1'), search_item('2')], scores={'2': 0.75})
+        save_listings(self.other_image, [search_item('2')])
+        self.assertEqual(EbayItem.objects.count(), 2)
+        self.assertEqual(self.listings(self.image), [('1', 0, Decimal('10.00'), None), ('2', 1, Decimal('10.00'), 0.75)])
+        self.assertEqual(self.listings(self.other_image), [('2', 0, Decimal('10.00'), None)])
+
+    def test_saving_again_updates_in_place(self):
+        save_listings(self.image, [search_item('1'), search_item('2')])
+        save_listings(self.image, [search_item('2', price='8.00', title='Drill, new title'), search_item('1')])
+        self.assertEqual(EbayListing.objects.count(), 2)
+        self.assertEqual(self.listings(self.image), [('2', 0, Decimal('8.00'), None), ('1', 1, Decimal('10.00'), None)])
+        item = EbayItem.objects.get(item_id='2')
+        self.assertEqual((item.title, item.price), ('Drill, new title', Decimal('8.00')))
+
+    def test_repeated_item_keeps_its_first_position(self):
+        save_listings(self.image, [search_item('1'), search_item('2'), search_item('1')])
+        self.assertEqual([row[:2] for row in self.listings(self.image)], [('1', 0), ('2', 1)])
+
+    def test_local_results_do_not_refresh_items(self):
+        save_listings(self.image, [search_item('1')])
+        updated_at = EbayItem.objects.get().updated_at
+        save_listings(self.other_image, [search_item('1', price='5.00')], refresh_items=False)
+        item = EbayItem.objects.get()
+        self.assertEqual((item.price, item.updated_at), (Decimal('10.00'), updated_at))
+        self.assertEqual(self.listings(self.other_image), [('1', 0, Decimal('5.00'), None)])
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.image = ProductImage.objects.create(image='product_images/a.jpg')
+
+    def job(self, age=0, **fields):
+        return ProcessingJob.objects.create(
+            product_image=self.image, created_at=timezone.now() - timedelta(seconds=age), **fields
+        )
+
+    def test_claims_the_oldest_pending_job(self):
+        newer = self.job(age=10)
+        older = self.job(age=20)
+        self.job(age=30, status=ProcessingJob.STATUS_RUNNING)
+        job = claim_next_job()
+        self.assertEqual(job.id, older.id)
+        self.assertEqual((job.status, job.attempts), (ProcessingJob.STATUS_RUNNING, 1))
+        self.assertIsNotNone(job.started_at)
+        self.assertEqual(claim_next_job().id, newer.id)
+        self.assertIsNone(claim_next_job())
+
+    def test_claims_up_to_the_limit(self):
+        for age in range(3):
+            self.job(age=age)
+        self.assertEqual(len(claim_jobs(2)), 2)
+        self.assertEqual(len(claim_jobs(2)), 1)
+        self.assertEqual(claim_jobs(2), [])
+
+    @override_settings(JOB_STALE_SECONDS=60, JOB_MAX_ATTEMPTS=2)
+    def test_requeues_stale_jobs_and_fails_them_after_too_many_attempts(self):
+        stale_start = timezone.now() - timedelta(seconds=120)
+        retried = self.job(status=ProcessingJob.STATUS_RUNNING, stage=ProcessingJob.STAGE_EBAY,
+                           started_at=stale_start, attempts=1)
+        exhausted = self.job(status=ProcessingJob.STATUS_RUNNING, started_at=stale_start, attempts=2)
+        running = self.job(status=ProcessingJob.STATUS_RUNNING, started_at=timezone.now(), attempts=1)
+        self.assertEqual(requeue_stale_jobs(), (1, 1))
+
+        retried.refresh_from_db()
+        self.assertEqual((retried.status, retried.stage), (ProcessingJob.STATUS_PENDING, ProcessingJob.STAGE_QUEUED))
+        exhausted.refresh_from_db()
+        self.assertEqual((exhausted.status, exhausted.error), (ProcessingJob.STATUS_FAILED, 'Worker stopped responding'))
+        running.refresh_from_db()
+        self.assertEqual(running.status, ProcessingJob.STATUS_RUNNING)
+
+
+class ExecuteJobsTests(TransactionTestCase):
+    def setUp(self):
+        image = ProductImage.objects.create(image='product_images/a.jpg')
+        self.jobs = [ProcessingJob.objects.create(product_image=image) for _ in range(2)]
+        for patcher in (
+            mock.patch.object(pipeline, 'run_vision_stage', side_effect=lambda batch: [({}, None)] * len(batch)),
+            mock.patch.object(pipeline, 'run_ebay_stage'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def statuses(self):
+        return [ProcessingJob.objects.get(id=job.id).status for job in self.jobs]
+
+    def test_jobs_succeed(self):
+        pipeline.execute_jobs(self.jobs)
+        self.assertEqual(self.statuses(), [ProcessingJob.STATUS_SUCCEEDED] * 2)
+
+    def test_job_whose_result_cannot_be_saved_is_marked_failed(self):
+        finish_job = pipeline._finish_job
+
+        def flaky_finish(job, error=None):
+            if job.id == self.jobs[0].id:
+                raise DatabaseError('connection lost')
+            return finish_job(job, error)
+
+        with mock.patch.object(pipeline, '_finish_job', side_effect=flaky_finish), \
+                self.assertLogs('product_matcher.pipeline', 'ERROR'):
+            pipeline.execute_jobs(self.jobs)
+        self.assertEqual(self.statuses(), [ProcessingJob.STATUS_FAILED, ProcessingJob.STATUS_SUCCEEDED])
+        self.assertEqual(self.jobs[0].status, ProcessingJob.STATUS_FAILED)
+        self.assertIn('connection lost', ProcessingJob.objects.get(id=self.jobs[0].id).error)
+
+    def test_task_errors_reach_the_caller(self):
+        with mock.patch.object(pipeline, '_finish_job', side_effect=DatabaseError('connection lost')), \
+                mock.patch.object(ProcessingJob.objects, 'filter', side_effect=DatabaseError('database is down')), \
+                self.assertLogs('product_matcher.pipeline', 'ERROR'):
+            with self.assertRaisesMessage(DatabaseError, 'database is down'):
+                pipeline.execute_jobs(self.jobs)
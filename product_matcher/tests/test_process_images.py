@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from product_matcher.management.commands import process_images
+from product_matcher.models import ProductImage
+
+from .test_intake import jpeg
+
+
+class ProcessImagesTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=os.path.join(self.directory, 'media'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        process_images._limiter = process_images.RateLimiter(0)
+        self.path = os.path.join(self.directory, 'drill.jpg')
+        with open(self.path, 'wb') as f:
+            f.write(jpeg())
+
+    def load_checkpoint(self, *entries, retry_failed=False):
+        path = os.path.join(self.directory, process_images.CHECKPOINT_FILENAME)
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(entry) + '\n' for entry in entries)
+            f.write('{"path": "partial')
+        return process_images.Command()._load_checkpoint(path, retry_failed)
+
+    def test_checkpoint_separates_done_and_interrupted_paths(self):
+        done, interrupted = self.load_checkpoint(
+            {'path': 'a.jpg', 'status': 'started', 'at': 1},
+            {'path': 'a.jpg', 'status': 'ok'},
+            {'path': 'b.jpg', 'status': 'started', 'at': 2},
+            {'path': 'c.jpg', 'status': 'started', 'at': 3},
+            {'path': 'c.jpg', 'status': 'failed', 'error': 'quota'},
+            {'path': 'b.jpg', 'status': 'started', 'at': 4},
+        )
+        self.assertEqual(done, {'a.jpg', 'c.jpg'})
+        self.assertEqual(interrupted, {'b.jpg': 2})
+
+    def test_retry_failed_reprocesses_failures(self):
+        done, interrupted = self.load_checkpoint({'path': 'c.jpg', 'status': 'failed', 'error': 'quota'}, retry_failed=True)
+        self.assertEqual((done, interrupted), (set(), {}))
+
+    @mock.patch('product_matcher.analysis.analyze_image', return_value={'labels': [], 'web_matches': {'ebay_listings': []}})
+    def test_resuming_an_interrupted_image_reuses_its_row(self, analyze_image):
+        started = time.time() - 1
+        first = process_images._process_file(self.path, 'drill.jpg')
+        self.assertEqual(first['status'], 'ok')
+        resumed = process_images._process_file(self.path, 'drill.jpg', started_before=started)
+        self.assertEqual(resumed['image_id'], first['image_id'])
+        self.assertEqual(ProductImage.objects.count(), 1)
+
+        # Images stored before the interrupted run started are not taken for its own
+        again = process_images._process_file(self.path, 'drill.jpg', started_before=time.time() + 1)
+        self.assertNotEqual(again['image_id'], first['image_id'])
+        self.assertEqual(analyze_image.call_count, 3)
@@ -0,0 +1,89 @@
+import threading
+from contextlib import contextmanager
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from product_matcher import search_cache
+
+
+@override_settings(
+    EBAY_SEARCH_CACHE_BACKEND='lru',
+    EBAY_SEARCH_CACHE_TTL_SECONDS=60,
+    EBAY_SEARCH_CACHE_STALE_SECONDS=600,
+    EBAY_SEARCH_CACHE_MAX_ENTRIES=2,
+)
+class SearchCacheTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(search_cache, '_backend', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1000.0
+        clock = mock.patch.object(search_cache.time, 'time', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    @contextmanager
+    def refresh_done(self):
+        done = threading.Event()
+        with mock.patch.object(search_cache.connections, 'close_all', side_effect=done.set):
+            yield done
+
+    def fetch(self, results):
+        return mock.Mock(side_effect=lambda query: [f'{query} {result}' for result in results])
+
+    def test_normalizes_the_query_and_serves_fresh_entries(self):
+        fetch = self.fetch(['a'])
+        self.assertEqual(search_cache.get_or_fetch('Cordless  DRILL', {'page': 1}, fetch), ['cordless drill a'])
+        self.assertEqual(search_cache.get_or_fetch('cordless drill', {'page': 1}, fetch), ['cordless drill a'])
+        fetch.assert_called_once_with('cordless drill')
+
+    def test_other_params_are_another_entry(self):
+        fetch = self.fetch(['a'])
+        search_cache.get_or_fetch('drill', {'page': 1}, fetch)
+        search_cache.get_or_fetch('drill', {'page': 2}, fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_stale_entry_is_served_while_refreshed_once(self):
+        search_cache.get_or_fetch('drill', {}, self.fetch(['old']))
+        self.now += 120
+        release = threading.Event()
+        slow = mock.Mock(side_effect=lambda query: release.wait(5) and [f'{query} new'])
+        with self.refresh_done() as done:
+            self.assertEqual(search_cache.get_or_fetch('drill', {}, slow), ['drill old'])
+            self.assertEqual(search_cache.get_or_fetch('drill', {}, slow), ['drill old'])
+            release.set()
+            # The refresh thread closes its database connections when it is done
+            self.assertTrue(done.wait(5))
+        slow.assert_called_once_with('drill')
+        self.assertEqual(search_cache.get_or_fetch('drill', {}, slow), ['drill new'])
+
+    def test_failed_refresh_keeps_serving_the_stale_entry(self):
+        search_cache.get_or_fetch('drill', {}, self.fetch(['old']))
+        self.now += 120
+        failing = mock.Mock(side_effect=RuntimeError('eBay is down'))
+        with self.refresh_done() as done:
+            self.assertEqual(search_cache.get_or_fetch('drill', {}, failing), ['drill old'])
+            self.assertTrue(done.wait(5))
+        self.assertEqual(search_cache.get_or_fetch('drill', {}, failing), ['drill old'])
+
+    def test_expired_entry_is_fetched_again(self):
+        search_cache.get_or_fetch('drill', {}, self.fetch(['old']))
+        self.now += 60 + 600 + 1
+        with mock.patch.object(search_cache.time, 'monotonic', return_value=search_cache.time.monotonic() + 661):
+            self.assertEqual(search_cache.get_or_fetch('drill', {}, self.fetch(['new'])), ['drill new'])
+
+    def test_lru_keeps_the_most_recently_used_entries(self):
+        backend = search_cache.LRUBackend(2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), (1, None, 3))
+
+    @override_settings(EBAY_SEARCH_CACHE_TTL_SECONDS=0)
+    def test_zero_ttl_disables_the_cache(self):
+        fetch = self.fetch(['a'])
+        search_cache.get_or_fetch('drill', {}, fetch)
+        search_cache.get_or_fetch('drill', {}, fetch)
+        self.assertEqual(fetch.call_count, 2)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from product_matcher import singleflight
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir, ignore_errors=True)
+        settings_override = override_settings(SINGLE_FLIGHT_LOCK_DIR=self.lock_dir, SINGLE_FLIGHT_WAIT_SECONDS=5)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def lock_file(self, key):
+        return singleflight._LockFile(self.lock_dir, key)
+
+
+class InProcessTests(SingleFlightTestCase):
+    def run_concurrently(self, fn, count=4):
+        """Start a leader blocked inside ``fn``, then ``count - 1`` followers; return their outcomes."""
+        started, release = threading.Event(), threading.Event()
+        outcomes = []
+
+        def leader_fn():
+            started.set()
+            release.wait(5)
+            return fn()
+
+        def run(call_fn):
+            try:
+                outcomes.append(('result', singleflight.do('key', call_fn)))
+            except Exception as e:
+                outcomes.append(('error', e))
+
+        joined = threading.Semaphore(0)
+        register = singleflight._register
+
+        def spy_register(keys):
+            owned, joined_calls = register(keys)
+            if joined_calls:
+                joined.release()
+            return owned, joined_calls
+
+        threads = [threading.Thread(target=run, args=(leader_fn,))]
+        threads[0].start()
+        started.wait(5)
+        with mock.patch.object(singleflight, '_register', spy_register):
+            for _ in range(count - 1):
+                threads.append(threading.Thread(target=run, args=(fn,)))
+                threads[-1].start()
+            # Every follower has joined the call in progress before the leader finishes
+            for _ in range(count - 1):
+                joined.acquire(timeout=5)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return outcomes
+
+    def test_concurrent_callers_share_one_call(self):
+        fn = mock.Mock(return_value=42)
+        outcomes = self.run_concurrently(fn)
+        self.assertEqual(outcomes, [('result', 42)] * 4)
+        fn.assert_called_once()
+
+    def test_leader_error_is_raised_to_followers(self):
+        fn = mock.Mock(side_effect=ValueError('boom'))
+        outcomes = self.run_concurrently(fn)
+        self.assertEqual([kind for kind, _ in outcomes], ['error'] * 4)
+        fn.assert_called_once()
+
+    def test_next_call_runs_again(self):
+        fn = mock.Mock(side_effect=[1, 2])
+        self.assertEqual(singleflight.do('key', fn), 1)
+        self.assertEqual(singleflight.do('key', fn), 2)
+        self.assertEqual(singleflight._calls, {})
+
+    def test_do_many_makes_one_call_for_all_keys(self):
+        fn = mock.Mock(side_effect=lambda keys: {key: key.upper() for key in keys})
+        results, shared = singleflight.do_many(['a', 'b', 'a'], fn)
+        self.assertEqual(results, {'a': 'A', 'b': 'B'})
+        self.assertEqual(shared, set())
+        fn.assert_called_once_with(['a', 'b'])
+
+    @override_settings(SINGLE_FLIGHT_WAIT_SECONDS=0)
+    def test_disabled(self):
+        fn = mock.Mock(side_effect=lambda keys: {key: 1 for key in keys})
+        self.assertEqual(singleflight.do_many(['a'], fn), ({'a': 1}, set()))
+
+
+class LockFileTests(SingleFlightTestCase):
+    def test_result_is_handed_to_queued_follower(self):
+        leader, follower = self.lock_file('key'), self.lock_file('key')
+        self.assertIs(leader.try_acquire(), True)
+        self.assertIs(follower.try_acquire(), False)
+        leader.release({'value': 1})
+        self.assertEqual(follower.try_acquire(), ({'value': 1},))
+        # The file was unlinked, so a later caller leads a new call
+        later = self.lock_file('key')
+        self.assertIs(later.try_acquire(), True)
+        later.release()
+
+    def test_failed_leader_hands_over_the_lead(self):
+        leader, follower = self.lock_file('key'), self.lock_file('key')
+        leader.try_acquire()
+        follower.try_acquire()
+        leader.release()
+        self.assertIs(follower.try_acquire(), True)
+        follower.release()
+
+    def test_stale_result_is_not_handed_off(self):
+        # A leader that died after writing its result but before unlinking the file
+        with open(self.lock_file('key').path, 'wb') as f:
+            f.write(b'stale')
+        leader, follower = self.lock_file('key'), self.lock_file('key')
+        self.assertIs(leader.try_acquire(), True)
+        follower.try_acquire()
+        leader.release()
+        self.assertIs(follower.try_acquire(), True)
+        follower.release()
+
+    @override_settings(SINGLE_FLIGHT_WAIT_SECONDS=0.2)
+    def test_follower_gives_up_without_touching_the_leaders_file(self):
+        leader = self.lock_file('key')
+        leader.try_acquire()
+        fn = mock.Mock(return_value='own')
+        self.assertEqual(singleflight.do('key', fn), 'own')
+        fn.assert_called_once()
+        self.assertTrue(os.path.exists(leader.path))
+        self.assertTrue(leader._is_current())
+        leader.release('leader')
+
+    def test_do_waits_for_a_leader_in_another_process(self):
+        leader = self.lock_file('key')
+        leader.try_acquire()
+        timer = threading.Timer(0.2, leader.release, args=('from leader',))
+        timer.start()
+        fn = mock.Mock()
+        results, shared = singleflight.do_many(['key'], fn)
+        timer.join()
+        self.assertEqual(results, {'key': 'from leader'})
+        self.assertEqual(shared, {'key'})
+        fn.assert_not_called()
+
+    def test_shared_lock_dir_is_not_used(self):
+        os.chmod(self.lock_dir, 0o777)
+        with override_settings(SINGLE_FLIGHT_LOCK_DIR=os.path.join(self.lock_dir, '')), \
+                self.assertLogs('product_matcher.singleflight', 'WARNING') as logs:
+            self.assertIsNone(singleflight.lock_dir())
+            self.assertIsNone(singleflight.lock_dir())
+        self.assertEqual(len(logs.output), 1)
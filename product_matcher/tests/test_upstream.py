@@ -0,0 +1,192 @@
+import asyncio
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from google.api_core import exceptions as google_exceptions
+
+from product_matcher import upstream
+from product_matcher.models import RateLimitBucket
+
+
+def failing():
+    raise google_exceptions.ServiceUnavailable('down')
+
+
+@override_settings(
+    RATE_LIMIT_VISION_PER_SECOND=0,
+    CIRCUIT_BREAKER_FAILURES=2,
+    CIRCUIT_BREAKER_RESET_SECONDS=60,
+    UPSTREAM_MAX_ATTEMPTS=1,
+)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(upstream._breakers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = upstream.get_breaker(upstream.VISION)
+
+    def open_breaker(self):
+        for _ in range(2):
+            with self.assertRaises(google_exceptions.ServiceUnavailable):
+                upstream.call(upstream.VISION, failing)
+        self.assertTrue(self.breaker.is_open)
+
+    def make_trial_due(self):
+        self.breaker.opened_at = time.monotonic() - 61
+
+    def test_opens_after_consecutive_failures_and_fails_fast(self):
+        self.open_breaker()
+        func = mock.Mock()
+        with self.assertRaises(upstream.UpstreamUnavailable):
+            upstream.call(upstream.VISION, func)
+        func.assert_not_called()
+
+    def test_success_resets_the_failure_count(self):
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            upstream.call(upstream.VISION, failing)
+        upstream.call(upstream.VISION, lambda: 'ok')
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            upstream.call(upstream.VISION, failing)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_bad_request_does_not_count_as_failure(self):
+        def bad_request():
+            raise google_exceptions.InvalidArgument('bad image')
+
+        for _ in range(3):
+            with self.assertRaises(google_exceptions.InvalidArgument):
+                upstream.call(upstream.VISION, bad_request)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_unexpected_errors_leave_the_breaker_alone(self):
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            upstream.call(upstream.VISION, failing)
+        for error in (TypeError('bad argument'), KeyError('missing')):
+            with self.assertRaises(type(error)):
+                upstream.call(upstream.VISION, mock.Mock(side_effect=error))
+        # The failure before them still counts
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            upstream.call(upstream.VISION, failing)
+        self.assertTrue(self.breaker.is_open)
+
+    def test_trial_with_an_unexpected_error_leaves_the_slot_free(self):
+        self.open_breaker()
+        self.make_trial_due()
+        with self.assertRaises(TypeError):
+            upstream.call(upstream.VISION, mock.Mock(side_effect=TypeError('bug')))
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.trial_running)
+        self.assertEqual(upstream.call(upstream.VISION, lambda: 'ok'), 'ok')
+        self.assertFalse(self.breaker.is_open)
+
+    def test_half_open_lets_one_trial_through(self):
+        self.open_breaker()
+        self.make_trial_due()
+        self.assertTrue(self.breaker.before_call())
+        with self.assertRaises(upstream.UpstreamUnavailable):
+            self.breaker.before_call()
+
+    def test_successful_trial_closes(self):
+        self.open_breaker()
+        self.make_trial_due()
+        self.assertEqual(upstream.call(upstream.VISION, lambda: 'ok'), 'ok')
+        self.assertFalse(self.breaker.is_open)
+
+    def test_failed_trial_reopens(self):
+        self.open_breaker()
+        self.make_trial_due()
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            upstream.call(upstream.VISION, failing)
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.trial_running)
+        with self.assertRaises(upstream.UpstreamUnavailable):
+            upstream.call(upstream.VISION, lambda: 'ok')
+
+    def test_rate_limited_trial_leaves_the_slot_free(self):
+        self.open_breaker()
+        self.make_trial_due()
+        with mock.patch.object(upstream, 'reserve_token', side_effect=upstream.UpstreamUnavailable('rate')):
+            with self.assertRaises(upstream.UpstreamUnavailable):
+                upstream.call(upstream.VISION, lambda: 'ok')
+        self.assertFalse(self.breaker.trial_running)
+        self.assertEqual(upstream.call(upstream.VISION, lambda: 'ok'), 'ok')
+
+    def test_cancelled_trial_leaves_the_slot_free(self):
+        self.open_breaker()
+        self.make_trial_due()
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(upstream.acall(upstream.VISION, slow), 0.05)
+
+        asyncio.run(run())
+        self.assertFalse(self.breaker.trial_running)
+        self.assertEqual(upstream.call(upstream.VISION, lambda: 'ok'), 'ok')
+        self.assertFalse(self.breaker.is_open)
+
+
+@override_settings(
+    RATE_LIMIT_VISION_PER_SECOND=10, RATE_LIMIT_BURST=3, RATE_LIMIT_MAX_WAIT_SECONDS=1, RATE_LIMIT_TOKEN_BATCH=1
+)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(upstream._local_tokens, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_waits_in_arrival_order(self):
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0):
+            waits = [upstream.reserve_token(upstream.VISION) for _ in range(5)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 0.1)
+        self.assertAlmostEqual(waits[4], 0.2)
+
+    def test_refuses_waits_over_the_limit(self):
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0):
+            for _ in range(13):
+                upstream.reserve_token(upstream.VISION)
+            with self.assertRaises(upstream.UpstreamUnavailable):
+                upstream.reserve_token(upstream.VISION)
+
+    def test_tokens_refill_over_time(self):
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0):
+            for _ in range(3):
+                upstream.reserve_token(upstream.VISION)
+        with mock.patch.object(upstream.time, 'time', return_value=1000.5):
+            self.assertEqual(upstream.reserve_token(upstream.VISION), 0)
+
+    @override_settings(RATE_LIMIT_VISION_PER_SECOND=0)
+    def test_zero_rate_disables_the_limit(self):
+        self.assertEqual(upstream.reserve_token(upstream.VISION), 0)
+
+    @override_settings(RATE_LIMIT_TOKEN_BATCH=4)
+    def test_tokens_are_taken_from_the_database_in_batches(self):
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0):
+            waits = [upstream.reserve_token(upstream.VISION)]
+            with self.assertNumQueries(0):
+                waits += [upstream.reserve_token(upstream.VISION) for _ in range(3)]
+            self.assertEqual(RateLimitBucket.objects.get().tokens, -1)
+            # The process hands out its batch in the same order the bucket would
+            self.assertEqual(waits[:3], [0, 0, 0])
+            self.assertAlmostEqual(waits[3], 0.1)
+            self.assertAlmostEqual(upstream.reserve_token(upstream.VISION), 0.2)
+
+    @override_settings(RATE_LIMIT_TOKEN_BATCH=4)
+    def test_batches_stop_at_the_longest_wait(self):
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0):
+            waits = [upstream.reserve_token(upstream.VISION) for _ in range(13)]
+            with self.assertRaises(upstream.UpstreamUnavailable):
+                upstream.reserve_token(upstream.VISION)
+        self.assertAlmostEqual(max(waits), 1.0)
+
+    @override_settings(RATE_LIMIT_TOKEN_BATCH=4)
+    def test_unused_tokens_expire(self):
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0):
+            upstream.reserve_token(upstream.VISION)
+        with mock.patch.object(upstream.time, 'time', return_value=1000.0 + upstream.LOCAL_TOKEN_EXPIRY_SECONDS + 1):
+            self.assertEqual(upstream.reserve_token(upstream.VISION), 0)
+        self.assertEqual(len(upstream._local_tokens[upstream.VISION]), 3)
@@ -0,0 +1,76 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from google.cloud import vision
+
+from product_matcher import upstream, vision_api
+
+ALL_KEYS = ['label_response', 'web_response', 'text_response']
+
+
+def combined_response():
+    return vision.AnnotateImageResponse(
+        label_annotations=[vision.EntityAnnotation(description='Drill', score=0.9)],
+        web_detection=vision.WebDetection(web_entities=[vision.WebDetection.WebEntity(description='Cordless drill')]),
+        text_annotations=[vision.EntityAnnotation(description='DeWalt 20V')],
+        full_text_annotation=vision.TextAnnotation(text='DeWalt 20V'),
+    )
+
+
+class SplitResponseTests(SimpleTestCase):
+    def test_each_detection_gets_only_its_fields(self):
+        responses = vision_api.split_response(combined_response(), ALL_KEYS)
+        self.assertEqual([label.description for label in responses['label_response'].label_annotations], ['Drill'])
+        self.assertFalse(responses['label_response'].text_annotations)
+        self.assertEqual(responses['web_response'].web_detection.web_entities[0].description, 'Cordless drill')
+        self.assertFalse(responses['web_response'].label_annotations)
+        self.assertEqual(responses['text_response'].text_annotations[0].description, 'DeWalt 20V')
+        self.assertEqual(responses['text_response'].full_text_annotation.text, 'DeWalt 20V')
+        self.assertNotIn('web_detection', responses['text_response'])
+
+    def test_errors_are_kept_for_every_detection(self):
+        response = vision.AnnotateImageResponse(error={'code': 3, 'message': 'Bad image data'})
+        responses = vision_api.split_response(response, ['label_response', 'text_response'])
+        self.assertEqual(set(responses), {'label_response', 'text_response'})
+        for part in responses.values():
+            self.assertEqual(part.error.message, 'Bad image data')
+
+
+@override_settings(RATE_LIMIT_VISION_PER_SECOND=0, UPSTREAM_MAX_ATTEMPTS=1)
+class BatchTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(upstream._breakers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock()
+        self.client.batch_annotate_images.side_effect = lambda requests: vision.BatchAnnotateImagesResponse(
+            responses=[combined_response() for _ in requests]
+        )
+
+    def batch_sizes(self):
+        return [len(call.kwargs['requests']) for call in self.client.batch_annotate_images.call_args_list]
+
+    def annotate(self, contents, normalized_bytes):
+        with mock.patch.object(vision_api.imaging, 'normalize_for_vision', return_value=b'x' * normalized_bytes):
+            return vision_api.annotate_images(contents, ALL_KEYS, client=self.client)
+
+    def test_one_request_per_batch_of_images(self):
+        results = self.annotate([b'image'] * (vision_api.MAX_BATCH_SIZE + 1), 100)
+        self.assertEqual(self.batch_sizes(), [vision_api.MAX_BATCH_SIZE, 1])
+        self.assertEqual(len(results), vision_api.MAX_BATCH_SIZE + 1)
+        self.assertEqual(set(results[0]), set(ALL_KEYS))
+
+    @mock.patch.object(vision_api, 'MAX_BATCH_BYTES', 1000)
+    def test_batches_are_sized_by_the_normalized_images(self):
+        # Large uploads that normalize to small images share a request
+        self.annotate([b'x' * 5000] * 3, 100)
+        self.assertEqual(self.batch_sizes(), [3])
+
+    @mock.patch.object(vision_api, 'MAX_BATCH_BYTES', 1000)
+    def test_images_over_the_byte_limit_get_their_own_request(self):
+        self.annotate([b'small'] * 3, 600)
+        self.assertEqual(self.batch_sizes(), [1, 1, 1])
+
+    def test_no_images_no_request(self):
+        self.assertEqual(vision_api.annotate_images([], ALL_KEYS, client=self.client), [])
+        self.client.batch_annotate_images.assert_not_called()
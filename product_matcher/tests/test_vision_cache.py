@@ -0,0 +1,74 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from product_matcher import vision_cache
+from product_matcher.models import ProductImage, VisionAPICall
+
+LABELS = {'label_annotations': [{'description': 'Drill'}]}
+TEXT = {'text_annotations': [{'description': 'DeWalt'}]}
+
+
+@override_settings(VISION_CACHE_TTL_SECONDS=3600, VISION_CACHE_MAX_ENTRIES=10, VISION_CACHE_EVICT_EVERY=0)
+class VisionCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.image = ProductImage.objects.create(image='product_images/a.jpg', content_hash='a' * 64)
+
+    def record(self, api_response, content_hash='a' * 64, age=0, **fields):
+        return VisionAPICall.objects.create(
+            product_image=self.image,
+            request_timestamp=timezone.now() - timedelta(seconds=age),
+            api_response=api_response,
+            content_hash=content_hash,
+            **fields
+        )
+
+    def test_serves_the_newest_call_holding_every_response(self):
+        self.record({'label_response': LABELS, 'text_response': TEXT}, age=20)
+        self.record({'label_response': {'label_annotations': []}}, age=10)
+        self.assertEqual(
+            vision_cache.lookup('a' * 64, ['label_response']),
+            {'label_response': {'label_annotations': []}}
+        )
+        self.assertEqual(
+            vision_cache.lookup('a' * 64, ['label_response', 'text_response']),
+            {'label_response': LABELS, 'text_response': TEXT}
+        )
+
+    def test_misses_stale_failed_and_copied_calls(self):
+        self.record({'label_response': LABELS}, age=7200)
+        self.record({'label_response': LABELS}, error='quota exceeded')
+        self.record({'label_response': LABELS}, cache_hit=True)
+        self.assertIsNone(vision_cache.lookup('a' * 64, ['label_response']))
+        self.assertIsNone(vision_cache.lookup('b' * 64, ['label_response']))
+
+    def test_counts_hits_and_misses(self):
+        self.record({'label_response': LABELS})
+        vision_cache.lookup('a' * 64, ['label_response'])
+        vision_cache.lookup('a' * 64, ['label_response'])
+        vision_cache.lookup('b' * 64, ['label_response'])
+        self.assertEqual(vision_cache.get_stats(), {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3})
+        vision_cache.reset_stats()
+        self.assertEqual(vision_cache.get_stats()['hits'], 0)
+
+    def test_evict_expires_old_entries_and_keeps_the_newest(self):
+        expired = self.record({'label_response': LABELS}, age=7200)
+        with override_settings(VISION_CACHE_MAX_ENTRIES=2):
+            kept = [self.record({'label_response': LABELS}, content_hash=f'{n}' * 64, age=n) for n in range(1, 4)]
+            self.assertEqual(vision_cache.evict(), 2)
+        hashes = dict(VisionAPICall.objects.values_list('id', 'content_hash'))
+        self.assertIsNone(hashes[expired.id])
+        self.assertEqual([hashes[call.id] is not None for call in kept], [True, True, False])
+        # Evicted calls stay in the history
+        self.assertEqual(VisionAPICall.objects.count(), 4)
+
+    @override_settings(VISION_CACHE_EVICT_EVERY=2)
+    def test_eviction_runs_every_n_misses(self):
+        expired = self.record({'label_response': LABELS}, age=7200)
+        vision_cache.lookup('b' * 64, ['label_response'])
+        self.assertIsNotNone(VisionAPICall.objects.get(id=expired.id).content_hash)
+        vision_cache.lookup('b' * 64, ['label_response'])
+        self.assertIsNone(VisionAPICall.objects.get(id=expired.id).content_hash)
@@ -0,0 +1,90 @@
+"""Lightweight per-stage latency instrumentation.
+
+Code wraps each stage in ``with timing.stage('vision'):``. Every measurement
+is added to a process-wide histogram, exposed in Prometheus text format at
+``/metrics/``. It is also added to every collector active in the current
+context: ``ServerTimingMiddleware`` opens one per request to fill the
+``Server-Timing`` header, and the pipeline opens one per Vision call to
+store its breakdown in ``VisionAPICall.stage_timings``.
+
+Histograms count since process start, as Prometheus expects; each process
+serves its own.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_collectors = contextvars.ContextVar('timing_collectors', default=())
+
+
+class Histogram:
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.lock = threading.Lock()
+        # label value -> [count per bucket (+Inf last), sum]
+        self.series = {}
+
+    def observe(self, label_value, seconds):
+        with self.lock:
+            counts, total = self.series.get(label_value) or ([0] * (len(BUCKETS) + 1), 0.0)
+            counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.series[label_value] = (counts, total + seconds)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_value, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {cumulative}')
+        return '\n'.join(lines)
+
+
+stage_durations = Histogram(
+    'product_matcher_stage_duration_seconds', 'Time spent in each processing stage.', 'stage'
+)
+request_durations = Histogram(
+    'product_matcher_request_duration_seconds', 'Time spent handling requests, by URL name.', 'view'
+)
+
+
+@contextmanager
+def collect():
+    """Collect the stages timed inside the block into a dict of stage -> milliseconds."""
+    timings = {}
+    token = _collectors.set(_collectors.get() + (timings,))
+    try:
+        yield timings
+    finally:
+        _collectors.reset(token)
+
+
+def record(name, seconds):
+    stage_durations.observe(name, seconds)
+    for timings in _collectors.get():
+        # Stages that run more than once add up
+        timings[name] = round(timings.get(name, 0) + seconds * 1000, 1)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def render_metrics():
+    return '\n'.join([stage_durations.render(), request_durations.render()]) + '\n'
@@ -0,0 +1,260 @@
+"""Coordinated access to the upstream APIs (Vision, eBay Finding, eBay Shopping).
+
+Every outbound call goes through :func:`call`, which
+
+* takes a token from a per-upstream token bucket stored in the database, so
+  all web and worker processes share one quota without needing Redis. When
+  the bucket is empty the caller waits for its reserved slot instead of
+  firing the request and getting a quota error back. Each process takes
+  ``RATE_LIMIT_TOKEN_BATCH`` tokens at a time and hands them out to its own
+  callers, so busy workers lock the bucket row once per batch rather than
+  once per call;
+* retries throttling, timeout and server errors with jittered exponential
+  backoff;
+* fails fast while the upstream's circuit breaker is open. The breaker opens
+  after ``CIRCUIT_BREAKER_FAILURES`` consecutive failures and lets one trial
+  call through after ``CIRCUIT_BREAKER_RESET_SECONDS``. Client errors (the
+  upstream rejected the request) count as a healthy upstream; any other
+  error leaves the breaker as it was. Breaker state is kept per process.
+
+:func:`acall` does the same for coroutines, waiting and backing off with
+``asyncio.sleep`` so the event loop keeps serving other requests.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from ebaysdk.exception import ConnectionError as EbayConnectionError
+from google.api_core import exceptions as google_exceptions
+
+from .models import RateLimitBucket
+
+VISION = 'vision'
+EBAY_FINDING = 'ebay_finding'
+EBAY_SHOPPING = 'ebay_shopping'
+
+RETRYABLE_GOOGLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+RETRYABLE_HTTP_STATUSES = {429, 500, 502, 503, 504}
+# Reserved tokens not used this long after their slot are given up, so they cannot add up to a burst
+LOCAL_TOKEN_EXPIRY_SECONDS = 1
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling an upstream that is failing or over its quota."""
+
+
+def _rate(upstream):
+    return getattr(settings, f'RATE_LIMIT_{upstream.upper()}_PER_SECOND')
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_GOOGLE_ERRORS):
+        return True
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_HTTP_STATUSES
+    if isinstance(error, EbayConnectionError):
+        status = getattr(error.response, 'status_code', None)
+        # eBay reports call limits as "... exceeded the number of times the operation is allowed to be called"
+        return status in RETRYABLE_HTTP_STATUSES or 'exceeded' in str(error).lower()
+    return False
+
+
+def is_client_error(error):
+    """Whether the upstream answered and rejected the request itself (a 4xx response)."""
+    if isinstance(error, google_exceptions.ClientError):
+        return True
+    if isinstance(error, (httpx.HTTPStatusError, requests.HTTPError)) and error.response is not None:
+        return 400 <= error.response.status_code < 500
+    if isinstance(error, EbayConnectionError):
+        # eBay reports API errors, such as an unknown item, with a 200 response
+        status = getattr(error.response, 'status_code', None)
+        return status is not None and status < 500
+    return False
+
+
+_local_tokens = {}  # upstream -> deque of the times at which this process's reserved tokens may be used
+_local_tokens_lock = threading.Lock()
+
+
+def _reserve_batch(upstream, rate):
+    """Take up to ``RATE_LIMIT_TOKEN_BATCH`` tokens from the shared bucket; return the time each may be used."""
+    capacity = max(settings.RATE_LIMIT_BURST, 1)
+    with transaction.atomic():
+        now = time.time()
+        bucket, created = RateLimitBucket.objects.select_for_update().get_or_create(
+            name=upstream, defaults={'tokens': capacity, 'updated_at': now}
+        )
+        available = min(capacity, bucket.tokens + max(now - bucket.updated_at, 0) * rate)
+        if (1 - available) / rate > settings.RATE_LIMIT_MAX_WAIT_SECONDS:
+            raise UpstreamUnavailable(f'{upstream} is over its rate limit, try again later')
+        # Never borrow tokens that could only be used after the longest wait
+        count = max(1, min(settings.RATE_LIMIT_TOKEN_BATCH, int(available + rate * settings.RATE_LIMIT_MAX_WAIT_SECONDS)))
+
+        bucket.tokens = available - count
+        bucket.updated_at = now
+        bucket.save(update_fields=['tokens', 'updated_at'])
+    return [now + max((n - available) / rate, 0) for n in range(1, count + 1)]
+
+
+def reserve_token(upstream):
+    """Take a token from the upstream's bucket and return how long to wait before using it.
+
+    Tokens may be borrowed ahead, which queues callers in the order they
+    arrived. Raises UpstreamUnavailable if the wait would exceed
+    ``RATE_LIMIT_MAX_WAIT_SECONDS``.
+    """
+    rate = _rate(upstream)
+    if rate <= 0:
+        return 0
+
+    # Held while refilling, so that the threads of a process take one batch at a time
+    with _local_tokens_lock:
+        tokens = _local_tokens.setdefault(upstream, deque())
+        while tokens and tokens[0] < time.time() - LOCAL_TOKEN_EXPIRY_SECONDS:
+            tokens.popleft()
+        if not tokens:
+            tokens.extend(_reserve_batch(upstream, rate))
+        slot = tokens.popleft()
+    return max(slot - time.time(), 0)
+
+
+class CircuitBreaker:
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def _refuse(self):
+        return time.monotonic() - self.opened_at < settings.CIRCUIT_BREAKER_RESET_SECONDS or self.trial_running
+
+    def check(self):
+        """Raise UpstreamUnavailable while the breaker is open and no trial call is due."""
+        with self.lock:
+            if self.opened_at is not None and self._refuse():
+                raise UpstreamUnavailable(f'{self.upstream} is failing, try again later')
+
+    def before_call(self):
+        """Check the breaker right before calling; return True if the call is the half-open trial."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self._refuse():
+                raise UpstreamUnavailable(f'{self.upstream} is failing, try again later')
+            # Half-open: let a single trial call through
+            self.trial_running = True
+            return True
+
+    def abandon_trial(self):
+        # A trial that was cancelled or hit an unexpected error says nothing about the upstream; let the next call try
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= settings.CIRCUIT_BREAKER_FAILURES:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(upstream):
+    with _breakers_lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(upstream)
+        return _breakers[upstream]
+
+
+def call(upstream, func, *args, **kwargs):
+    """Call ``func(*args, **kwargs)`` against ``upstream`` with rate limiting, retries and a circuit breaker."""
+    breaker = get_breaker(upstream)
+    for attempt in range(settings.UPSTREAM_MAX_ATTEMPTS):
+        # The token is taken before the trial slot, so waiting for it cannot leave the slot taken
+        breaker.check()
+        time.sleep(reserve_token(upstream))
+        trial = breaker.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                if is_client_error(e):
+                    # The upstream answered; the request itself was bad
+                    breaker.record_success()
+                elif trial:
+                    # A bug or unexpected error says nothing about the upstream
+                    breaker.abandon_trial()
+                raise
+            breaker.record_failure()
+            if attempt == settings.UPSTREAM_MAX_ATTEMPTS - 1 or breaker.is_open:
+                raise
+            # Full jitter keeps retrying workers from moving in lockstep
+            backoff = min(settings.UPSTREAM_BACKOFF_MAX_SECONDS, settings.UPSTREAM_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            time.sleep(random.uniform(0, backoff))
+        except BaseException:
+            if trial:
+                breaker.abandon_trial()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+async def acall(upstream, func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)`` against ``upstream``, like :func:`call`."""
+    breaker = get_breaker(upstream)
+    for attempt in range(settings.UPSTREAM_MAX_ATTEMPTS):
+        breaker.check()
+        await asyncio.sleep(await sync_to_async(reserve_token)(upstream))
+        trial = breaker.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                if is_client_error(e):
+                    breaker.record_success()
+                elif trial:
+                    breaker.abandon_trial()
+                raise
+            breaker.record_failure()
+            if attempt == settings.UPSTREAM_MAX_ATTEMPTS - 1 or breaker.is_open:
+                raise
+            backoff = min(settings.UPSTREAM_BACKOFF_MAX_SECONDS, settings.UPSTREAM_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            await asyncio.sleep(random.uniform(0, backoff))
+        except BaseException:
+            # Deadlines cancel the task mid-call
+            if trial:
+                breaker.abandon_trial()
+            raise
+        else:
+            breaker.record_success()
+            return result
@@ -7,7 +7,14 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('upload/', views.upload_image, name='upload_image'),
     path('results/<int:image_id>/', views.results, name='results'),
+    path('jobs/<int:job_id>/status/', views.job_status, name='job_status'),
+    path('bulk-upload/', views.bulk_upload, name='bulk_upload'),
+    path('batches/<int:batch_id>/', views.batch_results, name='batch_results'),
     path('test-vision/', views.test_vision, name='test_vision'),
     path('history/', views.history, name='history'),
+    path('export/', views.export_history, name='export_history'),
     path('vision-call/<int:call_id>/', views.vision_call_detail, name='vision_call_detail'),
+    path('api/results/<int:image_id>/', views.api_results, name='api_results'),
+    path('api/vision-call/<int:call_id>/', views.api_vision_call, name='api_vision_call'),
+    path('metrics/', views.metrics, name='metrics'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) 
\ No newline at end of file
@@ -2,184 +2,225 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.core.files.base import ContentFile
-from django.http import JsonResponse
-from django.core.paginator import Paginator
-from .models import ProductImage, EbayListing, VisionAPICall
-from ebaysdk.finding import Connection as Finding
-from ebaysdk.shopping import Connection as Shopping
-from ebaysdk.exception import ConnectionError
-from google.cloud import vision
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.db.models import Count, F
+from .models import ProductImage, VisionAPICall, ProcessingJob, UploadBatch
+from . import page_cache, timing, vision_cache
+from .export import HistoryExport
+from .bulk_intake import create_batch
+from .history import get_history_page
+from .intake import HashingUploadHandler, decode_base64_image, read_upload
 import os
 from dotenv import load_dotenv
-import re
-import requests
-from urllib.parse import urlparse
 import uuid
-import base64
-from django.views.decorators.csrf import csrf_exempt
-import time
-from google.protobuf.json_format import MessageToDict
+import json
+from django.middleware.csrf import CsrfViewMiddleware
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
 
 load_dotenv()
 
 def home(request):
     return render(request, 'product_matcher/home.html')
 
-def upload_image(request):
+# The analysis and pipeline modules are imported inside the views that use them: they load the
+# Vision and eBay client libraries, which would otherwise slow down every process start and manage.py command
+async def upload_image(request):
+    from .pipeline import enqueue_upload
+
+    rejection = await _parse_upload(request)
+    if rejection is not None:
+        return rejection
     if request.method == 'POST' and request.FILES.get('image'):
         image_file = request.FILES['image']
-        product_image = ProductImage.objects.create(image=image_file)
-        
-        try:
-            # Get the full path to the uploaded image
-            image_path = os.path.join(settings.MEDIA_ROOT, str(product_image.image))
-            
-            # Initialize Google Cloud Vision client
-            client = vision.ImageAnnotatorClient()
 
-            # Read the image file
-            with open(image_path, 'rb') as image_file:
-                content = image_file.read()
+        # Hash the upload so re-uploads of the same photo are served from the Vision cache
+        with timing.stage('hash'):
+            # Files not received by HashingUploadHandler are read from disk here
+            content, content_hash = await sync_to_async(read_upload, thread_sensitive=False)(image_file)
+
+        with timing.stage('save_file'):
+            product_image = await ProductImage.objects.acreate(image=image_file, content_hash=content_hash)
 
-            # Create image object
-            image = vision.Image(content=content)
+        # Vision and eBay run in the background worker; the results page polls the job
+        with timing.stage('enqueue'):
+            await sync_to_async(enqueue_upload)(product_image, content=content)
+        return redirect('results', image_id=product_image.id)
+    
+    return JsonResponse({'error': getattr(request, 'upload_error', 'No image provided')}, status=400)
 
-            # Perform label detection
-            label_response = client.label_detection(image=image)
-            labels = label_response.label_annotations
+# The CSRF check runs in _parse_upload, once the upload handler is in place
+upload_image.csrf_exempt = True
 
-            # Perform web detection
-            web_response = client.web_detection(image=image)
-            web = web_response.web_detection
+@sync_to_async
+def _parse_upload(request, check_csrf=True):
+    """Parse the body with HashingUploadHandler, returning the CSRF rejection if there is one."""
+    # Upload handlers must be swapped before anything reads the body, including the CSRF check
+    request.upload_handlers = [HashingUploadHandler(request)]
+    if check_csrf:
+        rejection = CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})
+        if rejection is not None:
+            return rejection
+    # Reading FILES parses the body, which is when the handler rejects a file
+    request.FILES
+    return None
 
-            # Collect all relevant terms
-            search_terms = []
-            
-            # Add labels (general image classification)
-            for label in labels[:3]:  # Top 3 labels
-                if label.score > 0.8:  # Only high confidence labels
-                    search_terms.append(label.description)
-                    print("label API",label.description)
-
-            # Add web entities
-            for entity in web.web_entities[:3]:  # Top 3 web entities
-                if entity.score > 0.8:  # Only high confidence entities
-                    search_terms.append(entity.description)
-                    print("entity API",entity.description)
-
-            # Create search query from the collected terms
-            search_query = ' '.join(search_terms)
-            
-            # Search eBay API with direct configuration
-            api = Finding(domain='svcs.ebay.com',
-                        appid=os.getenv('EBAY_APP_ID'),
-                        config_file=None)
-                        
-            response = api.execute('findItemsByKeywords', {
-                'keywords': search_query,
-                'outputSelector': ['SellerInfo', 'PictureURLSuperSize'],
-                'paginationInput': {'entriesPerPage': 10},
-                'sortOrder': 'BestMatch'  # Sort by best match
+def bulk_upload(request):
+    """Accept many images and/or zip archives at once and queue them as one batch."""
+    from .pipeline import enqueue_batch
+
+    if request.method == 'POST':
+        image_files = request.FILES.getlist('images')
+        archives = request.FILES.getlist('archives')
+        if not image_files and not archives:
+            return render(request, 'product_matcher/bulk_upload.html', {
+                'error': 'Please select images or a zip archive to upload.'
             })
-            
-            # Process and save results
-            for item in response.reply.searchResult.item:
-                EbayListing.objects.create(
-                    product_image=product_image,
-                    title=item.title,
-                    price=float(item.sellingStatus.currentPrice.value),
-                    url=item.viewItemURL,
-                    item_id=item.itemId,
-                    condition=getattr(item, 'condition', {}).get('conditionDisplayName', 'Not specified'),
-                    location=item.location,
-                    seller=item.sellerInfo.sellerUserName
-                )
-            
-            return redirect('results', image_id=product_image.id)
-            
-        except Exception as e:
-            # Delete the product image if the search fails
-            product_image.delete()
-            return JsonResponse({'error': str(e)}, status=400)
-    
-    return JsonResponse({'error': 'No image provided'}, status=400)
+
+        batch = create_batch(image_files, archives)
+        enqueue_batch(batch)
+        return redirect('batch_results', batch_id=batch.id)
+
+    return render(request, 'product_matcher/bulk_upload.html')
+
+def batch_results(request, batch_id):
+    batch = get_object_or_404(UploadBatch, id=batch_id)
+    jobs = (
+        batch.jobs
+        .select_related('product_image')
+        .annotate(listing_count=Count('product_image__ebay_listings'))
+        .order_by('id')
+    )
+
+    status_counts = {status: 0 for status, label in ProcessingJob.STATUS_CHOICES}
+    for job in jobs:
+        status_counts[job.status] += 1
+
+    return render(request, 'product_matcher/batch_results.html', {
+        'batch': batch,
+        'jobs': jobs,
+        'status_counts': status_counts,
+        'finished': status_counts[ProcessingJob.STATUS_PENDING] + status_counts[ProcessingJob.STATUS_RUNNING] == 0
+    })
+
+def _ordered_listings(product_image):
+    # Best visual matches first; listings that could not be compared keep eBay's order after them
+    return (
+        product_image.ebay_listings
+        .select_related('item')
+        .order_by(F('similarity_score').desc(nulls_last=True), 'rank')
+    )
+
+def _listing_json(listing):
+    return {
+        'item_id': listing.item_id,
+        'title': listing.item.title,
+        'url': listing.item.url,
+        'price': listing.price,
+        'condition': listing.item.condition,
+        'location': listing.item.location,
+        'seller': listing.item.seller,
+        'rank': listing.rank,
+        'similarity_score': listing.similarity_score,
+        'created_at': listing.created_at,
+    }
 
 def results(request, image_id):
+    with timing.stage('version'):
+        version = page_cache.results_version(image_id)
+    if version is None:
+        return redirect('home')
+    not_modified = version.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
     try:
         product_image = ProductImage.objects.get(id=image_id)
-        listings = product_image.ebay_listings.all()
-        return render(request, 'product_matcher/results.html', {
-            'product_image': product_image,
-            'listings': listings
-        })
+        with timing.stage('render'):
+            # The listings are only queried when their cached fragment is missing
+            response = render(request, 'product_matcher/results.html', {
+                'product_image': product_image,
+                'listings': _ordered_listings(product_image),
+                'job': product_image.jobs.first(),
+                'version': version.key,
+                'cache_ttl': settings.PAGE_CACHE_TTL_SECONDS
+            })
+        return version.stamp(response)
     except ProductImage.DoesNotExist:
         return redirect('home')
 
-def extract_ebay_item_id(url):
-    # Common eBay URL patterns
-    patterns = [
-        r'/itm/(?:[^/]+/)?(\d+)',  # Matches /itm/title/123456 or /itm/123456
-        r'item=(\d+)',             # Matches item=123456
-        r'ItemId=(\d+)',          # Matches ItemId=123456
-        r'/(\d{12})',             # Matches 12-digit item IDs in URL
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    return None
+def api_results(request, image_id):
+    """The results of an upload as JSON, for scripts polling for them."""
+    version = page_cache.results_version(image_id)
+    if version is None:
+        return JsonResponse({'error': 'Image not found'}, status=404)
+    not_modified = version.not_modified(request)
+    if not_modified is not None:
+        return not_modified
 
-def get_ebay_item_details(item_id):
-    try:
-        api = Shopping(domain='open.api.ebay.com',
-                      appid=os.getenv('EBAY_APP_ID'),
-                      config_file=None)
-        
-        response = api.execute('GetSingleItem', {
-            'ItemID': item_id,
-            'IncludeSelector': 'Details,ItemSpecifics'
-        })
-        
-        item = response.reply.Item
+    def build():
+        product_image = get_object_or_404(ProductImage, id=image_id)
+        job = product_image.jobs.first()
         return {
-            'title': item.Title,
-            'price': f"${float(item.CurrentPrice.value):.2f}",
-            'currency': item.CurrentPrice._currencyID,
-            'condition': item.ConditionDisplayName if hasattr(item, 'ConditionDisplayName') else 'Not specified',
-            'location': item.Location if hasattr(item, 'Location') else 'Not specified',
-            'url': item.ViewItemURLForNaturalSearch if hasattr(item, 'ViewItemURLForNaturalSearch') else None
+            'id': product_image.id,
+            'uploaded_at': product_image.uploaded_at,
+            'image_url': product_image.image.url,
+            'near_duplicate_of': product_image.near_duplicate_of_id,
+            'job': {
+                'id': job.id,
+                'status': job.status,
+                'stage': job.stage,
+                'finished': job.is_finished,
+                'error': job.error,
+            } if job else None,
+            'listings': [_listing_json(listing) for listing in _ordered_listings(product_image)],
         }
-    except Exception as e:
-        print(f"Error fetching eBay item details: {str(e)}")
-        return None
 
-@csrf_exempt
-def test_vision(request):
+    body = page_cache.cached_json('results', version, build)
+    return version.stamp(HttpResponse(body, content_type='application/json'))
+
+def job_status(request, job_id):
+    job = get_object_or_404(ProcessingJob, id=job_id)
+    return JsonResponse({
+        'id': job.id,
+        'image_id': job.product_image_id,
+        'status': job.status,
+        'stage': job.stage,
+        'stage_display': job.get_stage_display(),
+        'finished': job.is_finished,
+        'error': job.error,
+        'results_url': reverse('results', args=[job.product_image_id])
+    })
+
+async def test_vision(request):
     """View for testing the Google Cloud Vision API."""
+    await _parse_upload(request, check_csrf=False)
+    if request.method == 'POST' and not request.FILES and getattr(request, 'upload_error', None):
+        return render(request, 'product_matcher/test_vision.html', {
+            'error': f'Error processing image: {request.upload_error}'
+        })
     if request.method == 'POST' and (request.FILES.get('image') or request.POST.get('image_data')):
         try:
-            # Handle file upload or clipboard data
+            # Handle file upload or clipboard data; either way the bytes stay in memory for the analysis
+            fs = FileSystemStorage()
             if request.FILES.get('image'):
                 image_file = request.FILES['image']
-                fs = FileSystemStorage()
-                filename = fs.save(f'temp/{uuid.uuid4()}.jpg', image_file)
-                file_path = os.path.join(settings.MEDIA_ROOT, filename)
-            elif request.POST.get('image_data'):
-                # Handle clipboard data
-                image_data = request.POST['image_data'].split(',')[1]
-                image_bytes = base64.b64decode(image_data)
-                
-                # Save to temporary file
-                filename = f'temp/{uuid.uuid4()}.jpg'
-                file_path = os.path.join(settings.MEDIA_ROOT, filename)
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                
-                with open(file_path, 'wb') as f:
-                    f.write(image_bytes)
+                image_content, content_hash = await sync_to_async(read_upload, thread_sensitive=False)(image_file)
+            else:
+                # Clipboard data from clients that send it as base64 text
+                image_content, content_hash = await sync_to_async(decode_base64_image, thread_sensitive=False)(
+                    request.POST['image_data']
+                )
+                image_file = ContentFile(image_content)
+
+            with timing.stage('save_file'):
+                filename = await sync_to_async(fs.save)(f'temp/{uuid.uuid4()}.jpg', image_file)
+            file_path = os.path.join(settings.MEDIA_ROOT, filename)
             
             # Process the image and return results
-            return process_image(request, file_path)
+            return await process_image(request, file_path, image_content, content_hash)
             
         except Exception as e:
             return render(request, 'product_matcher/test_vision.html', {
@@ -188,158 +229,158 @@ def test_vision(request):
     
     return render(request, 'product_matcher/test_vision.html')
 
-def process_image(request, file_path):
-    try:
-        # Initialize Google Cloud Vision client
-        client = vision.ImageAnnotatorClient()
+test_vision.csrf_exempt = True
+
+async def process_image(request, file_path, image_content=None, content_hash=None):
+    from .analysis import aanalyze_image
 
+    try:
         # Get or create ProductImage instance
         fs = FileSystemStorage()
         relative_path = os.path.relpath(file_path, fs.location)
         image_url = fs.url(relative_path)
         
-        # Create ProductImage instance if it doesn't exist
-        with open(file_path, 'rb') as f:
-            image_content = f.read()
-            product_image, created = ProductImage.objects.get_or_create(
-                image=relative_path
+        # Create ProductImage instance if it doesn't exist; uploads pass their bytes in instead of rereading them
+        if image_content is None:
+            with timing.stage('read_file'):
+                image_content = await sync_to_async(_read_file, thread_sensitive=False)(file_path)
+        if content_hash is None:
+            with timing.stage('hash'):
+                content_hash = vision_cache.hash_image_bytes(image_content)
+        with timing.stage('db_write'):
+            product_image, created = await ProductImage.objects.aget_or_create(
+                image=relative_path,
+                defaults={'content_hash': content_hash}
             )
+            if product_image.content_hash != content_hash:
+                product_image.content_hash = content_hash
+                await product_image.asave(update_fields=['content_hash'])
 
-        # Record start time for API call
-        start_time = time.time()
-
-        # Create image object
-        image = vision.Image(content=image_content)
-
-        # Perform various detections
-        label_response = client.label_detection(image=image)
-        web_response = client.web_detection(image=image)
-        text_response = client.text_detection(image=image)
-
-        # Calculate processing time
-        processing_time = int((time.time() - start_time) * 1000)  # Convert to milliseconds
-
-        # Get web detection results
-        web = web_response.web_detection
-
-        # Store API call data
-        vision_call = VisionAPICall.objects.create(
-            product_image=product_image,
-            api_response={
-                'label_response': MessageToDict(label_response._pb),
-                'web_response': MessageToDict(web_response._pb),
-                'text_response': MessageToDict(text_response._pb)
-            },
-            labels=[{
-                'description': label.description,
-                'score': label.score
-            } for label in label_response.label_annotations],
-            text=[{
-                'description': text.description,
-                'locale': text.locale if hasattr(text, 'locale') else None
-            } for text in text_response.text_annotations] if text_response.text_annotations else [],
-            detected_objects=[{
-                'url': image.url
-                for image in web.visually_similar_images
-            }] if web.visually_similar_images else [],
-            processing_time_ms=processing_time
-        )
-        
-        # Extract eBay-specific results with details
-        ebay_results = []
-        if web.pages_with_matching_images:
-            for page in web.pages_with_matching_images:
-                if 'ebay' in page.url.lower():
-                    item_id = extract_ebay_item_id(page.url)
-                    listing_info = {
-                        'url': page.url,
-                        'title': page.page_title if page.page_title else 'eBay Listing'
-                    }
-                    
-                    if item_id:
-                        details = get_ebay_item_details(item_id)
-                        if details:
-                            listing_info.update(details)
-                    
-                    ebay_results.append(listing_info)
-
-        # Collect results for template
-        results = {
-            'image_url': image_url,
-            'labels': [
-                {'description': label.description, 'score': f"{label.score:.2%}"}
-                for label in label_response.label_annotations
-            ],
-            'web_entities': [
-                {'description': entity.description, 'score': f"{entity.score:.2%}"}
-                for entity in web_response.web_detection.web_entities
-            ],
-            'text': text_response.text_annotations[0].description if text_response.text_annotations else None,
-            'web_matches': {
-                'ebay_listings': ebay_results,
-                'similar_images': [
-                    {'url': image.url}
-                    for image in web.visually_similar_images[:5]
-                    if is_image_accessible(image.url)
-                ] if web.visually_similar_images else [],
-                'pages': [
-                    {'url': page.url, 'title': page.page_title}
-                    for page in web.pages_with_matching_images[:5]
-                    if page.page_title
-                ] if web.pages_with_matching_images else []
-            }
-        }
+        # Browsers with JavaScript ask for the results as a stream of server-sent events
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            # Under WSGI an async iterator would be buffered whole, so stream from the sync analysis there
+            events = (astream_analysis if isinstance(request, ASGIRequest) else stream_analysis)(
+                request, product_image, image_content, image_url
+            )
+            response = StreamingHttpResponse(events, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            # Keep nginx from buffering the stream
+            response['X-Accel-Buffering'] = 'no'
+            return response
 
-        return render(request, 'product_matcher/test_vision.html', {'results': results})
+        # Analyze the image and collect results for template
+        results = await aanalyze_image(product_image, image_content)
+        results['image_url'] = image_url
+
+        with timing.stage('render'):
+            return render(request, 'product_matcher/test_vision.html', {'results': results})
 
     except Exception as e:
         # Clean up the file if there's an error
-        try:
-            os.remove(file_path)
-            if 'temp_file' in request.session:
-                del request.session['temp_file']
-        except (FileNotFoundError, OSError):
-            pass
+        await sync_to_async(_remove_temp_file)(request, file_path)
         
         return render(request, 'product_matcher/test_vision.html', {
             'error': f'Error processing image: {str(e)}'
         })
 
+def _read_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def _remove_temp_file(request, file_path):
+    try:
+        os.remove(file_path)
+        if 'temp_file' in request.session:
+            del request.session['temp_file']
+    except (FileNotFoundError, OSError):
+        pass
+
+def _analysis_event(request, name, data=None):
+    """Render one analysis stage as a server-sent event carrying a fragment of the results."""
+    if name == 'summary':
+        html = render_to_string('product_matcher/partials/test_vision_results.html',
+                                {'results': data, 'streaming': True}, request)
+    elif name == 'ebay_listing':
+        html = render_to_string('product_matcher/partials/ebay_listing.html', {'listing': data[1]}, request)
+    elif name == 'similar_images':
+        html = render_to_string('product_matcher/partials/similar_images.html', {'images': data}, request)
+    else:
+        html = data or ''
+    return f'event: {name}\ndata: {json.dumps({"html": html})}\n\n'
+
+def stream_analysis(request, product_image, image_content, image_url):
+    """Yield the analysis as server-sent events."""
+    from .analysis import iter_analysis
+
+    try:
+        for name, data in iter_analysis(product_image, image_content):
+            if name == 'summary':
+                data['image_url'] = image_url
+            yield _analysis_event(request, name, data)
+        yield _analysis_event(request, 'done')
+    except Exception as e:
+        yield _analysis_event(request, 'error', f'Error processing image: {str(e)}')
+
+async def astream_analysis(request, product_image, image_content, image_url):
+    """Async version of ``stream_analysis``, served under ASGI."""
+    from .analysis import aiter_analysis
+
+    try:
+        async for name, data in aiter_analysis(product_image, image_content):
+            if name == 'summary':
+                data['image_url'] = image_url
+            yield _analysis_event(request, name, data)
+        yield _analysis_event(request, 'done')
+    except Exception as e:
+        yield _analysis_event(request, 'error', f'Error processing image: {str(e)}')
+
 def history(request):
-    # Get all product images ordered by upload date
-    images = ProductImage.objects.all().order_by('-uploaded_at')
-    
-    # Set up pagination - 10 images per page
-    paginator = Paginator(images, 10)
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
-    
-    # For each image on the current page, get its Vision API call and eBay listings
-    image_data = []
-    for image in page_obj:
-        # Get the most recent Vision API call for this image
-        vision_call = image.vision_api_calls.first()
-        
-        # Get associated eBay listings
-        ebay_listings = image.ebay_listings.all()[:5]  # Limit to 5 listings per image
-        
-        image_data.append({
-            'image': image,
-            'vision_call': vision_call,
-            'ebay_listings': ebay_listings,
-            'total_listings': image.ebay_listings.count()
-        })
+    # Keyset pagination: the cursor marks the last image seen, newest first
+    with timing.stage('history_query'):
+        page = get_history_page(
+            cursor=request.GET.get('cursor'),
+            direction=request.GET.get('direction', 'older')
+        )
     
     context = {
-        'page_obj': page_obj,
-        'image_data': image_data,
+        'image_data': page['items'],
+        'page': page,
     }
     
-    return render(request, 'product_matcher/history.html', context)
+    with timing.stage('render'):
+        return render(request, 'product_matcher/history.html', context)
+
+def export_history(request):
+    """Stream the upload history with its labels, text and listings as CSV or NDJSON."""
+    try:
+        export = HistoryExport(
+            format=request.GET.get('format', 'csv'),
+            since=request.GET.get('since'),
+            until=request.GET.get('until'),
+            after=request.GET.get('after') or None,
+            checkpoint=request.GET.get('checkpoint')
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Under ASGI a synchronous iterator would be read whole before anything is sent
+    chunks = export.achunks() if isinstance(request, ASGIRequest) else export.chunks()
+    response = StreamingHttpResponse(chunks, content_type=export.content_type)
+    response['Content-Disposition'] = f'attachment; filename="{export.filename}"'
+    # Pass back as ?after= to export only what was added since
+    response['X-Export-Cursor'] = str(export.cursor)
+    return response
 
 def vision_call_detail(request, call_id):
+    version = page_cache.vision_call_version(call_id)
+    if version is None:
+        raise Http404('No Vision API call matches the given query.')
+    not_modified = version.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
     # Get the specific Vision API call or return 404
-    vision_call = get_object_or_404(VisionAPICall, id=call_id)
+    vision_call = get_object_or_404(VisionAPICall.objects.defer(None).defer('api_response'), id=call_id)
     
     context = {
         'vision_call': vision_call,
@@ -347,17 +388,41 @@ def vision_call_detail(request, call_id):
         'text': vision_call.text if vision_call.text else [],
         'detected_objects': vision_call.detected_objects if vision_call.detected_objects else [],
         'processing_time': vision_call.processing_time_ms,
-        'ebay_listings': vision_call.product_image.ebay_listings.all(),
+        'ebay_listings': vision_call.product_image.ebay_listings.select_related('item').order_by('rank'),
+        'version': version.key,
+        'cache_ttl': settings.PAGE_CACHE_TTL_SECONDS,
     }
     
-    return render(request, 'product_matcher/vision_call_detail.html', context)
+    return version.stamp(render(request, 'product_matcher/vision_call_detail.html', context))
 
-def is_image_accessible(url):
-    try:
-        # Set a short timeout to avoid long waits
-        response = requests.head(url, timeout=3)
-        # Check if the response is successful and the content type is an image
-        return (response.status_code == 200 and 
-                response.headers.get('content-type', '').startswith('image/'))
-    except:
-        return False
+def api_vision_call(request, call_id):
+    """A Vision API call and the listings found for its image, as JSON."""
+    version = page_cache.vision_call_version(call_id)
+    if version is None:
+        return JsonResponse({'error': 'Vision API call not found'}, status=404)
+    not_modified = version.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    def build():
+        vision_call = get_object_or_404(VisionAPICall.objects.defer(None).defer('api_response'), id=call_id)
+        listings = vision_call.product_image.ebay_listings.select_related('item').order_by('rank')
+        return {
+            'id': vision_call.id,
+            'image_id': vision_call.product_image_id,
+            'request_timestamp': vision_call.request_timestamp,
+            'processing_time_ms': vision_call.processing_time_ms,
+            'cache_hit': vision_call.cache_hit,
+            'stage_timings': vision_call.stage_timings,
+            'labels': vision_call.labels or [],
+            'text': vision_call.text or [],
+            'detected_objects': vision_call.detected_objects or [],
+            'listings': [_listing_json(listing) for listing in listings],
+        }
+
+    body = page_cache.cached_json('vision_call', version, build)
+    return version.stamp(HttpResponse(body, content_type='application/json'))
+
+def metrics(request):
+    # Prometheus text exposition format; each process reports its own counters
+    return HttpResponse(timing.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
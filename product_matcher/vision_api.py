@@ -0,0 +1,182 @@
+"""Request layer for the Google Vision API.
+
+All detections needed for an image are sent as features of a single
+``AnnotateImageRequest``, and several images are packed into one
+``batch_annotate_images`` call. The combined response is split back into
+the per-detection responses stored for each VisionAPICall
+(``label_response``, ``web_response``, ``text_response``) so stored rows keep
+the shape they had when each detection was a separate call.
+
+Images are normalized (orientation, size, metadata) before they are sent;
+the cache stays keyed on the hash of the original upload. An image that is
+already being annotated for another request, in this or another process, is
+not sent again: the request waits for that result (see ``singleflight``).
+
+The ``a``-prefixed functions do the same with the asyncio Vision client, for
+the async views.
+"""
+from asgiref.sync import sync_to_async
+from google.cloud import vision
+
+from . import clients, imaging, singleflight, upstream, vision_cache
+
+# Vision accepts at most 16 images per batch request
+MAX_BATCH_SIZE = 16
+# Stay well under the request payload limit when packing several images together
+MAX_BATCH_BYTES = 10 * 1024 * 1024
+
+# Response key -> (feature type, AnnotateImageResponse fields it fills)
+FEATURES = {
+    'label_response': (vision.Feature.Type.LABEL_DETECTION, ('label_annotations',)),
+    'web_response': (vision.Feature.Type.WEB_DETECTION, ('web_detection',)),
+    'text_response': (vision.Feature.Type.TEXT_DETECTION, ('text_annotations', 'full_text_annotation')),
+}
+
+
+def build_request(content, response_keys):
+    return vision.AnnotateImageRequest(
+        image=vision.Image(content=imaging.normalize_for_vision(content)),
+        features=[vision.Feature(type_=FEATURES[key][0]) for key in response_keys],
+    )
+
+
+def split_response(response, response_keys):
+    """Split a combined AnnotateImageResponse into one response per detection."""
+    responses = {}
+    for key in response_keys:
+        fields = FEATURES[key][1] + ('error',)
+        part = vision.AnnotateImageResponse()
+        for descriptor, value in response._pb.ListFields():
+            if descriptor.name not in fields:
+                continue
+            if descriptor.label == descriptor.LABEL_REPEATED:
+                getattr(part._pb, descriptor.name).extend(value)
+            else:
+                getattr(part._pb, descriptor.name).CopyFrom(value)
+        responses[key] = part
+    return responses
+
+
+def _request_bytes(request):
+    return vision.AnnotateImageRequest.pb(request).ByteSize()
+
+
+def _batches(requests):
+    """Pack requests into batches, sized by the normalized images they carry."""
+    batch, batch_bytes = [], 0
+    for request in requests:
+        size = _request_bytes(request)
+        if batch and (len(batch) == MAX_BATCH_SIZE or batch_bytes + size > MAX_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(request)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def annotate_images(contents, response_keys, client=None):
+    """Run the requested detections for every image with as few requests as possible.
+
+    Returns one dict of responses per image, in the order of ``contents``.
+    """
+    if not contents:
+        return []
+    client = client or clients.vision()
+
+    results = []
+    for batch in _batches([build_request(content, response_keys) for content in contents]):
+        batch_response = upstream.call(upstream.VISION, client.batch_annotate_images, requests=batch)
+        results.extend(split_response(response, response_keys) for response in batch_response.responses)
+    return results
+
+
+def _flight_key(content, content_hash, response_keys):
+    return f"vision:{content_hash or vision_cache.hash_image_bytes(content)}:{','.join(response_keys)}"
+
+
+def cached_responses(content_hash, response_keys):
+    """Return the Vision cache's responses for ``content_hash``, or None on a miss."""
+    cached = vision_cache.lookup(content_hash, response_keys)
+    return None if cached is None else vision_cache.load_responses(cached, response_keys)
+
+
+def detect_images(images, response_keys, client=None, check_cache=True):
+    """Return ``(responses, cache_hit)`` for each ``(content, content_hash)`` pair.
+
+    Images found in the Vision cache are served from it; the rest are
+    annotated together in batched requests. Identical images are annotated
+    once, and images in flight for another request are waited for; both
+    count as cache hits. Pass ``check_cache=False`` for images the caller
+    already looked up with ``cached_responses``.
+    """
+    results = [None] * len(images)
+    misses = {}
+    for index, (content, content_hash) in enumerate(images):
+        cached = cached_responses(content_hash, response_keys) if check_cache else None
+        if cached is not None:
+            results[index] = (cached, True)
+        else:
+            misses[index] = _flight_key(content, content_hash, response_keys)
+
+    contents = {key: images[index][0] for index, key in misses.items()}
+
+    def annotate(keys):
+        return dict(zip(keys, annotate_images([contents[key] for key in keys], response_keys, client=client)))
+
+    annotated, shared = singleflight.do_many(list(misses.values()), annotate)
+    seen = set(shared)
+    for index, key in misses.items():
+        results[index] = (annotated[key], key in seen)
+        seen.add(key)
+    return results
+
+
+def detect_image(content, content_hash, response_keys, client=None, check_cache=True):
+    return detect_images([(content, content_hash)], response_keys, client=client, check_cache=check_cache)[0]
+
+
+async def aannotate_images(contents, response_keys, client=None):
+    """Async version of ``annotate_images``."""
+    if not contents:
+        return []
+    client = client or clients.vision_async()
+
+    # Normalizing is CPU work; keep it off the event loop
+    requests = await sync_to_async(
+        lambda: [build_request(content, response_keys) for content in contents], thread_sensitive=False
+    )()
+    results = []
+    for batch in _batches(requests):
+        batch_response = await upstream.acall(upstream.VISION, client.batch_annotate_images, requests=batch)
+        results.extend(split_response(response, response_keys) for response in batch_response.responses)
+    return results
+
+
+async def adetect_images(images, response_keys, client=None, check_cache=True):
+    """Async version of ``detect_images``."""
+    results = [None] * len(images)
+    misses = {}
+    for index, (content, content_hash) in enumerate(images):
+        cached = await sync_to_async(cached_responses)(content_hash, response_keys) if check_cache else None
+        if cached is not None:
+            results[index] = (cached, True)
+        else:
+            misses[index] = _flight_key(content, content_hash, response_keys)
+
+    contents = {key: images[index][0] for index, key in misses.items()}
+
+    async def annotate(keys):
+        annotated = await aannotate_images([contents[key] for key in keys], response_keys, client=client)
+        return dict(zip(keys, annotated))
+
+    annotated, shared = await singleflight.ado_many(list(misses.values()), annotate)
+    seen = set(shared)
+    for index, key in misses.items():
+        results[index] = (annotated[key], key in seen)
+        seen.add(key)
+    return results
+
+
+async def adetect_image(content, content_hash, response_keys, client=None, check_cache=True):
+    return (await adetect_images([(content, content_hash)], response_keys, client=client, check_cache=check_cache))[0]
@@ -0,0 +1,115 @@
+"""Content-addressed cache of Google Vision results.
+
+Every VisionAPICall that actually hit the Vision API records the SHA-256 of
+the image bytes in ``content_hash``. When the same bytes are analysed again
+within ``VISION_CACHE_TTL_SECONDS`` the stored API response is served
+instead of calling Google.
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import VisionAPICall
+
+HITS_KEY = 'vision_cache:hits'
+MISSES_KEY = 'vision_cache:misses'
+# Calls for the same image may hold different detections; check this many of the newest
+LOOKUP_CANDIDATES = 5
+
+
+def hash_image_bytes(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def _increment(key):
+    cache.add(key, 0, timeout=None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The key was evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+        return 1
+
+
+def _cache_entries():
+    # Only calls that really went to Google are cache entries; hits are copies
+    return VisionAPICall.objects.filter(
+        content_hash__isnull=False,
+        cache_hit=False,
+        error__isnull=True,
+    )
+
+
+def lookup(content_hash, response_keys):
+    """Return the stored API response of the newest fresh call for ``content_hash`` holding all ``response_keys``."""
+    cutoff = timezone.now() - timedelta(seconds=settings.VISION_CACHE_TTL_SECONDS)
+    candidates = (
+        _cache_entries()
+        .filter(content_hash=content_hash, request_timestamp__gte=cutoff)
+        .only('id', 'request_timestamp', 'api_response', 'api_response_ref')[:LOOKUP_CANDIDATES]
+    )
+
+    api_response = None
+    for vision_call in candidates:
+        stored = vision_call.get_api_response()
+        if all(key in stored for key in response_keys):
+            api_response = stored
+            break
+
+    if api_response is None:
+        misses = _increment(MISSES_KEY)
+        if settings.VISION_CACHE_EVICT_EVERY and misses % settings.VISION_CACHE_EVICT_EVERY == 0:
+            evict()
+    else:
+        _increment(HITS_KEY)
+    return api_response
+
+
+def load_responses(api_response, response_keys):
+    """Rebuild the Vision response messages from a stored API response."""
+    from google.cloud import vision
+    from google.protobuf.json_format import ParseDict
+
+    responses = {}
+    for key in response_keys:
+        message = vision.AnnotateImageResponse()
+        ParseDict(api_response[key], message._pb, ignore_unknown_fields=True)
+        responses[key] = message
+    return responses
+
+
+def evict():
+    """Expire entries older than the TTL and trim the cache to ``VISION_CACHE_MAX_ENTRIES``.
+
+    Evicted calls stay in the history; they are only no longer served as cache hits.
+    Returns the number of entries evicted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.VISION_CACHE_TTL_SECONDS)
+    evicted = _cache_entries().filter(request_timestamp__lt=cutoff).update(content_hash=None)
+
+    boundary = (
+        _cache_entries()
+        .order_by('-request_timestamp')
+        .values_list('request_timestamp', flat=True)[settings.VISION_CACHE_MAX_ENTRIES:settings.VISION_CACHE_MAX_ENTRIES + 1]
+    )
+    if boundary:
+        evicted += _cache_entries().filter(request_timestamp__lte=boundary[0]).update(content_hash=None)
+    return evicted
+
+
+def get_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])